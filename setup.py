@@ -72,5 +72,12 @@ setup(
       [console_scripts]
       create_test_users = speak_friend.scripts.createusers:main
       initialize_speak_friend_db = speak_friend.scripts.initializedb:main
+      backfill_latest_activity = speak_friend.scripts.backfillactivity:main
+      prune_activity = speak_friend.scripts.pruneactivity:main
+      reap_expired = speak_friend.scripts.reapexpired:main
+      bench_token_validation = speak_friend.scripts.benchtokens:main
+      loadtest_oauth2 = speak_friend.scripts.loadtest:main
+      password_hash_status = speak_friend.scripts.hashstatus:main
+      calibrate_password_hash = speak_friend.scripts.calibratehash:main
       """,
       )
@@ -7,6 +7,7 @@ from openid.yadis.constants import YADIS_CONTENT_TYPE
 from pyramid.authentication import AuthTktAuthenticationPolicy
 from pyramid.authorization import ACLAuthorizationPolicy
 from pyramid.config import Configurator
+from pyramid.events import ApplicationCreated
 from pyramid.events import NewResponse
 from pyramid.httpexceptions import HTTPBadRequest
 from pyramid.renderers import JSON
@@ -18,12 +19,24 @@ from pyramid_beaker import session_factory_from_settings
 from sixfeetup.bowab.configuration import require_csrf
 from sixfeetup.bowab.db import init_sa
 
+from speak_friend.cache import LRUCache
+from speak_friend.cache import cache_size
 from speak_friend.configuration import get_user
+from speak_friend.configuration import set_activity_writer
+from speak_friend.configuration import set_domain_matcher
+from speak_friend.configuration import set_identity_cache
+from speak_friend.configuration import set_login_throttle
+from speak_friend.configuration import set_openid_store
 from speak_friend.configuration import set_password_context
 from speak_friend.configuration import set_password_validator
+from speak_friend.configuration import set_rehash_queue
+from speak_friend.configuration import set_token_signer
 from speak_friend.configuration import set_username_validator
+from speak_friend.domains import RequestDomains
 from speak_friend.events import AccountCreated
+from speak_friend.events import AccountDisabled
 from speak_friend.events import AccountLocked
+from speak_friend.events import LoggedIn
 from speak_friend.events import PasswordRequested
 from speak_friend.events import PasswordReset
 from speak_friend.events import ProfileChanged
@@ -31,6 +44,10 @@ from speak_friend.events import UserActivity
 from speak_friend.forms.controlpanel import authentication_schema
 from speak_friend.forms.controlpanel import domain_defaults_schema
 from speak_friend.forms.controlpanel import email_notification_schema
+from speak_friend.forms.controlpanel import reports_schema
+from speak_friend.hashing import PasswordServiceBusy
+from speak_friend.oauth_provider import DEFAULT_TOKEN_CACHE_TTL
+from speak_friend.oauth_provider import TokenValidationCache
 from speak_friend.security import EditProfileFactory
 from speak_friend.security import RootFactory
 from speak_friend.security import groupfinder
@@ -46,10 +63,14 @@ from speak_friend.subscribers import confirm_password_reset
 from speak_friend.subscribers import email_change_notification
 from speak_friend.subscribers import email_profile_change_notification
 from speak_friend.subscribers import log_activity
+from speak_friend.subscribers import invalidate_user_identity
+from speak_friend.subscribers import invalidate_user_tokens_cache
 from speak_friend.subscribers import log_user_activity
 from speak_friend.subscribers import notify_account_created
 from speak_friend.subscribers import notify_account_locked
 from speak_friend.subscribers import notify_password_request
+from speak_friend.subscribers import record_domain_login
+from speak_friend.subscribers import start_maintenance
 
 
 def datetime_adapter(obj, request):
@@ -83,6 +104,16 @@ def includeme(config):
     # Events
     config.add_subscriber(log_activity, UserActivity)
     config.add_subscriber(log_user_activity, UserActivity)
+    config.add_subscriber(record_domain_login, LoggedIn)
+    config.add_subscriber(start_maintenance, ApplicationCreated)
+    config.add_subscriber(invalidate_user_identity, ProfileChanged)
+    config.add_subscriber(invalidate_user_tokens_cache, ProfileChanged)
+    config.add_subscriber(invalidate_user_identity, AccountDisabled)
+    config.add_subscriber(invalidate_user_identity, AccountLocked)
+    config.add_subscriber(invalidate_user_identity, PasswordReset)
+    config.add_subscriber(invalidate_user_tokens_cache, AccountDisabled)
+    config.add_subscriber(invalidate_user_tokens_cache, AccountLocked)
+    config.add_subscriber(invalidate_user_tokens_cache, PasswordReset)
     config.add_subscriber(confirm_account_created, AccountCreated)
     config.add_subscriber(notify_account_created, AccountCreated)
     config.add_subscriber(notify_account_locked, AccountLocked)
@@ -168,6 +199,15 @@ def includeme(config):
                     decorator=[require_csrf],
                     http_cache=0,
                     renderer='templates/edit_profile.pt')
+    config.add_route('authorizations_json',
+                     '/authorizations/{username}/list.json',
+                     factory=EditProfileFactory)
+    config.add_view(accounts.ManageAuthorizations, attr="listing",
+                    request_method='GET',
+                    route_name='authorizations_json',
+                    permission='edit',
+                    http_cache=0,
+                    renderer='json')
     config.add_route('remove_authzn',
                      '/remove_authorization/{username}/{access_token}',
                      factory=EditProfileFactory)
@@ -306,6 +346,8 @@ def includeme(config):
     config.add_view(error.badrequest, context=HTTPBadRequest,
                     http_cache=0,
                     renderer='templates/400_template.pt')
+    config.add_view(error.password_service_busy, context=PasswordServiceBusy,
+                    http_cache=0)
     config.add_static_view('speak_friend_static', 'speak_friend:static',
                            cache_max_age=3600)
     config.add_static_view('deform_static', 'deform:static')
@@ -346,7 +388,7 @@ def includeme(config):
     config.add_view(
         oauth2_api.get_user_details,
         route_name='get_user_details',
-        request_method='POST',
+        request_method=('GET', 'HEAD', 'POST'),
         permission=NO_PERMISSION_REQUIRED,
         renderer='json',
     )
@@ -354,6 +396,22 @@ def includeme(config):
     config.add_view(
         oauth2_api.validate_user_token,
         route_name='validate_user_token',
+        request_method=('GET', 'HEAD', 'POST'),
+        permission=NO_PERMISSION_REQUIRED,
+        renderer='json',
+    )
+    config.add_route('get_users_details', '/oauth2/get_user_details/batch')
+    config.add_view(
+        oauth2_api.get_users_details,
+        route_name='get_users_details',
+        request_method='POST',
+        permission=NO_PERMISSION_REQUIRED,
+        renderer='json',
+    )
+    config.add_route('validate_user_tokens', '/validate_user_token/batch')
+    config.add_view(
+        oauth2_api.validate_user_tokens,
+        route_name='validate_user_tokens',
         request_method='POST',
         permission=NO_PERMISSION_REQUIRED,
         renderer='json',
@@ -396,8 +454,15 @@ def includeme(config):
     json_renderer.add_adapter(colander.null.__class__, null_adapter)
 
     ## Add custom directives
+    config.add_directive('set_activity_writer', set_activity_writer)
+    config.add_directive('set_domain_matcher', set_domain_matcher)
+    config.add_directive('set_identity_cache', set_identity_cache)
+    config.add_directive('set_login_throttle', set_login_throttle)
+    config.add_directive('set_openid_store', set_openid_store)
     config.add_directive('set_password_context', set_password_context)
     config.add_directive('set_password_validator', set_password_validator)
+    config.add_directive('set_rehash_queue', set_rehash_queue)
+    config.add_directive('set_token_signer', set_token_signer)
     config.add_directive('set_username_validator', set_username_validator)
 
     # Call custom directives
@@ -405,17 +470,42 @@ def includeme(config):
     config.add_controlpanel_section(authentication_schema)
     config.add_controlpanel_section(email_notification_schema)
     config.add_controlpanel_section(domain_defaults_schema)
+    config.add_controlpanel_section(reports_schema)
     ## Password context
     from passlib.apps import ldap_context
     config.set_password_context(context=ldap_context)
+    ## Deferred upgrades of outdated password hashes
+    config.set_rehash_queue()
+    ## Login attempt throttling
+    config.set_login_throttle()
     ## Default password validator
     config.set_password_validator()
+    ## Domain name resolution
+    config.set_domain_matcher()
 
-    # Session
+    ## Identity cache
+    config.set_identity_cache()
+    ## Activity logging
+    config.set_activity_writer()
+    ## OpenID associations and nonces
+    config.set_openid_store()
+    ## Signed OAuth access tokens
+    config.set_token_signer()
+
+    # Caches
     settings = config.registry.settings
+    config.registry.login_cache = LRUCache(cache_size(settings, 'login'))
+    token_ttl = int(settings.get('speak_friend.token_cache_ttl',
+                                 DEFAULT_TOKEN_CACHE_TTL))
+    if token_ttl > 0:
+        config.registry.token_cache = TokenValidationCache(
+            cache_size(settings, 'token'), ttl=token_ttl)
+
+    # Session
     session_factory = session_factory_from_settings(settings)
     config.set_session_factory(session_factory)
     config.add_request_method(get_user, 'user', reify=True)
+    config.add_request_method(RequestDomains, 'domains', reify=True)
 
 
 def main(global_config, **settings):
@@ -0,0 +1,171 @@
+"""Batched, out of band writing of UserActivity records.
+"""
+from datetime import datetime
+import atexit
+import logging
+import os
+import Queue
+import threading
+
+from psycopg2.tz import FixedOffsetTimezone
+
+from pyramid.threadlocal import manager
+
+from speak_friend.models.reports import UserActivity
+from speak_friend.utils import after_commit
+
+
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_FLUSH_INTERVAL = 1.0  # seconds
+DEFAULT_QUEUE_SIZE = 10000
+# Read back by tweens in the same request, or needed by a foreign key
+# before the next flush.
+DEFAULT_SYNC_ACTIVITIES = (u'login', u'create_account')
+BACKPRESSURE_POLICIES = ('block', 'drop', 'sync')
+ACTIVITY_COLUMNS = [col.name for col in UserActivity.__table__.columns
+                    if col.name != 'user_activity_id']
+
+_stop = object()
+
+
+def activity_values(activity):
+    """Return the row to insert for a UserActivity, stamping the time the
+    activity happened rather than the time it is written.
+    """
+    if activity.activity_ts is None:
+        now = datetime.utcnow()
+        activity.activity_ts = now.replace(tzinfo=FixedOffsetTimezone(offset=0))
+    return dict((col, getattr(activity, col)) for col in ACTIVITY_COLUMNS)
+
+
+class ActivityWriter(object):
+    """Write UserActivity rows from a background thread.
+
+    Rows are queued once the request's transaction commits and inserted
+    ``batch_size`` at a time, with a single multi-row INSERT at least every
+    ``flush_interval`` seconds. When the queue is full, ``backpressure``
+    decides what happens: ``block`` waits for room, ``drop`` discards the
+    row and ``sync`` writes it from the calling thread.
+
+    Activities named in ``sync_activities`` are always added to the
+    request's own transaction, for those that must be visible before the
+    request ends.
+    """
+
+    def __init__(self, batch_size=DEFAULT_BATCH_SIZE,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL,
+                 queue_size=DEFAULT_QUEUE_SIZE, backpressure='block',
+                 sync_activities=DEFAULT_SYNC_ACTIVITIES):
+        if backpressure not in BACKPRESSURE_POLICIES:
+            raise ValueError(u'Unknown backpressure policy: %s' % backpressure)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.backpressure = backpressure
+        self.sync_activities = frozenset(sync_activities)
+        self.queue = Queue.Queue(queue_size)
+        self.engine = None
+        self.registry = None
+        self.logger = logging.getLogger('speak_friend.activity')
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def is_sync(self, activity):
+        return activity.activity in self.sync_activities
+
+    def record(self, request, activity):
+        """Record ``activity``, either inline or once the transaction
+        commits.
+        """
+        if self.is_sync(activity):
+            request.db_session.add(activity)
+            return
+        if self.engine is None:
+            self.engine = request.db_session.get_bind()
+            self.registry = request.registry
+        after_commit(self.enqueue, activity_values(activity))
+
+    def enqueue(self, values):
+        self.start()
+        if self.backpressure == 'block':
+            self.queue.put(values)
+            return
+        try:
+            self.queue.put_nowait(values)
+        except Queue.Full:
+            if self.backpressure == 'sync':
+                self.write([values])
+            else:
+                with self._lock:
+                    self.dropped += 1
+                self.logger.warning('Activity queue full, dropped: %r', values)
+
+    def start(self):
+        # A forked worker doesn't inherit the parent's thread
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self.run,
+                                            name='speak_friend.activity')
+            self._thread.daemon = True
+            self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self, timeout=5):
+        """Flush whatever is queued and stop the background thread."""
+        thread = self._thread
+        if thread is None or not thread.is_alive():
+            return
+        self.queue.put(_stop)
+        thread.join(timeout)
+
+    def next_batch(self):
+        """Block until a batch is ready, returning it and whether the
+        writer should stop afterwards.
+        """
+        batch = []
+        try:
+            item = self.queue.get(timeout=self.flush_interval)
+        except Queue.Empty:
+            return batch, False
+        while item is not _stop:
+            batch.append(item)
+            if len(batch) >= self.batch_size:
+                return batch, False
+            try:
+                item = self.queue.get_nowait()
+            except Queue.Empty:
+                return batch, False
+        return batch, True
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            batch, stopping = self.next_batch()
+            if batch:
+                self.write(batch)
+
+    def write(self, rows):
+        table = UserActivity.__table__
+        # activity_detail is serialized with the application's JSON
+        # renderer, which is looked up in the current registry
+        manager.push({'registry': self.registry, 'request': None})
+        try:
+            with self.engine.begin() as connection:
+                connection.execute(table.insert().values(rows))
+        except Exception:
+            with self._lock:
+                self.failed += len(rows)
+            self.logger.exception('Unable to write %d activities', len(rows))
+            return
+        finally:
+            manager.pop()
+        with self._lock:
+            self.written += len(rows)
+        self.logger.debug('Wrote %d activities', len(rows))
@@ -0,0 +1,47 @@
+"""latest_user_activity summary table
+
+Revision ID: 3f1c2a9b7d44
+Revises: 532bd411c9ca
+Create Date: 2026-10-18 16:05:12.418211
+
+Existing history is not copied here, as that can take a while on a large
+reports.user_activity table; run ``backfill_latest_activity`` afterwards.
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3f1c2a9b7d44'
+down_revision = '532bd411c9ca'
+
+from alembic import op
+import sqlalchemy as sa
+
+from sixfeetup.bowab.db import CIText
+
+from speak_friend.models.reports import LATEST_ACTIVITY_TRIGGER
+from speak_friend.models.reports import LATEST_ACTIVITY_TRIGGER_FUNCTION
+
+
+def upgrade():
+    op.create_table(
+        'latest_user_activity',
+        sa.Column('username', CIText,
+                  sa.ForeignKey('profiles.user_profiles.username'),
+                  primary_key=True),
+        sa.Column('activity', sa.UnicodeText,
+                  sa.ForeignKey('reports.activities.activity'),
+                  primary_key=True),
+        sa.Column('user_activity_id', sa.Integer, nullable=False),
+        sa.Column('activity_ts', sa.DateTime(timezone=True), nullable=False),
+        sa.Column('came_from', sa.UnicodeText),
+        sa.Column('came_from_fqdn', sa.UnicodeText),
+        schema='reports',
+    )
+    op.execute(LATEST_ACTIVITY_TRIGGER_FUNCTION)
+    op.execute(LATEST_ACTIVITY_TRIGGER % ('reports', 'user_activity'))
+
+
+def downgrade():
+    op.execute('DROP TRIGGER latest_user_activity_update '
+               'ON reports.user_activity')
+    op.execute('DROP FUNCTION latest_user_activity_trigger()')
+    op.drop_table('latest_user_activity', schema='reports')
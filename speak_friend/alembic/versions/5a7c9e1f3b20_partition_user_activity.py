@@ -0,0 +1,100 @@
+"""Partition reports.user_activity by month
+
+Revision ID: 5a7c9e1f3b20
+Revises: 8d2e4b6a1c35
+Create Date: 2026-10-18 17:32:05.604417
+
+Requires PostgreSQL 11 or newer. The existing rows are copied into the
+new partitioned table, which can take a while on a large history.
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5a7c9e1f3b20'
+down_revision = '8d2e4b6a1c35'
+
+from datetime import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+from sixfeetup.bowab.db import CIText
+
+from speak_friend.models.reports import CREATE_DEFAULT_ACTIVITY_PARTITION
+from speak_friend.models.reports import LATEST_ACTIVITY_TRIGGER
+from speak_friend.models.reports import PARTITION_MONTHS_AHEAD
+from speak_friend.models.reports import add_months
+from speak_friend.models.reports import create_activity_partitions
+from speak_friend.models.reports import month_start
+
+
+SEQUENCE = 'reports.user_activity_user_activity_id_seq'
+COLUMNS = ('user_activity_id, username, activity, activity_ts, '
+           'actor_username, came_from, came_from_fqdn, activity_detail')
+INDEXED = ('username', 'activity', 'activity_ts', 'came_from_fqdn')
+
+
+def create_user_activity(**kw):
+    op.create_table(
+        'user_activity',
+        sa.Column('user_activity_id', sa.Integer, nullable=False,
+                  server_default=sa.text("nextval('%s')" % SEQUENCE)),
+        sa.Column('username', CIText,
+                  sa.ForeignKey('profiles.user_profiles.username'),
+                  nullable=False),
+        sa.Column('activity', sa.UnicodeText,
+                  sa.ForeignKey('reports.activities.activity'),
+                  nullable=False),
+        sa.Column('activity_ts', sa.DateTime(timezone=True), nullable=False,
+                  server_default=sa.func.current_timestamp()),
+        sa.Column('actor_username', CIText,
+                  sa.ForeignKey('profiles.user_profiles.username')),
+        sa.Column('came_from', sa.UnicodeText),
+        sa.Column('came_from_fqdn', sa.UnicodeText),
+        sa.Column('activity_detail', sa.UnicodeText),
+        schema='reports',
+        **kw
+    )
+
+
+def set_aside_user_activity():
+    # Keep the id sequence when the old table is dropped
+    op.execute('ALTER SEQUENCE %s OWNED BY NONE' % SEQUENCE)
+    op.rename_table('user_activity', 'user_activity_old', schema='reports')
+    for column in INDEXED:
+        op.drop_index('ix_reports_user_activity_%s' % column,
+                      'user_activity_old', schema='reports')
+
+
+def copy_user_activity(primary_key):
+    op.execute('INSERT INTO reports.user_activity (%s) '
+               'SELECT %s FROM reports.user_activity_old' % (COLUMNS, COLUMNS))
+    op.drop_table('user_activity_old', schema='reports')
+    op.execute('ALTER SEQUENCE %s OWNED BY reports.user_activity.'
+               'user_activity_id' % SEQUENCE)
+    op.create_primary_key('user_activity_pkey', 'user_activity', primary_key,
+                          schema='reports')
+    for column in INDEXED:
+        op.create_index('ix_reports_user_activity_%s' % column,
+                        'user_activity', [column], schema='reports')
+    # Added last, latest_user_activity is already up to date
+    op.execute(LATEST_ACTIVITY_TRIGGER % ('reports', 'user_activity'))
+
+
+def upgrade():
+    set_aside_user_activity()
+    create_user_activity(postgresql_partition_by='RANGE (activity_ts)')
+    bind = op.get_bind()
+    oldest = bind.execute('SELECT min(activity_ts) '
+                          'FROM reports.user_activity_old').scalar()
+    this_month = month_start(datetime.utcnow())
+    create_activity_partitions(bind, oldest or this_month,
+                               add_months(this_month, PARTITION_MONTHS_AHEAD))
+    op.execute(CREATE_DEFAULT_ACTIVITY_PARTITION % {'schema': 'reports'})
+    copy_user_activity(['user_activity_id', 'activity_ts'])
+
+
+def downgrade():
+    # Partitions already archived or dropped are not restored
+    set_aside_user_activity()
+    create_user_activity()
+    copy_user_activity(['user_activity_id'])
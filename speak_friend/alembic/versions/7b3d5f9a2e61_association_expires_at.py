@@ -0,0 +1,29 @@
+"""Store when OpenID associations expire
+
+Revision ID: 7b3d5f9a2e61
+Revises: c4e8a2d6f913
+Create Date: 2026-10-18 18:41:19.730528
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7b3d5f9a2e61'
+down_revision = 'c4e8a2d6f913'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('associations',
+                  sa.Column('expires_at', sa.Integer),
+                  schema='openid')
+    op.execute('UPDATE openid.associations SET expires_at = issued + lifetime')
+    op.create_index('ix_openid_associations_expires_at', 'associations',
+                    ['expires_at'], schema='openid')
+
+
+def downgrade():
+    op.drop_index('ix_openid_associations_expires_at', 'associations',
+                  schema='openid')
+    op.drop_column('associations', 'expires_at', schema='openid')
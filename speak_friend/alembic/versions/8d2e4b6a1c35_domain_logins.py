@@ -0,0 +1,39 @@
+"""domain_logins presence table
+
+Revision ID: 8d2e4b6a1c35
+Revises: 3f1c2a9b7d44
+Create Date: 2026-10-18 16:48:37.120934
+
+Unlike latest_user_activity this table is populated here: until it is,
+initial_login_tween would log every user out of every domain.
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8d2e4b6a1c35'
+down_revision = '3f1c2a9b7d44'
+
+from alembic import op
+import sqlalchemy as sa
+
+from sixfeetup.bowab.db import CIText
+
+from speak_friend.models.reports import DOMAIN_LOGIN_BACKFILL
+
+
+def upgrade():
+    op.create_table(
+        'domain_logins',
+        sa.Column('username', CIText,
+                  sa.ForeignKey('profiles.user_profiles.username'),
+                  primary_key=True),
+        sa.Column('came_from_fqdn', sa.UnicodeText, primary_key=True),
+        sa.Column('first_login_ts', sa.DateTime(timezone=True),
+                  nullable=False,
+                  server_default=sa.func.current_timestamp()),
+        schema='reports',
+    )
+    op.execute(DOMAIN_LOGIN_BACKFILL)
+
+
+def downgrade():
+    op.drop_table('domain_logins', schema='reports')
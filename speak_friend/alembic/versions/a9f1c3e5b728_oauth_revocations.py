@@ -0,0 +1,32 @@
+"""Add the revocation list for signed OAuth tokens
+
+Revision ID: a9f1c3e5b728
+Revises: e2a6c8f0b417
+Create Date: 2026-10-18 21:04:12.518230
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'a9f1c3e5b728'
+down_revision = 'e2a6c8f0b417'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+        'oauth_revocations',
+        sa.Column('revocation_id', sa.Integer(), nullable=False),
+        sa.Column('kind', sa.UnicodeText(), nullable=False),
+        sa.Column('value', sa.UnicodeText(), nullable=False),
+        sa.Column('revoked_at', sa.TIMESTAMP(), nullable=False),
+        sa.PrimaryKeyConstraint('revocation_id'),
+    )
+    op.create_index('ix_oauth_revocations_revoked_at', 'oauth_revocations',
+                    ['revoked_at'])
+
+
+def downgrade():
+    op.drop_index('ix_oauth_revocations_revoked_at', 'oauth_revocations')
+    op.drop_table('oauth_revocations')
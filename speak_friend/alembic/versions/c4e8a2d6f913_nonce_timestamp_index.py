@@ -0,0 +1,22 @@
+"""Index openid.nonces by timestamp
+
+Revision ID: c4e8a2d6f913
+Revises: 5a7c9e1f3b20
+Create Date: 2026-10-18 18:10:44.285163
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c4e8a2d6f913'
+down_revision = '5a7c9e1f3b20'
+
+from alembic import op
+
+
+def upgrade():
+    op.create_index('ix_openid_nonces_timestamp', 'nonces', ['timestamp'],
+                    schema='openid')
+
+
+def downgrade():
+    op.drop_index('ix_openid_nonces_timestamp', 'nonces', schema='openid')
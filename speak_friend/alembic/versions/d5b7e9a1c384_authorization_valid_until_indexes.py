@@ -0,0 +1,34 @@
+"""Index oauth_authorizations.valid_until for reap_expired
+
+Revision ID: d5b7e9a1c384
+Revises: a9f1c3e5b728
+Create Date: 2026-10-18 22:11:37.402915
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'd5b7e9a1c384'
+down_revision = 'a9f1c3e5b728'
+
+from alembic import op
+import sqlalchemy as sa
+
+from speak_friend.models.authorizations import UNDEFINED_SECRET
+
+
+def upgrade():
+    op.create_index('ix_oauth_authorizations_code_valid_until',
+                    'oauth_authorizations', ['valid_until'],
+                    postgresql_where=sa.text("access_token = '%s'" %
+                                             UNDEFINED_SECRET))
+    op.create_index('ix_oauth_authorizations_token_valid_until',
+                    'oauth_authorizations', ['valid_until'],
+                    postgresql_where=sa.text("access_token <> '%s'" %
+                                             UNDEFINED_SECRET))
+
+
+def downgrade():
+    op.drop_index('ix_oauth_authorizations_token_valid_until',
+                  'oauth_authorizations')
+    op.drop_index('ix_oauth_authorizations_code_valid_until',
+                  'oauth_authorizations')
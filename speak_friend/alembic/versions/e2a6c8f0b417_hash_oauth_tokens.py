@@ -0,0 +1,69 @@
+"""Store digests of OAuth tokens and codes
+
+Revision ID: e2a6c8f0b417
+Revises: 7b3d5f9a2e61
+Create Date: 2026-10-18 19:20:51.903377
+
+Existing tokens and codes are replaced by their SHA-256 digests, which
+can't be undone: downgrading only drops the indexes.
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'e2a6c8f0b417'
+down_revision = '7b3d5f9a2e61'
+
+from alembic import op
+import sqlalchemy as sa
+
+from speak_friend.models.authorizations import UNDEFINED_SECRET
+from speak_friend.utils import hash_string
+
+
+authorizations = sa.sql.table(
+    'oauth_authorizations',
+    sa.sql.column('username', sa.UnicodeText),
+    sa.sql.column('client_id', sa.UnicodeText),
+    sa.sql.column('access_token', sa.UnicodeText),
+    sa.sql.column('auth_code', sa.UnicodeText),
+)
+
+
+def digest(value):
+    if value is None or value == UNDEFINED_SECRET:
+        return value
+    return hash_string(value)
+
+
+def upgrade():
+    bind = op.get_bind()
+    rows = bind.execute(sa.select([
+        authorizations.c.username,
+        authorizations.c.client_id,
+        authorizations.c.access_token,
+        authorizations.c.auth_code,
+    ])).fetchall()
+    for row in rows:
+        bind.execute(
+            authorizations.update().where(
+                (authorizations.c.username == row.username) &
+                (authorizations.c.client_id == row.client_id)
+            ).values(
+                access_token=digest(row.access_token),
+                auth_code=digest(row.auth_code),
+            )
+        )
+    op.create_index('ix_oauth_authorizations_access_token',
+                    'oauth_authorizations', ['access_token'], unique=True,
+                    postgresql_where=sa.text("access_token <> '%s'" %
+                                             UNDEFINED_SECRET))
+    op.create_index('ix_oauth_authorizations_auth_code',
+                    'oauth_authorizations', ['auth_code'], unique=True,
+                    postgresql_where=sa.text("auth_code <> '%s'" %
+                                             UNDEFINED_SECRET))
+
+
+def downgrade():
+    op.drop_index('ix_oauth_authorizations_auth_code',
+                  'oauth_authorizations')
+    op.drop_index('ix_oauth_authorizations_access_token',
+                  'oauth_authorizations')
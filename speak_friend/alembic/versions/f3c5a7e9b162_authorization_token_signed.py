@@ -0,0 +1,30 @@
+"""Record whether an authorization's access token is signed
+
+Revision ID: f3c5a7e9b162
+Revises: d5b7e9a1c384
+Create Date: 2026-10-19 10:42:18.306144
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'f3c5a7e9b162'
+down_revision = 'd5b7e9a1c384'
+
+from alembic import op
+import sqlalchemy as sa
+
+from speak_friend.models.authorizations import UNDEFINED_SECRET
+
+
+def upgrade():
+    op.add_column('oauth_authorizations',
+                  sa.Column('token_signed', sa.Boolean(), nullable=False,
+                            server_default=sa.false()))
+    # Tokens issued before now can't be told apart, so they are still
+    # revoked when replaced
+    op.execute("UPDATE oauth_authorizations SET token_signed = true "
+               "WHERE access_token <> '%s'" % UNDEFINED_SECRET)
+
+
+def downgrade():
+    op.drop_column('oauth_authorizations', 'token_signed')
@@ -3,7 +3,7 @@ import logging
 from pyramid.renderers import get_renderer
 from sixfeetup.bowab.api import TemplateAPI
 
-from speak_friend.models.profiles import DomainProfile
+from speak_friend.domains import find_domain
 from speak_friend.models.reports import UserActivity
 
 from speak_friend.utils import get_xrds_url
@@ -49,10 +49,7 @@ class SFTemplateAPI(TemplateAPI):
             else:
                 came_from = self.rendering_val.get('came_from', self.request)
                 name = get_domain(came_from)
-            domain = None
-            if name:
-                domain = DomainProfile.apply_wildcard(
-                    self.request.db_session, name)
+            domain = find_domain(self.request, name)
             if domain:
                 self._domain = domain
         logger.debug('Came from: %s', getattr(self, '_domain', None))
@@ -0,0 +1,87 @@
+"""Small in-process caches shared between requests.
+"""
+from collections import OrderedDict
+import threading
+import time
+
+
+DEFAULT_CACHE_SIZE = 10000
+
+
+class LRUCache(object):
+    """A thread safe, size bounded mapping with optional expiry.
+
+    Once ``maxsize`` entries are stored the least recently used one is
+    evicted. Entries older than ``ttl`` seconds are treated as missing;
+    a per-entry ``ttl`` passed to :meth:`set` takes precedence.
+    """
+
+    def __init__(self, maxsize=DEFAULT_CACHE_SIZE, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key, _missing) is not _missing
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires, value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires is not None and expires < time.time():
+                self.misses += 1
+                return default
+            # Re-insert to mark as most recently used
+            self._data[key] = (expires, value)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        expires = None
+        if ttl is not None:
+            expires = time.time() + ttl
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (expires, value)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def invalidate_where(self, predicate):
+        """Drop every entry whose key satisfies ``predicate``."""
+        with self._lock:
+            for key in [k for k in self._data if predicate(k)]:
+                del self._data[key]
+
+    def invalidate_values(self, predicate):
+        """Drop every entry whose value satisfies ``predicate``."""
+        with self._lock:
+            for key, (expires, value) in self._data.items():
+                if predicate(value):
+                    del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+_missing = object()
+
+
+def cache_size(settings, name, default=DEFAULT_CACHE_SIZE):
+    """Read the ``speak_friend.<name>_cache_size`` setting."""
+    return int(settings.get('speak_friend.%s_cache_size' % name, default))
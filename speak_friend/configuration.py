@@ -1,12 +1,44 @@
 
 from pyramid.exceptions import ConfigurationError
+from pyramid.path import DottedNameResolver
 from pyramid.security import unauthenticated_userid
+from pyramid.settings import asbool
+from pyramid.settings import aslist
 
 from passlib.context import CryptContext
 
+from speak_friend.activity import DEFAULT_BATCH_SIZE
+from speak_friend.activity import DEFAULT_FLUSH_INTERVAL
+from speak_friend.activity import DEFAULT_QUEUE_SIZE
+from speak_friend.activity import DEFAULT_SYNC_ACTIVITIES
+from speak_friend.activity import ActivityWriter
+from speak_friend.cache import LRUCache
+from speak_friend.cache import cache_size
+from speak_friend.domains import DEFAULT_CLIENT_CREDENTIALS_TTL
+from speak_friend.domains import DEFAULT_DOMAIN_CACHE_TTL
+from speak_friend.domains import ClientCredentials
+from speak_friend.domains import DomainMatcher
+from speak_friend.hashing import DEFAULT_PASSWORD_PROCESSES
+from speak_friend.hashing import DEFAULT_PASSWORD_QUEUE_SIZE
+from speak_friend.hashing import DEFAULT_PASSWORD_TIMEOUT
+from speak_friend.hashing import DEFAULT_REHASH_MAX_AGE
+from speak_friend.hashing import DEFAULT_REHASH_QUEUE_SIZE
+from speak_friend.hashing import DEFAULT_REHASH_RATE
+from speak_friend.hashing import PasswordHashingService
+from speak_friend.hashing import RehashQueue
+from speak_friend.identity import DEFAULT_IDENTITY_CACHE_TTL
+from speak_friend.identity import IdentityCache
+from speak_friend.identity import load_user
+from speak_friend.models.open_id import DEFAULT_NONCE_CAPACITY
+from speak_friend.models.open_id import AssociationCache
+from speak_friend.models.open_id import MemoryOpenIDStore
+from speak_friend.models.open_id import sql_store_factory
 from speak_friend.passwords import PasswordValidator
-
-from speak_friend.models.profiles import UserProfile
+from speak_friend.throttle import LoginThrottle
+from speak_friend.tokens import DEFAULT_REVOCATION_TTL
+from speak_friend.tokens import RevocationList
+from speak_friend.tokens import TokenSigner
+from speak_friend.tokens import parse_signing_keys
 
 
 def set_password_context(config, context=None, ini_string='', ini_file=None,
@@ -33,6 +65,13 @@ def set_password_context(config, context=None, ini_string='', ini_file=None,
         A dictionary of arguments suitable for constructing a CryptContext
         (see http://pythonhosted.org/passlib/lib/passlib.context.html#passlib.context.CryptContext.to_dict)
 
+    When ``speak_friend.password_processes`` is more than 0, the context is
+    wrapped in a PasswordHashingService, which encrypts and verifies passwords
+    in that many worker processes. ``speak_friend.password_queue_size``
+    bounds how many calls wait for a worker, and
+    ``speak_friend.password_timeout`` how many seconds a caller waits,
+    before PasswordServiceBusy is raised.
+
     :raises ConfigurationError
         If given insufficient or incorrect arguments
     """
@@ -67,11 +106,50 @@ def set_password_context(config, context=None, ini_string='', ini_file=None,
         if bad_config:
             raise ConfigurationError("set_password_context %s" % bad_config)
 
+        settings = config.registry.settings
+        processes = int(settings.get('speak_friend.password_processes',
+                                     DEFAULT_PASSWORD_PROCESSES))
+        if processes > 0:
+            constructed_context = PasswordHashingService(
+                constructed_context, processes,
+                queue_size=int(settings.get('speak_friend.password_queue_size',
+                                            DEFAULT_PASSWORD_QUEUE_SIZE)),
+                timeout=float(settings.get('speak_friend.password_timeout',
+                                           DEFAULT_PASSWORD_TIMEOUT)))
         config.registry.password_context = constructed_context
 
     config.action('password_context', register_context)
 
 
+def set_rehash_queue(config, queue_class=RehashQueue):
+    """
+    Upgrade password hashes that don't match the password context's policy
+    from a background thread after login, instead of during the login.
+
+    ``speak_friend.rehash_rate`` sets how many hashes are upgraded per
+    second (0 upgrades them inline, during the login request).
+    ``speak_friend.rehash_queue_size`` bounds how many wait, and
+    ``speak_friend.rehash_max_age`` how many seconds each may wait before
+    it is discarded until the user's next login.
+    """
+    def initialize_queue():
+        settings = config.registry.settings
+        rate = float(settings.get('speak_friend.rehash_rate',
+                                  DEFAULT_REHASH_RATE))
+        rehash_queue = None
+        if rate > 0:
+            rehash_queue = queue_class(
+                rate=rate,
+                queue_size=int(settings.get('speak_friend.rehash_queue_size',
+                                            DEFAULT_REHASH_QUEUE_SIZE)),
+                max_age=float(settings.get('speak_friend.rehash_max_age',
+                                           DEFAULT_REHASH_MAX_AGE)),
+            )
+        config.registry.rehash_queue = rehash_queue
+
+    config.action('rehash_queue', initialize_queue)
+
+
 def set_password_validator(config, validator_class=PasswordValidator):
     def initialize_validator():
         settings = config.registry.settings
@@ -81,12 +159,204 @@ def set_password_validator(config, validator_class=PasswordValidator):
     config.action('password_validator', initialize_validator)
 
 
+def set_domain_matcher(config, matcher_class=DomainMatcher):
+    """
+    Create the object used to resolve request domains to DomainProfiles,
+    and the in-memory copy of their OAuth client secrets.
+
+    The ``speak_friend.domain_cache_ttl`` setting controls how many seconds
+    the compiled domain patterns are trusted before being reloaded. This
+    bounds how long other processes serve stale patterns after a domain is
+    changed.
+
+    The secrets are reloaded every ``speak_friend.client_credentials_ttl``
+    seconds, bounding how long other processes accept a rotated secret or
+    reject a new client.
+    """
+    def initialize_matcher():
+        settings = config.registry.settings
+        ttl = int(settings.get('speak_friend.domain_cache_ttl',
+                               DEFAULT_DOMAIN_CACHE_TTL))
+        config.registry.domain_matcher = matcher_class(ttl=ttl)
+        ttl = int(settings.get('speak_friend.client_credentials_ttl',
+                               DEFAULT_CLIENT_CREDENTIALS_TTL))
+        config.registry.client_credentials = ClientCredentials(ttl=ttl)
+
+    config.action('domain_matcher', initialize_matcher)
+
+
+def set_identity_cache(config, cache_class=IdentityCache):
+    """
+    Create the cache used to resolve userids to UserProfiles.
+
+    Entries are trusted for ``speak_friend.identity_cache_ttl`` seconds,
+    which bounds how long other processes keep serving a changed profile.
+    Setting it to 0 disables the cache. ``speak_friend.identity_cache_size``
+    bounds the number of users kept.
+    """
+    def initialize_cache():
+        settings = config.registry.settings
+        ttl = int(settings.get('speak_friend.identity_cache_ttl',
+                               DEFAULT_IDENTITY_CACHE_TTL))
+        cache = None
+        if ttl > 0:
+            cache = cache_class(cache_size(settings, 'identity'), ttl=ttl)
+        config.registry.identity_cache = cache
+
+    config.action('identity_cache', initialize_cache)
+
+
+def set_activity_writer(config, writer_class=ActivityWriter):
+    """
+    Optionally write UserActivity records in batches from a background
+    thread, instead of as part of each request's transaction.
+
+    Disabled unless ``speak_friend.activity_writer`` is true. It is tuned
+    with these settings:
+
+    ``speak_friend.activity_batch_size``
+        The most rows written by a single INSERT.
+
+    ``speak_friend.activity_flush_interval``
+        The most seconds a queued row waits before being written.
+
+    ``speak_friend.activity_queue_size``
+        How many rows may be waiting to be written.
+
+    ``speak_friend.activity_backpressure``
+        What to do when the queue is full: ``block``, ``drop`` or ``sync``.
+
+    ``speak_friend.activity_sync``
+        Activities still written inline, as they are read back in the
+        same request.
+    """
+    def initialize_writer():
+        settings = config.registry.settings
+        writer = None
+        if asbool(settings.get('speak_friend.activity_writer', False)):
+            sync = settings.get('speak_friend.activity_sync',
+                                DEFAULT_SYNC_ACTIVITIES)
+            writer = writer_class(
+                batch_size=int(settings.get('speak_friend.activity_batch_size',
+                                            DEFAULT_BATCH_SIZE)),
+                flush_interval=float(settings.get(
+                    'speak_friend.activity_flush_interval',
+                    DEFAULT_FLUSH_INTERVAL)),
+                queue_size=int(settings.get('speak_friend.activity_queue_size',
+                                            DEFAULT_QUEUE_SIZE)),
+                backpressure=settings.get('speak_friend.activity_backpressure',
+                                          'block'),
+                sync_activities=aslist(sync),
+            )
+        config.registry.activity_writer = writer
+
+    config.action('activity_writer', initialize_writer)
+
+
+def set_login_throttle(config, store_factory=None):
+    """
+    Create the token buckets limiting login attempts per client address
+    and per login name. Their rates are set in the Authentication section
+    of the control panel.
+
+    :arg store_factory:
+        A callable taking the settings and returning the store buckets are
+        kept in, with the ``get`` and ``set`` methods of LRUCache, such as a
+        store shared by the processes on a host. Defaults to the
+        ``speak_friend.login_throttle_store`` setting, a dotted name, or an
+        in-process LRUCache of ``speak_friend.login_throttle_cache_size``
+        buckets.
+    """
+    def initialize_throttle():
+        settings = config.registry.settings
+        factory = store_factory
+        if factory is None:
+            name = settings.get('speak_friend.login_throttle_store')
+            if name:
+                factory = DottedNameResolver().maybe_resolve(name)
+        if factory is None:
+            store = LRUCache(cache_size(settings, 'login_throttle'))
+        else:
+            store = factory(settings)
+        config.registry.login_throttle = LoginThrottle(store)
+
+    config.action('login_throttle', initialize_throttle)
+
+
+def set_openid_store(config, store_factory=None):
+    """
+    Choose where the OpenID provider keeps associations and nonces.
+
+    :arg store_factory:
+        A callable taking the request and returning an IOpenIDStore.
+        Defaults to the ``speak_friend.openid_store`` setting: ``sql`` (the
+        default) for the database, ``memory`` for a store private to this
+        process, or the dotted name of a factory. The memory store
+        remembers up to ``speak_friend.nonce_capacity`` nonces.
+
+    Associations read from or written to the database are also kept in
+    an in-process cache, bounded by
+    ``speak_friend.association_cache_size``.
+    """
+    def initialize_store():
+        settings = config.registry.settings
+        factory = store_factory
+        if factory is None:
+            name = settings.get('speak_friend.openid_store', 'sql')
+            if name == 'sql':
+                factory = sql_store_factory
+            elif name == 'memory':
+                capacity = int(settings.get('speak_friend.nonce_capacity',
+                                            DEFAULT_NONCE_CAPACITY))
+                store = MemoryOpenIDStore(nonce_capacity=capacity)
+                factory = lambda request: store
+            else:
+                factory = DottedNameResolver().maybe_resolve(name)
+        config.registry.openid_store_factory = factory
+        config.registry.association_cache = AssociationCache(
+            cache_size(settings, 'association'))
+
+    config.action('openid_store', initialize_store)
+
+
+def set_token_signer(config, signer_class=TokenSigner):
+    """
+    Optionally issue signed access tokens, which are checked without a
+    database round trip.
+
+    Enabled by ``speak_friend.token_signing_keys``, a whitespace separated
+    list of ``key_id:secret`` pairs. New tokens are signed with the first
+    key; tokens signed with any listed key are accepted.
+
+    Revoked signed tokens are kept in memory and reloaded from the database
+    every ``speak_friend.revocation_ttl`` seconds, which bounds how long
+    other processes accept a revoked token.
+    """
+    def initialize_signer():
+        settings = config.registry.settings
+        signer = revocations = None
+        keys = aslist(settings.get('speak_friend.token_signing_keys', ''))
+        if keys:
+            try:
+                signer = signer_class(parse_signing_keys(keys))
+            except ValueError, e:
+                raise ConfigurationError(
+                    'speak_friend.token_signing_keys: %s' % e)
+            ttl = int(settings.get('speak_friend.revocation_ttl',
+                                   DEFAULT_REVOCATION_TTL))
+            revocations = RevocationList(ttl=ttl)
+        config.registry.token_signer = signer
+        config.registry.token_revocations = revocations
+
+    config.action('token_signer', initialize_signer)
+
+
 def get_user(request):
     userid = unauthenticated_userid(request)
     if userid is not None:
         # this should return None if the user doesn't exist
         # in the database
-        return request.db_session.query(UserProfile).get(userid)
+        return load_user(request, userid)
 
 
 def set_username_validator(config, validator_class=None):
@@ -0,0 +1,278 @@
+"""In-process resolution of domain names against stored DomainProfiles.
+"""
+import logging
+import threading
+import time
+
+from speak_friend.models.profiles import DomainProfile
+from speak_friend.utils import after_commit
+
+
+DEFAULT_DOMAIN_CACHE_TTL = 300  # seconds
+DEFAULT_CLIENT_CREDENTIALS_TTL = 30  # seconds
+DEFAULT_CLIENT_SECRET_RECHECK_AGE = 5  # seconds
+WILDCARD = u'*'
+WILDCARD_LABEL = u'*.'
+
+
+class _LabelNode(object):
+    """A node in the reversed-label trie used for ``*.`` wildcards."""
+    __slots__ = ('children', 'profile')
+
+    def __init__(self):
+        self.children = {}
+        self.profile = None
+
+
+class CompiledDomains(object):
+    """An immutable snapshot of every DomainProfile pattern.
+
+    Exact names live in a dictionary, ``*.example.com`` patterns in a trie
+    keyed by reversed labels and any other leading ``*`` patterns in a
+    short list of suffixes.
+    """
+
+    def __init__(self, profiles):
+        self.exact = {}
+        self.wildcards = _LabelNode()
+        self.suffixes = []
+        for profile in profiles:
+            name = profile.name.lower()
+            if name.startswith(WILDCARD_LABEL):
+                node = self.wildcards
+                for label in reversed(name[2:].split(u'.')):
+                    node = node.children.setdefault(label, _LabelNode())
+                node.profile = profile
+            elif name.startswith(WILDCARD):
+                self.suffixes.append((name[1:], profile))
+            else:
+                self.exact[name] = profile
+
+    def match(self, domain_name):
+        """Return the most specific profile matching ``domain_name``.
+
+        An exact name always wins, otherwise the longest matching
+        wildcard pattern is returned.
+        """
+        domain_name = domain_name.lower()
+        profile = self.exact.get(domain_name)
+        if profile is not None:
+            return profile
+
+        best = None
+        labels = domain_name.split(u'.')
+        node = self.wildcards
+        # Stop one label short, a wildcard needs something to match
+        for label in reversed(labels[1:]):
+            node = node.children.get(label)
+            if node is None:
+                break
+            if node.profile is not None:
+                best = node.profile
+        for suffix, candidate in self.suffixes:
+            if not domain_name.endswith(suffix):
+                continue
+            if best is None or len(candidate.name) > len(best.name):
+                best = candidate
+        return best
+
+
+class DomainMatcher(object):
+    """Resolve domain names without a database round trip.
+
+    The first lookup loads every DomainProfile in a single query and
+    compiles them; later lookups only touch memory until the matcher is
+    invalidated or ``ttl`` seconds have passed. Profiles are returned as
+    detached copies, so they can safely be shared between requests.
+    """
+
+    def __init__(self, ttl=DEFAULT_DOMAIN_CACHE_TTL):
+        self.ttl = ttl
+        self.logger = logging.getLogger('speak_friend.domains')
+        self._lock = threading.Lock()
+        self._compiled = None
+        self._loaded_at = 0
+        self._generation = 0
+        self.request_hits = 0
+        self.request_misses = 0
+
+    def invalidate(self):
+        """Discard the compiled domains, forcing a reload on next use."""
+        with self._lock:
+            self._generation += 1
+            self._compiled = None
+        self.logger.debug('Domain patterns invalidated')
+
+    def is_stale(self):
+        if self._compiled is None:
+            return True
+        if self.ttl and time.time() - self._loaded_at > self.ttl:
+            return True
+        return False
+
+    def load(self, session):
+        generation = self._generation
+        profiles = []
+        for profile in session.query(DomainProfile).all():
+            profiles.append(DomainProfile(**profile.make_appstruct()))
+        compiled = CompiledDomains(profiles)
+        with self._lock:
+            # Don't publish a snapshot that was invalidated while loading
+            if generation == self._generation:
+                self._compiled = compiled
+                self._loaded_at = time.time()
+        self.logger.debug('Loaded %d domain patterns', len(profiles))
+        return compiled
+
+    def compiled(self, session):
+        compiled = self._compiled
+        if compiled is None or self.is_stale():
+            compiled = self.load(session)
+        return compiled
+
+    def match(self, session, domain_name):
+        if not domain_name:
+            return None
+        return self.compiled(session).match(domain_name)
+
+    def record_request(self, hits, misses):
+        """Accumulate the per-request cache counters for this process."""
+        with self._lock:
+            self.request_hits += hits
+            self.request_misses += misses
+
+
+class ClientCredentials(object):
+    """Every domain's client secret digest, kept in memory.
+
+    Loaded with a single query and reloaded when invalidated or ``ttl``
+    seconds old, so checking a secret, or rejecting an unknown client,
+    needs no database round trip. Only this process invalidates it, so
+    ``ttl`` bounds how long another process accepts a rotated secret.
+    """
+
+    def __init__(self, ttl=DEFAULT_CLIENT_CREDENTIALS_TTL):
+        self.ttl = ttl
+        self.logger = logging.getLogger('speak_friend.domains')
+        self._lock = threading.Lock()
+        self._secrets = None
+        self._loaded_at = 0
+        self._generation = 0
+
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+            self._secrets = None
+
+    def is_stale(self):
+        if self._secrets is None:
+            return True
+        if self.ttl and time.time() - self._loaded_at > self.ttl:
+            return True
+        return False
+
+    def load(self, session):
+        generation = self._generation
+        secrets = dict(session.query(DomainProfile.name,
+                                     DomainProfile.client_secret).all())
+        with self._lock:
+            if generation == self._generation:
+                self._secrets = secrets
+                self._loaded_at = time.time()
+        self.logger.debug('Loaded %d client credentials', len(secrets))
+        return secrets
+
+    def secret_digest(self, session, client_id):
+        """Return the client secret digest of ``client_id``, or None if
+        there is no such domain or it has no secret.
+        """
+        secrets = self._secrets
+        if secrets is None or self.is_stale():
+            secrets = self.load(session)
+        return secrets.get(client_id)
+
+    def recheck(self, session, client_id,
+                min_age=DEFAULT_CLIENT_SECRET_RECHECK_AGE):
+        """Reload the secrets if they were loaded more than ``min_age``
+        seconds ago, and return ``client_id``'s digest. Returns None without
+        a query if they are more recent.
+        """
+        if time.time() - self._loaded_at < min_age:
+            return None
+        return self.load(session).get(client_id)
+
+
+class RequestDomains(object):
+    """Memoize domain resolution for the lifetime of a single request.
+
+    Available as ``request.domains``; every tween, the template API and
+    the OAuth provider share it, so each distinct name is resolved at
+    most once per request. ``hits`` and ``misses`` count lookups answered
+    from, and added to, the memo.
+    """
+
+    def __init__(self, request):
+        self.request = request
+        self.resolved = {}
+        self.hits = 0
+        self.misses = 0
+        self.logger = logging.getLogger('speak_friend.domains')
+        request.add_finished_callback(self.finished)
+
+    def find(self, domain_name):
+        if not domain_name:
+            return None
+        key = domain_name.lower()
+        if key in self.resolved:
+            self.hits += 1
+            return self.resolved[key]
+        self.misses += 1
+        domain = lookup_domain(self.request, domain_name)
+        self.resolved[key] = domain
+        return domain
+
+    def finished(self, request):
+        if not (self.hits or self.misses):
+            return
+        self.logger.debug('Domain lookups for %s: %d hits, %d misses',
+                          request.path, self.hits, self.misses)
+        matcher = getattr(request.registry, 'domain_matcher', None)
+        if matcher is not None:
+            matcher.record_request(self.hits, self.misses)
+
+
+def find_domain(request, domain_name):
+    """Return the most specific DomainProfile for ``domain_name``.
+
+    Results are memoized on ``request.domains`` when it is available.
+    """
+    domains = getattr(request, 'domains', None)
+    if domains is not None:
+        return domains.find(domain_name)
+    return lookup_domain(request, domain_name)
+
+
+def lookup_domain(request, domain_name):
+    """Resolve ``domain_name`` without any per-request memoization.
+
+    Uses the registry's domain matcher when one is configured and falls
+    back to querying the database.
+    """
+    if not domain_name:
+        return None
+    matcher = getattr(request.registry, 'domain_matcher', None)
+    if matcher is None:
+        return DomainProfile.apply_wildcard(request.db_session, domain_name)
+    return matcher.match(request.db_session, domain_name)
+
+
+def invalidate_domains(request):
+    """Reload the domain patterns and client credentials once the current
+    transaction commits.
+    """
+    matcher = getattr(request.registry, 'domain_matcher', None)
+    if matcher is not None:
+        after_commit(matcher.invalidate)
+    credentials = getattr(request.registry, 'client_credentials', None)
+    if credentials is not None:
+        after_commit(credentials.invalidate)
@@ -1,5 +1,6 @@
 from colander import (
-    Email, Integer, Schema, SchemaNode, SequenceSchema, String, Range)
+    Boolean, Email, Integer, Schema, SchemaNode, SequenceSchema, String,
+    Range)
 from deform import Form
 
 
@@ -22,6 +23,8 @@ class EmailNotification(Schema):
 
 MAX_DOMAIN_ATTEMPTS = 10
 TOKEN_DURATION = 60
+ADDRESS_ATTEMPTS_PER_MINUTE = 30
+LOGIN_ATTEMPTS_PER_MINUTE = 5
 
 class Authentication(Schema):
     token_duration = SchemaNode(
@@ -37,6 +40,25 @@ class Authentication(Schema):
                     "fail a login attempt before being disabled (must be >= 1)",
         validator=Range(min=1),
     )
+    address_attempts_per_minute = SchemaNode(
+        Integer(),
+        default=ADDRESS_ATTEMPTS_PER_MINUTE,
+        title="Login attempts per minute from an address",
+        description="Login attempts from one client address beyond this "
+                    "rate are refused before the password is checked "
+                    "(0 for no limit)",
+        validator=Range(min=0),
+    )
+    login_attempts_per_minute = SchemaNode(
+        Integer(),
+        default=LOGIN_ATTEMPTS_PER_MINUTE,
+        title="Login attempts per minute for an account",
+        description="Login attempts for one account, by username or "
+                    "email, beyond this rate are refused before the "
+                    "password is checked "
+                    "(0 for no limit)",
+        validator=Range(min=0),
+    )
 
 
 MAX_PASSWORD_VALID = 60*24*30
@@ -52,6 +74,27 @@ class DomainDefaults(Schema):
     )
 
 
+ACTIVITY_RETENTION = 0
+
+class Reports(Schema):
+    activity_retention = SchemaNode(
+        Integer(),
+        default=ACTIVITY_RETENTION,
+        title="Activity retention",
+        description="Number of whole months of user activity to keep, "
+                    "older months are removed by the prune_activity "
+                    "command (0 keeps everything)",
+        validator=Range(min=0),
+    )
+    archive_activity = SchemaNode(
+        Boolean(),
+        default=False,
+        title="Archive activity",
+        description="Move removed months of user activity to the "
+                    "reports_archive schema instead of deleting them",
+    )
+
+
 email_notification_schema = EmailNotification(
     path=u'.'.join((EmailNotification.__module__,
                    'email_notification_schema')),
@@ -75,3 +118,11 @@ domain_defaults_schema = DomainDefaults(
     title=u'Domain Default Values',
     description=u'Default values applied to domains without specific settings',
 )
+
+
+reports_schema = Reports(
+    path=u'.'.join((Reports.__module__,
+                    'reports_schema')),
+    name=u'reports_schema',
+    title=u'Reports',
+)
@@ -0,0 +1,337 @@
+"""Password hashing in a pool of worker processes, and upgrading hashes
+to the current policy off the request path.
+"""
+import atexit
+import logging
+import multiprocessing
+import os
+import Queue
+import threading
+import time
+
+from pyramid.httpexceptions import HTTPServiceUnavailable
+
+from sqlalchemy import and_
+
+from speak_friend.models.profiles import UserProfile
+from speak_friend.utils import after_commit
+
+
+DEFAULT_PASSWORD_PROCESSES = 0  # hash in the calling thread
+DEFAULT_PASSWORD_QUEUE_SIZE = 16
+DEFAULT_PASSWORD_TIMEOUT = 10  # seconds
+DEFAULT_PASSWORD_STATS_INTERVAL = 300  # seconds, 0 disables
+DEFAULT_REHASH_RATE = 10  # per second, 0 rehashes inline
+DEFAULT_REHASH_QUEUE_SIZE = 1000
+DEFAULT_REHASH_MAX_AGE = 60  # seconds
+
+# Set in each worker process by _init_worker
+_context = None
+
+
+class PasswordServiceBusy(HTTPServiceUnavailable):
+    """Raised instead of queueing a hash when the pool is saturated."""
+    explanation = ('We are receiving too many sign in requests right now. '
+                   'Please try again in a few seconds.')
+
+
+def _init_worker(context):
+    global _context
+    _context = context
+
+
+def _run(method, args, kwargs, queued_at):
+    """Call ``method`` on the worker's context, returning how long the call
+    waited for a worker and how long it took, with its outcome.
+    """
+    started = time.time()
+    try:
+        outcome = (True, getattr(_context, method)(*args, **kwargs))
+    except Exception, e:
+        outcome = (False, e)
+    return started - queued_at, time.time() - started, outcome
+
+
+class Timing(object):
+    """Running count, total and maximum of a duration, in seconds."""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    @property
+    def mean(self):
+        return self.count and self.total / self.count or 0.0
+
+
+class PasswordHashingService(object):
+    """Stand-in for a passlib CryptContext that runs ``encrypt``, ``verify``
+    and ``verify_and_update`` in a pool of ``processes`` worker processes,
+    so a slow hash doesn't hold the GIL of a request thread.
+
+    At most ``queue_size`` calls wait for a free worker; past that, and when
+    a call isn't answered within ``timeout`` seconds,
+    :class:`PasswordServiceBusy` is raised. ``queue_wait`` and ``hash_time``
+    time every call, and ``busy`` counts those refused; :meth:`stats`
+    returns them and :meth:`log_stats` logs them.
+
+    :meth:`start` creates the pool, and should be called before serving
+    requests: forking from a request thread can copy a lock another thread
+    holds into the workers.
+    """
+
+    def __init__(self, context, processes,
+                 queue_size=DEFAULT_PASSWORD_QUEUE_SIZE,
+                 timeout=DEFAULT_PASSWORD_TIMEOUT):
+        self.context = context
+        self.processes = processes
+        self.max_pending = processes + queue_size
+        self.timeout = timeout
+        self.pending = 0
+        self.busy = 0
+        self.queue_wait = Timing()
+        self.hash_time = Timing()
+        self.logger = logging.getLogger('speak_friend.hashing')
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pid = None
+
+    def __getattr__(self, name):
+        return getattr(self.context, name)
+
+    def encrypt(self, *args, **kwargs):
+        return self.dispatch('encrypt', args, kwargs)
+
+    def verify(self, *args, **kwargs):
+        return self.dispatch('verify', args, kwargs)
+
+    def verify_and_update(self, *args, **kwargs):
+        return self.dispatch('verify_and_update', args, kwargs)
+
+    def start(self):
+        # A forked worker doesn't inherit a usable pool from its parent
+        if self._pool is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pool is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self.pending = 0
+                self._pool = multiprocessing.Pool(
+                    self.processes, _init_worker, (self.context,))
+                atexit.register(self.stop)
+
+    def pool(self):
+        if self._pool is None or self._pid != os.getpid():
+            self.logger.warning('Password hashing pool started late, from '
+                                'a request')
+            self.start()
+        return self._pool
+
+    def stop(self):
+        pool = self._pool
+        if pool is not None and self._pid == os.getpid():
+            self._pool = None
+            pool.terminate()
+
+    def dispatch(self, method, args, kwargs):
+        pool = self.pool()
+        with self._lock:
+            if self.pending >= self.max_pending:
+                self.busy += 1
+                self.logger.warning('Password hashing pool busy, refused %s',
+                                    method)
+                raise PasswordServiceBusy()
+            self.pending += 1
+        result = pool.apply_async(_run, (method, args, kwargs, time.time()),
+                                  callback=self.finished)
+        try:
+            waited, took, (ok, value) = result.get(self.timeout)
+        except multiprocessing.TimeoutError:
+            with self._lock:
+                self.busy += 1
+            self.logger.warning('Password hashing timed out after %ss',
+                                self.timeout)
+            raise PasswordServiceBusy()
+        self.logger.debug('%s waited %.3fs, took %.3fs', method, waited, took)
+        if not ok:
+            raise value
+        return value
+
+    def stats(self):
+        """Return the calls waiting or running, and the metrics above."""
+        with self._lock:
+            return {
+                'pending': self.pending,
+                'busy': self.busy,
+                'calls': self.hash_time.count,
+                'queue_wait_mean': self.queue_wait.mean,
+                'queue_wait_max': self.queue_wait.max,
+                'hash_time_mean': self.hash_time.mean,
+                'hash_time_max': self.hash_time.max,
+            }
+
+    def log_stats(self):
+        self.logger.info(
+            'Password hashing: %(calls)d calls, %(pending)d pending, '
+            '%(busy)d refused, waited %(queue_wait_mean).3fs mean '
+            '%(queue_wait_max).3fs max, hashed %(hash_time_mean).3fs mean '
+            '%(hash_time_max).3fs max', self.stats())
+
+    def finished(self, result):
+        """Called from the pool's result thread, even for calls the
+        requester stopped waiting for.
+        """
+        waited, took, outcome = result
+        with self._lock:
+            self.pending -= 1
+            self.queue_wait.add(waited)
+            self.hash_time.add(took)
+
+
+class RehashQueue(object):
+    """Upgrade password hashes that no longer match the CryptContext's
+    policy from a background thread, rather than in the login request.
+
+    Once the login's transaction commits, the verified password is queued
+    in memory only. At most ``rate`` hashes are computed per second, so a
+    policy change doesn't rehash every active user at once; entries older
+    than ``max_age`` seconds are discarded unused, as are new ones while
+    ``queue_size`` are waiting. A discarded upgrade is retried at the user's
+    next login.
+
+    The new hash is only written if the stored one is still the hash that
+    was verified, so a password changed in the meantime is never
+    overwritten.
+    """
+
+    def __init__(self, rate=DEFAULT_REHASH_RATE,
+                 queue_size=DEFAULT_REHASH_QUEUE_SIZE,
+                 max_age=DEFAULT_REHASH_MAX_AGE):
+        self.interval = 1.0 / rate
+        self.max_age = max_age
+        self.queue = Queue.Queue(queue_size)
+        self.context = None
+        self.engine = None
+        self.logger = logging.getLogger('speak_friend.hashing')
+        self.rehashed = 0
+        self.conflicts = 0
+        self.dropped = 0
+        self.expired = 0
+        self.failed = 0
+        self._queued = set()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    def submit(self, request, user, password):
+        """Queue an upgrade of ``user``'s hash, which ``password`` was
+        just verified against, once the transaction commits.
+        """
+        if self.engine is None:
+            self.engine = request.db_session.get_bind()
+            self.context = request.registry.password_context
+        after_commit(self.enqueue, user.username, user.password_hash,
+                     password)
+
+    def enqueue(self, username, old_hash, password):
+        self.start()
+        with self._lock:
+            if username in self._queued:
+                return
+            try:
+                self.queue.put_nowait((time.time(), username, old_hash,
+                                       password))
+            except Queue.Full:
+                self.dropped += 1
+                return
+            self._queued.add(username)
+
+    def start(self):
+        # A forked worker doesn't inherit the parent's thread
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self.run,
+                                            name='speak_friend.rehash')
+            self._thread.daemon = True
+            self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self, timeout=5):
+        """Stop the background thread, discarding whatever is queued."""
+        self._stopped.set()
+        thread = self._thread
+        if thread is not None and thread.is_alive():
+            thread.join(timeout)
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                item = self.queue.get(timeout=1)
+            except Queue.Empty:
+                continue
+            started = time.time()
+            self.rehash(*item)
+            self._stopped.wait(self.interval - (time.time() - started))
+
+    def rehash(self, queued_at, username, old_hash, password):
+        with self._lock:
+            self._queued.discard(username)
+        if time.time() - queued_at > self.max_age:
+            with self._lock:
+                self.expired += 1
+            return
+        table = UserProfile.__table__
+        try:
+            new_hash = self.context.encrypt(password)
+            stmt = table.update().where(and_(
+                table.c.username == username,
+                table.c.password_hash == old_hash,
+            )).values(password_hash=new_hash, password_salt=None)
+            with self.engine.begin() as connection:
+                updated = connection.execute(stmt).rowcount
+        except Exception:
+            with self._lock:
+                self.failed += 1
+            self.logger.exception('Unable to rehash the password of %s',
+                                  username)
+            return
+        with self._lock:
+            if updated:
+                self.rehashed += 1
+            else:
+                self.conflicts += 1
+        self.logger.debug('Rehashed the password of %s', username)
+
+
+def hash_status(session, context):
+    """Count the stored password hashes using each scheme, and those that
+    match ``context``'s current policy.
+
+    Returns a dict with the ``total`` and ``current`` numbers of hashes and
+    a count per scheme in ``schemes``. Hashes the context doesn't recognize
+    are counted as ``unknown``.
+    """
+    status = {'total': 0, 'current': 0, 'schemes': {}}
+    query = session.query(UserProfile.password_hash).yield_per(1000)
+    for (password_hash,) in query:
+        status['total'] += 1
+        scheme = context.identify(password_hash, required=False)
+        if scheme is None:
+            scheme = 'unknown'
+        elif not context.needs_update(password_hash):
+            status['current'] += 1
+        schemes = status['schemes']
+        schemes[scheme] = schemes.get(scheme, 0) + 1
+    return status
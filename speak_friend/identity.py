@@ -0,0 +1,111 @@
+"""Short lived in-process cache of the logged in user's profile.
+"""
+from sqlalchemy import inspect
+from sqlalchemy.orm import make_transient_to_detached
+
+from speak_friend.cache import LRUCache
+from speak_friend.models.profiles import UserProfile
+from speak_friend.utils import after_commit
+
+
+DEFAULT_IDENTITY_CACHE_TTL = 5  # seconds
+# Never served from the cache, these are loaded from the database
+# whenever they are accessed.
+UNCACHED_COLUMNS = frozenset([
+    'password_hash',
+    'password_salt',
+    'login_attempts',
+    'searchable_text',
+])
+
+
+def identity_values(user):
+    """Return the cacheable column values of ``user`` as a dictionary."""
+    mapper = inspect(UserProfile)
+    return dict((attr.key, getattr(user, attr.key))
+                for attr in mapper.column_attrs
+                if attr.key not in UNCACHED_COLUMNS)
+
+
+class IdentityCache(object):
+    """Keep recently used UserProfile column values, keyed by userid.
+
+    Answers the authentication policy's group lookup and ``request.user``
+    without a query for ``ttl`` seconds. Changes made in this process
+    invalidate the entry straight away; other processes see them once the
+    entry expires.
+    """
+
+    def __init__(self, maxsize, ttl=DEFAULT_IDENTITY_CACHE_TTL):
+        self.entries = LRUCache(maxsize, ttl=ttl)
+
+    def key(self, userid):
+        return userid.lower()
+
+    def get(self, session, userid):
+        """Return the cached column values for ``userid``.
+
+        Loads and caches them on a miss; returns None if there is no such
+        user.
+        """
+        key = self.key(userid)
+        values = self.entries.get(key)
+        if values is None:
+            user = session.query(UserProfile).get(userid)
+            if user is None:
+                return None
+            values = self.remember(user)
+        return values
+
+    def remember(self, user):
+        values = identity_values(user)
+        self.entries.set(self.key(user.username), values)
+        return values
+
+    def invalidate(self, userid):
+        self.entries.invalidate(self.key(userid))
+
+    def clear(self):
+        self.entries.clear()
+
+
+def load_user(request, userid):
+    """Return the UserProfile for ``userid`` attached to the request's
+    session, using the identity cache when one is configured.
+    """
+    session = request.db_session
+    cache = getattr(request.registry, 'identity_cache', None)
+    if cache is None:
+        return session.query(UserProfile).get(userid)
+    values = cache.get(session, userid)
+    if values is None:
+        return None
+    user = UserProfile.__mapper__.class_manager.new_instance()
+    for col, value in values.items():
+        setattr(user, col, value)
+    # Present the cached values as if they had just been loaded; the
+    # remaining columns are loaded on first access.
+    make_transient_to_detached(user)
+    return session.merge(user, load=False)
+
+
+def lookup_identity(request, userid):
+    """Return the cacheable column values of ``userid``'s profile, or None
+    if there is no such user.
+    """
+    cache = getattr(request.registry, 'identity_cache', None)
+    if cache is not None:
+        return cache.get(request.db_session, userid)
+    user = request.db_session.query(UserProfile).get(userid)
+    if user is not None:
+        return identity_values(user)
+
+
+def invalidate_identity(request, userid):
+    """Forget ``userid`` now, and again once the transaction commits so a
+    concurrent request can't cache the old values in between.
+    """
+    cache = getattr(request.registry, 'identity_cache', None)
+    if cache is not None:
+        cache.invalidate(userid)
+        after_commit(cache.invalidate, userid)
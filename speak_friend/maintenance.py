@@ -0,0 +1,168 @@
+"""Housekeeping that runs outside of requests.
+"""
+from datetime import datetime
+from datetime import timedelta
+import logging
+import threading
+import time
+
+from openid.store.nonce import SKEW as NONCE_SKEW
+
+from pyramid.scripting import prepare
+from pyramid.settings import asbool
+
+from pyramid_controlpanel.views import ControlPanel
+
+from sqlalchemy import and_
+from sqlalchemy import func
+from sqlalchemy import select
+from sqlalchemy import tuple_
+
+import transaction
+
+from zope.sqlalchemy import mark_changed
+
+from speak_friend.forms.controlpanel import TOKEN_DURATION
+from speak_friend.forms.controlpanel import authentication_schema
+from speak_friend.models.authorizations import OAuthAuthorization
+from speak_friend.models.authorizations import OAuthRevocation
+from speak_friend.models.authorizations import UNDEFINED_SECRET
+from speak_friend.models.open_id import Association
+from speak_friend.models.open_id import Nonce
+from speak_friend.models.open_id import SFOpenIDStore
+from speak_friend.models.profiles import ResetToken
+from speak_friend.oauth_provider import SFOauthProvider
+
+
+DEFAULT_NONCE_CLEANUP_INTERVAL = 600  # seconds
+DEFAULT_REAP_INTERVAL = 0  # seconds, disabled
+DEFAULT_REAP_BATCH_SIZE = 1000
+
+logger = logging.getLogger('speak_friend.maintenance')
+
+
+class PeriodicTask(object):
+    """Call ``func`` every ``interval`` seconds from a daemon thread.
+
+    Exceptions are logged, and don't stop later runs.
+    """
+
+    def __init__(self, name, interval, func, *args):
+        self.name = name
+        self.interval = interval
+        self.func = func
+        self.args = args
+        self.runs = 0
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name=self.name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.func(*self.args)
+            except Exception:
+                logger.exception('%s failed', self.name)
+            self.runs += 1
+
+
+def cleanup_nonces(db_session):
+    """Delete the nonces too old to pass useNonce."""
+    try:
+        with transaction.manager:
+            count = SFOpenIDStore(db_session).cleanupNonces()
+            mark_changed(db_session())
+    finally:
+        db_session.remove()
+    logger.info('Removed %d expired nonces', count)
+    return count
+
+
+def delete_in_batches(db_session, table, condition, batch_size):
+    """Delete the rows of ``table`` matching ``condition``, committing
+    every ``batch_size`` rows so locks are only held briefly. Returns the
+    number of rows deleted.
+    """
+    key = list(table.primary_key.columns)
+    doomed = select(key).where(condition).limit(batch_size)
+    stmt = table.delete().where(tuple_(*key).in_(doomed))
+    total = 0
+    while True:
+        with transaction.manager:
+            deleted = db_session.execute(stmt).rowcount
+            mark_changed(db_session())
+        total += deleted
+        if deleted < batch_size:
+            return total
+
+
+def reap(db_session, token_duration=TOKEN_DURATION,
+         batch_size=DEFAULT_REAP_BATCH_SIZE, access_tokens=False):
+    """Delete expired associations, nonces, password reset tokens, signed
+    token revocations and OAuth authorization codes that were never
+    exchanged for a token.
+
+    Expired OAuth access tokens are only deleted when ``access_tokens`` is
+    true, as ``/validate_user_token`` accepts them.
+
+    Returns the number of rows removed from each table.
+    """
+    now = int(time.time())
+    utcnow = datetime.utcnow()
+    token_cutoff = func.current_timestamp() - timedelta(minutes=token_duration)
+    # Every token a revocation could apply to has expired by then
+    revocation_cutoff = utcnow - timedelta(
+        days=SFOauthProvider.token_expires_in)
+    expired = [
+        ('associations', Association, Association.expires_at < now),
+        ('nonces', Nonce, Nonce.timestamp < now - NONCE_SKEW),
+        ('reset_tokens', ResetToken, ResetToken.generation_ts < token_cutoff),
+        ('revocations', OAuthRevocation,
+         OAuthRevocation.revoked_at < revocation_cutoff),
+        ('auth_codes', OAuthAuthorization,
+         and_(OAuthAuthorization.access_token == UNDEFINED_SECRET,
+              OAuthAuthorization.valid_until < utcnow)),
+    ]
+    if access_tokens:
+        expired.append(
+            ('access_tokens', OAuthAuthorization,
+             and_(OAuthAuthorization.access_token != UNDEFINED_SECRET,
+                  OAuthAuthorization.valid_until < utcnow)))
+    counts = {}
+    try:
+        for name, model, condition in expired:
+            counts[name] = delete_in_batches(db_session, model.__table__,
+                                             condition, batch_size)
+    finally:
+        db_session.remove()
+    logger.info('Reaped %s', ', '.join('%d %s' % (counts[name], name)
+                                       for name, model, condition in expired))
+    return counts
+
+
+def reap_expired(registry):
+    """Run :func:`reap` with the application's settings."""
+    env = prepare(registry=registry)
+    try:
+        request = env['request']
+        cp = ControlPanel(request)
+        token_duration = cp.get_value(authentication_schema.name,
+                                      'token_duration', TOKEN_DURATION)
+        settings = registry.settings
+        batch_size = int(settings.get('speak_friend.reap_batch_size',
+                                      DEFAULT_REAP_BATCH_SIZE))
+        access_tokens = asbool(settings.get(
+            'speak_friend.reap_access_tokens', False))
+        return reap(request.db_session, token_duration, batch_size,
+                    access_tokens)
+    finally:
+        env['closer']()
@@ -1,22 +1,118 @@
+from datetime import datetime
+
+from sqlalchemy import Boolean
 from sqlalchemy import Column
+from sqlalchemy import Index
+from sqlalchemy import Integer
 from sqlalchemy import TIMESTAMP
 from sqlalchemy import UnicodeText
+from sqlalchemy import false
+from sqlalchemy import func
+from sqlalchemy import text
 
 from sixfeetup.bowab.db import Base
 
+from speak_friend.models.profiles import DomainProfile
+
+
+# Stored in place of a token or code that hasn't been issued, or has been
+# used up
+UNDEFINED_SECRET = 'TBD'
+
 
 class OAuthAuthorization(Base):
+    """An application's authorization to act for a user.
+
+    ``access_token`` and ``auth_code`` hold SHA-256 digests, the plain
+    values are only ever given to the user or application.
+    ``token_signed`` records whether the access token is a signed one,
+    which has to be revoked when it is replaced.
+    """
     __tablename__ = 'oauth_authorizations'
+    __table_args__ = (
+        Index('ix_oauth_authorizations_access_token', 'access_token',
+              unique=True,
+              postgresql_where=text("access_token <> '%s'" % UNDEFINED_SECRET)),
+        Index('ix_oauth_authorizations_auth_code', 'auth_code',
+              unique=True,
+              postgresql_where=text("auth_code <> '%s'" % UNDEFINED_SECRET)),
+        # For reap_expired, which deletes unused codes and expired tokens
+        Index('ix_oauth_authorizations_code_valid_until', 'valid_until',
+              postgresql_where=text("access_token = '%s'" % UNDEFINED_SECRET)),
+        Index('ix_oauth_authorizations_token_valid_until', 'valid_until',
+              postgresql_where=text("access_token <> '%s'" %
+                                    UNDEFINED_SECRET)),
+    )
     username = Column(UnicodeText, primary_key=True, nullable=False)
     client_id = Column(UnicodeText, primary_key=True, nullable=False)
     access_token = Column(UnicodeText, nullable=False)
     auth_code = Column(UnicodeText, nullable=True)
     valid_until = Column(TIMESTAMP, nullable=False)
+    token_signed = Column(Boolean, nullable=False, default=False,
+                          server_default=false())
 
     def __init__(self, username, client_id,
-                 access_token, auth_code, valid_until):
+                 access_token, auth_code, valid_until, token_signed=False):
         self.username = username
         self.client_id = client_id
         self.access_token = access_token
         self.auth_code = auth_code
         self.valid_until = valid_until
+        self.token_signed = token_signed
+
+    @classmethod
+    def issued_to(cls, session, username, offset=0, limit=None):
+        """Return a slice of the access tokens issued for ``username``,
+        ordered by application name, along with how many there are.
+
+        The application name is the domain's display name, falling back to
+        the client_id. Runs a single query, whatever the number of rows,
+        unless ``offset`` is past the last of them.
+        """
+        issued = (
+            cls.username == username,
+            cls.access_token != UNDEFINED_SECRET,
+        )
+        name = func.coalesce(DomainProfile.display_name, cls.client_id)
+        query = session.query(
+            cls.client_id,
+            cls.access_token,
+            cls.valid_until,
+            name.label('name'),
+            func.count().over().label('total'),
+        ).outerjoin(
+            DomainProfile,
+            DomainProfile.name == cls.client_id,
+        ).filter(
+            *issued
+        ).order_by(name, cls.client_id).offset(offset).limit(limit)
+        rows = query.all()
+        if rows:
+            total = rows[0].total
+        elif offset:
+            # The window count is only returned with a row
+            total = session.query(func.count()).filter(*issued).scalar()
+        else:
+            total = 0
+        return rows, total
+
+
+class OAuthRevocation(Base):
+    """A revoked signed access token.
+
+    ``kind`` is ``token`` for a single token, whose digest is ``value``,
+    or ``client`` or ``user`` for every token issued to that client_id or
+    username until ``revoked_at`` (UTC).
+    """
+    __tablename__ = 'oauth_revocations'
+    revocation_id = Column(Integer, primary_key=True)
+    kind = Column(UnicodeText, nullable=False)
+    value = Column(UnicodeText, nullable=False)
+    revoked_at = Column(TIMESTAMP, nullable=False, index=True)
+
+    def __init__(self, kind, value, revoked_at=None):
+        self.kind = kind
+        self.value = value
+        if revoked_at is None:
+            revoked_at = datetime.utcnow()
+        self.revoked_at = revoked_at
@@ -1,19 +1,30 @@
+from collections import deque
 import datetime
 import logging
+import threading
 import time
 
 from sixfeetup.bowab.db import Base
 
 from sqlalchemy import Column, Integer, UnicodeText
-from sqlalchemy import func
 from sqlalchemy.dialects.postgresql import BYTEA
+from sqlalchemy.dialects.postgresql import insert
 
 from openid.association import Association as OpenIDAssociation
 from openid.store.nonce import SKEW as NONCE_SKEW
 
 from zope.interface import implements
 
+from zope.sqlalchemy import mark_changed
+
+from speak_friend.cache import LRUCache
 from speak_friend.interfaces import IOpenIDStore
+from speak_friend.utils import after_commit
+
+
+def association_expires_at(context):
+    params = context.current_parameters
+    return params['issued'] + params['lifetime']
 
 
 class Association(Base):
@@ -25,6 +36,8 @@ class Association(Base):
     issued = Column(Integer)
     lifetime = Column(Integer)
     assoc_type = Column(UnicodeText)
+    # issued + lifetime, stored so it can be indexed
+    expires_at = Column(Integer, index=True, default=association_expires_at)
 
     @property
     def expires(self):
@@ -56,7 +69,7 @@ class Nonce(Base):
     __table_args__ = {'schema': 'openid'}
     schema = 'openid'
     server_url = Column(UnicodeText, primary_key=True)
-    timestamp = Column(Integer, primary_key=True)
+    timestamp = Column(Integer, primary_key=True, index=True)
     salt = Column(UnicodeText, primary_key=True)
 
     def __init__(self, server_url, timestamp, salt):
@@ -68,11 +81,54 @@ class Nonce(Base):
         return u"<Nonce(%s)>" % self.server_url
 
 
+def to_openid_association(association):
+    return OpenIDAssociation(
+        association.handle,
+        association.secret,
+        association.issued,
+        association.lifetime,
+        association.assoc_type,
+    )
+
+
+class AssociationCache(object):
+    """Process wide cache of OpenID associations, keyed by
+    ``(server_url, handle)``.
+
+    Entries expire along with the association they hold.
+    """
+
+    def __init__(self, maxsize):
+        self.entries = LRUCache(maxsize)
+
+    def get(self, server_url, handle):
+        return self.entries.get((server_url, handle))
+
+    def add(self, server_url, association):
+        expires_in = association.expiresIn
+        if expires_in > 0:
+            self.entries.set((server_url, association.handle), association,
+                             ttl=expires_in)
+
+    def remove(self, server_url, handle):
+        self.entries.invalidate((server_url, handle))
+
+    def clear(self):
+        self.entries.clear()
+
+
 class SFOpenIDStore(object):
+    """Stores associations and nonces in the ``openid`` schema.
+
+    Given an :class:`AssociationCache`, associations are written through
+    it once the transaction commits, and looked up by handle without a
+    query.
+    """
     implements(IOpenIDStore)
 
-    def __init__(self, session):
+    def __init__(self, session, cache=None):
         self.session = session
+        self.cache = cache
         self.logger = logging.getLogger('speak_friend.openid_store')
 
     def storeAssociation(self, server_url, raw_association):
@@ -86,15 +142,20 @@ class SFOpenIDStore(object):
         )
         self.logger.debug('Storing association: %s', association)
         self.session.add(association)
+        if self.cache is not None:
+            after_commit(self.cache.add, server_url, raw_association)
         return association
 
     def getAssociation(self, server_url, handle=None):
+        if self.cache is not None and handle is not None:
+            openid_association = self.cache.get(server_url, handle)
+            if openid_association is not None:
+                return openid_association
         query_args = {'server_url': server_url}
         if handle is not None:
             query_args['handle'] = handle
         query = self.session.query(Association)
-        expires = func.to_timestamp(Association.issued + Association.lifetime)
-        query = query.filter(func.current_timestamp() < expires)
+        query = query.filter(Association.expires_at > int(time.time()))
         query = query.filter_by(**query_args)
         query = query.order_by(Association.issued.desc())
 
@@ -103,38 +164,141 @@ class SFOpenIDStore(object):
             self.logger.debug('Association not found: %s', query_args)
             return association
 
-        openid_association = OpenIDAssociation(
-            association.handle,
-            association.secret,
-            association.issued,
-            association.lifetime,
-            association.assoc_type,
-        )
+        openid_association = to_openid_association(association)
         self.logger.debug('Returning association: %s', openid_association)
+        if self.cache is not None:
+            self.cache.add(server_url, openid_association)
         return openid_association
 
     def cleanupAssociations(self):
-        now = datetime.datetime.now()
-        now_stamp = int(time.mktime(now.timetuple()))
-
         query = self.session.query(Association)
-        query = query.filter(Association.issued + Association.lifetime \
-                             < now_stamp)
-        query.delete()
+        query = query.filter(Association.expires_at < int(time.time()))
+        return query.delete()
 
     def removeAssociation(self, server_url, handle):
         kwargs = {'server_url': server_url, 'handle': handle}
         query = self.session.query(Association)
         num_deleted = query.filter_by(**kwargs).delete()
         self.logger.debug('Removing association: %s', kwargs)
+        if self.cache is not None:
+            self.cache.remove(server_url, handle)
+            after_commit(self.cache.remove, server_url, handle)
         return num_deleted > 0
 
     def useNonce(self, server_url, timestamp, salt):
-        past = timestamp - NONCE_SKEW
-        future = timestamp + NONCE_SKEW
-        query_args = {'server_url': server_url, 'salt': salt}
-        query = self.session.query(Nonce).filter_by(**query_args)
-        query = query.filter(Nonce.timestamp > past, Nonce.timestamp < future)
-        nonces = query.all()
-
-        return not len(nonces) > 0
+        """Record the nonce, returning False if it was already used or
+        its timestamp is too far from now to be checked.
+        """
+        if abs(timestamp - time.time()) > NONCE_SKEW:
+            return False
+        stmt = insert(Nonce.__table__).values(server_url=server_url,
+                                              timestamp=timestamp,
+                                              salt=salt)
+        result = self.session.execute(stmt.on_conflict_do_nothing())
+        mark_changed(self.session())
+        return result.rowcount == 1
+
+    def cleanupNonces(self):
+        cutoff = int(time.time()) - NONCE_SKEW
+        query = self.session.query(Nonce)
+        return query.filter(Nonce.timestamp < cutoff).delete()
+
+    def cleanup(self):
+        return self.cleanupNonces(), self.cleanupAssociations()
+
+
+DEFAULT_NONCE_CAPACITY = 100000
+
+
+class MemoryOpenIDStore(object):
+    """Keeps associations and nonces in memory.
+
+    Only suitable for a single process: nothing is shared with other
+    processes or survives a restart. Nonces are kept in a ring buffer of
+    ``nonce_capacity`` entries; once a nonce is pushed out, nonces as old
+    as it are refused, since they can no longer be checked.
+    """
+    implements(IOpenIDStore)
+
+    def __init__(self, nonce_capacity=DEFAULT_NONCE_CAPACITY):
+        self.associations = {}
+        self.nonces = set()
+        self.nonce_ring = deque()
+        self.nonce_capacity = nonce_capacity
+        self.nonce_horizon = 0
+        self._lock = threading.Lock()
+        self.logger = logging.getLogger('speak_friend.openid_store')
+
+    def storeAssociation(self, server_url, association):
+        with self._lock:
+            server_assocs = self.associations.setdefault(server_url, {})
+            server_assocs[association.handle] = association
+
+    def getAssociation(self, server_url, handle=None):
+        with self._lock:
+            server_assocs = self.associations.get(server_url, {})
+            if handle is not None:
+                candidates = [server_assocs.get(handle)]
+            else:
+                candidates = server_assocs.values()
+        candidates = [assoc for assoc in candidates
+                      if assoc is not None and assoc.expiresIn > 0]
+        if not candidates:
+            return None
+        return max(candidates, key=lambda assoc: assoc.issued)
+
+    def removeAssociation(self, server_url, handle):
+        with self._lock:
+            server_assocs = self.associations.get(server_url, {})
+            return server_assocs.pop(handle, None) is not None
+
+    def cleanupAssociations(self):
+        removed = 0
+        with self._lock:
+            for server_assocs in self.associations.values():
+                for handle, assoc in server_assocs.items():
+                    if assoc.expiresIn <= 0:
+                        del server_assocs[handle]
+                        removed += 1
+        return removed
+
+    def useNonce(self, server_url, timestamp, salt):
+        if abs(timestamp - time.time()) > NONCE_SKEW:
+            return False
+        key = (server_url, timestamp, salt)
+        with self._lock:
+            if timestamp <= self.nonce_horizon or key in self.nonces:
+                return False
+            if len(self.nonce_ring) >= self.nonce_capacity:
+                evicted = self.nonce_ring.popleft()
+                self.nonces.discard(evicted)
+                self.nonce_horizon = max(self.nonce_horizon, evicted[1])
+            self.nonce_ring.append(key)
+            self.nonces.add(key)
+        return True
+
+    def cleanupNonces(self):
+        cutoff = time.time() - NONCE_SKEW
+        expired = 0
+        with self._lock:
+            # Nonces are mostly used in timestamp order
+            while self.nonce_ring and self.nonce_ring[0][1] < cutoff:
+                self.nonces.discard(self.nonce_ring.popleft())
+                expired += 1
+        return expired
+
+    def cleanup(self):
+        return self.cleanupNonces(), self.cleanupAssociations()
+
+
+def sql_store_factory(request):
+    cache = getattr(request.registry, 'association_cache', None)
+    return SFOpenIDStore(request.db_session, cache=cache)
+
+
+def get_openid_store(request):
+    """Return the OpenID store configured by ``set_openid_store``."""
+    factory = getattr(request.registry, 'openid_store_factory', None)
+    if factory is None:
+        factory = sql_store_factory
+    return factory(request)
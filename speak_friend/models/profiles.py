@@ -11,13 +11,17 @@ from sqlalchemy import FetchedValue
 from sqlalchemy import ForeignKey
 from sqlalchemy import Integer
 from sqlalchemy import UnicodeText
-from sqlalchemy import desc
 from sqlalchemy import event
 from sqlalchemy import func
+from sqlalchemy import or_
 from sqlalchemy.orm import relationship
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.sql.expression import literal
 
+from zope.sqlalchemy import mark_changed
+
+from speak_friend.models.reports import LatestUserActivity
 from speak_friend.models.reports import UserActivity
 from speak_friend.forms.controlpanel import MAX_PASSWORD_VALID
 from speak_friend.forms.controlpanel import domain_defaults_schema
@@ -137,25 +141,74 @@ class UserProfile(Base):
         return query.filter_by(**kwargs)
 
     def last_activity(self, session, activity=None):
-        query = self.activity_query(session, activity)
-        return query.order_by(desc(UserActivity.activity_ts)).first()
+        if activity:
+            return LatestUserActivity.latest(session, self.username, activity)
+        return LatestUserActivity.latest(session, self.username)
 
     def activity_count(self, session, activity=None):
         query = self.activity_query(session, activity)
         return query.count()
 
     def last_login(self, session):
-        """Query UserActivity for last login."""
+        """Look up the most recent login."""
         return self.last_activity(session, u'login')
 
     def created(self, session):
-        """Query UserActivity for created."""
+        """Look up when the account was created."""
         return self.last_activity(session, u'create_account')
 
     def login_count(self, session):
         return self.activity_count(session, u'login')
 
 
+class LoginAttempts(object):
+    """Account for a user's failed logins with one statement each, rather
+    than through the ORM.
+
+    Both methods update the loaded ``user`` to match the row without
+    marking it as modified, so no refresh or second write follows.
+    """
+
+    @staticmethod
+    def failed(session, user, max_attempts):
+        """Count a failed login, locking the account once it has failed
+        ``max_attempts`` times, in a single UPDATE ... RETURNING. Returns
+        whether this failure locked the account.
+        """
+        table = UserProfile.__table__
+        attempts = func.coalesce(table.c.login_attempts, 0) + 1
+        stmt = table.update().where(
+            table.c.username == user.username
+        ).values(
+            login_attempts=attempts,
+            locked=or_(table.c.locked.is_(True), attempts >= max_attempts),
+        ).returning(table.c.login_attempts, table.c.locked)
+        row = session.execute(stmt).first()
+        mark_changed(session())
+        if row is None:
+            return False
+        was_locked = user.locked
+        set_committed_value(user, 'login_attempts', row.login_attempts)
+        set_committed_value(user, 'locked', row.locked)
+        return row.locked and not was_locked
+
+    @staticmethod
+    def reset(session, user):
+        """Clear the failed logins and unlock the account, if there were
+        any. Returns whether there were.
+        """
+        if not user.login_attempts:
+            return False
+        table = UserProfile.__table__
+        session.execute(table.update().where(
+            table.c.username == user.username
+        ).values(login_attempts=0, locked=False))
+        mark_changed(session())
+        set_committed_value(user, 'login_attempts', 0)
+        set_committed_value(user, 'locked', False)
+        return True
+
+
 FT_TRIGGER_FUNCTION = """
 CREATE OR REPLACE FUNCTION user_searchable_text_trigger()
 RETURNS trigger AS $$
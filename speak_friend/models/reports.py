@@ -1,3 +1,7 @@
+from datetime import date
+from datetime import datetime
+import re
+
 from sixfeetup.bowab.db import Base
 from sixfeetup.bowab.db import CIText
 from sixfeetup.bowab.db import JSON
@@ -9,6 +13,7 @@ from sqlalchemy import Integer
 from sqlalchemy import UnicodeText
 from sqlalchemy import event
 from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.orm import relationship
 
 from speak_friend.events import ACTIVITIES
@@ -40,11 +45,15 @@ event.listen(Activity.__table__, "after_create", after_activity_create)
 class UserActivity(Base):
     __tablename__ = 'user_activity'
     __table_args__ = (
-        {'schema': 'reports'}
+        {
+            'schema': 'reports',
+            'postgresql_partition_by': 'RANGE (activity_ts)',
+        }
     )
     user_activity_id = Column(
         Integer,
-        primary_key=True
+        primary_key=True,
+        autoincrement=True,
     )
     username = Column(
         CIText,
@@ -63,8 +72,10 @@ class UserActivity(Base):
         nullable=False,
         index=True
     )
+    # Part of the primary key, as the table is partitioned by it
     activity_ts = Column(
         DateTime(timezone=True),
+        primary_key=True,
         nullable=False,
         server_default=func.current_timestamp(),
         index=True,
@@ -123,5 +134,290 @@ class UserActivity(Base):
 
     @classmethod
     def last_checkid(cls, session, user):
-        return cls.last_user_activity(session, user,
-                                      u'authorize_checkid', u'login')
+        return LatestUserActivity.latest(session, user.username,
+                                         u'authorize_checkid', u'login')
+
+
+class LatestUserActivity(Base):
+    """The most recent UserActivity row for each user and activity.
+
+    Maintained by a trigger on reports.user_activity, so looking up the
+    last login (or any other activity) is a primary key probe instead of
+    a sort over the user's whole history.
+    """
+    __tablename__ = 'latest_user_activity'
+    __table_args__ = (
+        {'schema': 'reports'}
+    )
+    username = Column(
+        CIText,
+        ForeignKey("profiles.user_profiles.username"),
+        primary_key=True,
+    )
+    activity = Column(
+        UnicodeText,
+        ForeignKey("reports.activities.activity"),
+        primary_key=True,
+    )
+    user_activity_id = Column(
+        Integer,
+        nullable=False,
+    )
+    activity_ts = Column(
+        DateTime(timezone=True),
+        nullable=False,
+    )
+    came_from = Column(
+        UnicodeText,
+    )
+    came_from_fqdn = Column(
+        UnicodeText,
+    )
+
+    def __repr__(self):
+        return u"<LatestUserActivity(%s, %s, %s)>" % (self.username,
+                                                      self.activity,
+                                                      self.activity_ts)
+
+    @classmethod
+    def latest(cls, session, username, *activities):
+        """Return the most recent of ``activities`` for ``username``, or of
+        any activity if none are given.
+        """
+        if len(activities) == 1:
+            return session.query(cls).get((username, activities[0]))
+        qry = session.query(cls).filter(cls.username == username)
+        if activities:
+            qry = qry.filter(cls.activity.in_(activities))
+        qry = qry.order_by(cls.activity_ts.desc())
+        return qry.first()
+
+
+LATEST_ACTIVITY_TRIGGER_FUNCTION = """
+CREATE OR REPLACE FUNCTION latest_user_activity_trigger()
+RETURNS trigger AS $$
+begin
+  INSERT INTO reports.latest_user_activity
+      (username, activity, user_activity_id, activity_ts,
+       came_from, came_from_fqdn)
+  VALUES (new.username, new.activity, new.user_activity_id, new.activity_ts,
+          new.came_from, new.came_from_fqdn)
+  ON CONFLICT (username, activity) DO UPDATE SET
+      user_activity_id = excluded.user_activity_id,
+      activity_ts = excluded.activity_ts,
+      came_from = excluded.came_from,
+      came_from_fqdn = excluded.came_from_fqdn
+  WHERE reports.latest_user_activity.activity_ts <= excluded.activity_ts;
+  return null;
+end
+$$ LANGUAGE plpgsql;
+"""
+LATEST_ACTIVITY_TRIGGER = """
+CREATE TRIGGER latest_user_activity_update AFTER INSERT
+    ON %s.%s FOR EACH ROW EXECUTE PROCEDURE latest_user_activity_trigger();
+"""
+LATEST_ACTIVITY_BACKFILL = """
+INSERT INTO reports.latest_user_activity
+    (username, activity, user_activity_id, activity_ts,
+     came_from, came_from_fqdn)
+SELECT DISTINCT ON (username, activity)
+       username, activity, user_activity_id, activity_ts,
+       came_from, came_from_fqdn
+  FROM reports.user_activity
+ ORDER BY username, activity, activity_ts DESC, user_activity_id DESC
+ON CONFLICT (username, activity) DO UPDATE SET
+    user_activity_id = excluded.user_activity_id,
+    activity_ts = excluded.activity_ts,
+    came_from = excluded.came_from,
+    came_from_fqdn = excluded.came_from_fqdn
+WHERE reports.latest_user_activity.activity_ts <= excluded.activity_ts
+"""
+
+
+class DomainLogin(Base):
+    """Records that a user has logged in from a given domain at least once.
+
+    Lets initial_login_tween answer with an existence probe on the primary
+    key instead of counting the user's logins.
+    """
+    __tablename__ = 'domain_logins'
+    __table_args__ = (
+        {'schema': 'reports'}
+    )
+    username = Column(
+        CIText,
+        ForeignKey("profiles.user_profiles.username"),
+        primary_key=True,
+    )
+    came_from_fqdn = Column(
+        UnicodeText,
+        primary_key=True,
+    )
+    first_login_ts = Column(
+        DateTime(timezone=True),
+        nullable=False,
+        server_default=func.current_timestamp(),
+    )
+
+    def __repr__(self):
+        return u"<DomainLogin(%s, %s)>" % (self.username, self.came_from_fqdn)
+
+    @staticmethod
+    def cache_key(username, came_from_fqdn):
+        return (username.lower(), came_from_fqdn)
+
+    @classmethod
+    def exists(cls, session, username, came_from_fqdn):
+        qry = session.query(cls.username)
+        qry = qry.filter(cls.username == username,
+                         cls.came_from_fqdn == came_from_fqdn)
+        return qry.first() is not None
+
+    @classmethod
+    def record(cls, session, username, came_from_fqdn):
+        """Insert the login, doing nothing if it is already known."""
+        stmt = insert(cls.__table__).values(username=username,
+                                            came_from_fqdn=came_from_fqdn)
+        session.execute(stmt.on_conflict_do_nothing())
+
+
+DOMAIN_LOGIN_BACKFILL = """
+INSERT INTO reports.domain_logins (username, came_from_fqdn, first_login_ts)
+SELECT username, came_from_fqdn, min(activity_ts)
+  FROM reports.user_activity
+ WHERE activity = 'login'
+   AND came_from_fqdn IS NOT NULL
+   AND came_from_fqdn <> ''
+ GROUP BY username, came_from_fqdn
+ON CONFLICT DO NOTHING
+"""
+
+
+# reports.user_activity is partitioned by month, rows outside every
+# monthly partition land in the default one.
+PARTITION_MONTHS_AHEAD = 3
+PARTITION_NAME = re.compile(r'^user_activity_(\d{4})_(\d{2})$')
+
+CREATE_ACTIVITY_PARTITION = """
+CREATE TABLE IF NOT EXISTS %(schema)s.%(name)s
+PARTITION OF %(schema)s.user_activity
+FOR VALUES FROM ('%(start)s+00') TO ('%(end)s+00')
+"""
+
+CREATE_DEFAULT_ACTIVITY_PARTITION = """
+CREATE TABLE IF NOT EXISTS %(schema)s.user_activity_default
+PARTITION OF %(schema)s.user_activity DEFAULT
+"""
+
+HAS_DEFAULT_ACTIVITY_PARTITION = """
+SELECT to_regclass('%(schema)s.user_activity_default') IS NOT NULL
+"""
+
+DEFAULT_ACTIVITY_RANGE = """
+  FROM %(schema)s.user_activity_default
+ WHERE activity_ts >= '%(start)s+00' AND activity_ts < '%(end)s+00'
+"""
+
+DEFAULT_ACTIVITY_EXISTS = (
+    "SELECT EXISTS (SELECT 1" + DEFAULT_ACTIVITY_RANGE + ")")
+
+# PostgreSQL won't create a partition for rows already in the default
+# partition, so they are moved while the default partition is detached.
+MOVE_DEFAULT_ACTIVITY = [
+    """
+ALTER TABLE %(schema)s.user_activity
+DETACH PARTITION %(schema)s.user_activity_default
+""",
+    CREATE_ACTIVITY_PARTITION,
+    "INSERT INTO %(schema)s.%(name)s SELECT *" + DEFAULT_ACTIVITY_RANGE,
+    "DELETE" + DEFAULT_ACTIVITY_RANGE,
+    """
+ALTER TABLE %(schema)s.user_activity
+ATTACH PARTITION %(schema)s.user_activity_default DEFAULT
+""",
+]
+
+LIST_ACTIVITY_PARTITIONS = """
+SELECT child.relname
+  FROM pg_inherits
+  JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+  JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+  JOIN pg_namespace ns ON ns.oid = parent.relnamespace
+ WHERE parent.relname = 'user_activity'
+   AND ns.nspname = %(schema)s
+"""
+
+
+def month_start(value):
+    return date(value.year, value.month, 1)
+
+
+def add_months(month, months):
+    months = month.year * 12 + month.month - 1 + months
+    return date(months // 12, months % 12 + 1, 1)
+
+
+def activity_partition_name(month):
+    return 'user_activity_%04d_%02d' % (month.year, month.month)
+
+
+def create_activity_partitions(connection, first, last, schema='reports'):
+    """Create any missing monthly partitions from ``first`` to ``last``,
+    inclusive, moving in the rows the default partition holds for them.
+    Returns the names of the partitions covering that range.
+    """
+    existing = set(name for month, name
+                   in activity_partitions(connection, schema=schema))
+    has_default = connection.execute(
+        HAS_DEFAULT_ACTIVITY_PARTITION % {'schema': schema}).scalar()
+    month = month_start(first)
+    names = []
+    while month <= month_start(last):
+        name = activity_partition_name(month)
+        if name not in existing:
+            params = {
+                'schema': schema,
+                'name': name,
+                'start': month.isoformat(),
+                'end': add_months(month, 1).isoformat(),
+            }
+            statements = [CREATE_ACTIVITY_PARTITION]
+            if has_default and connection.execute(
+                    DEFAULT_ACTIVITY_EXISTS % params).scalar():
+                statements = MOVE_DEFAULT_ACTIVITY
+            for statement in statements:
+                connection.execute(statement % params)
+        names.append(name)
+        month = add_months(month, 1)
+    return names
+
+
+def activity_partitions(connection, schema='reports'):
+    """Return ``(month, name)`` for each attached monthly partition,
+    oldest first.
+    """
+    partitions = []
+    result = connection.execute(LIST_ACTIVITY_PARTITIONS, schema=schema)
+    for (name,) in result:
+        match = PARTITION_NAME.match(name)
+        if match:
+            year, month = [int(part) for part in match.groups()]
+            partitions.append((date(year, month, 1), name))
+    return sorted(partitions)
+
+
+def after_user_activity_create(target, connection, **kw):
+    # The function body is only resolved when the trigger fires, so it
+    # doesn't matter which of the two tables is created first.
+    connection.execute(LATEST_ACTIVITY_TRIGGER_FUNCTION)
+    connection.execute(LATEST_ACTIVITY_TRIGGER % (target.schema, target.name))
+    connection.execute(CREATE_DEFAULT_ACTIVITY_PARTITION %
+                       {'schema': target.schema})
+    this_month = month_start(datetime.utcnow())
+    create_activity_partitions(connection, this_month,
+                               add_months(this_month, PARTITION_MONTHS_AHEAD),
+                               schema=target.schema)
+
+
+event.listen(UserActivity.__table__, "after_create",
+             after_user_activity_create)
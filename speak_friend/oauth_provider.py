@@ -1,14 +1,122 @@
 # largely based on https://github.com/NateFerrero/oauth2lib
+from collections import namedtuple
 import datetime
+import hmac
+from speak_friend.cache import LRUCache
+from speak_friend.domains import find_domain
 from speak_friend.models.authorizations import OAuthAuthorization
+from speak_friend.models.authorizations import UNDEFINED_SECRET
 from speak_friend.models.profiles import DomainProfile
 from speak_friend.models.profiles import UserProfile
+from speak_friend.utils import after_commit
 from speak_friend.utils import get_domain
 from speak_friend.utils import hash_string
 from speak_friend.utils import random_ascii_string
 
+DEFAULT_TOKEN_CACHE_TTL = 60  # seconds
+_missing = object()
 
-UNDEFINED_SECRET = 'TBD'
+# What /oauth2/get_user_details returns about a token's user, and until
+# when; the profile columns are None if the user no longer exists.
+UserDetails = namedtuple('UserDetails',
+                         'username email first_name last_name valid_until')
+
+
+class TokenValidationCache(object):
+    """Remember recent access token checks, keyed by the token's digest.
+
+    Both valid and invalid outcomes are kept, for at most ``ttl`` seconds
+    and never past the authorization's ``valid_until``. Each entry also
+    records the username it concerns, so all of a user's entries can be
+    dropped when their account is disabled or locked.
+    """
+
+    def __init__(self, maxsize, ttl=DEFAULT_TOKEN_CACHE_TTL):
+        self.ttl = ttl
+        self.entries = LRUCache(maxsize)
+
+    def get(self, digest, principal, default=None):
+        entry = self.entries.get((digest, principal), _missing)
+        if entry is _missing:
+            return default
+        return entry[1]
+
+    def set(self, digest, principal, username, result, valid_until=None):
+        ttl = self.ttl
+        if valid_until is not None:
+            remaining = valid_until - datetime.datetime.utcnow()
+            ttl = min(ttl, remaining.total_seconds())
+            if ttl <= 0:
+                return
+        if username is not None:
+            username = username.lower()
+        self.entries.set((digest, principal), (username, result), ttl=ttl)
+
+    def invalidate_token(self, digest):
+        self.entries.invalidate_where(lambda key: key[0] == digest)
+
+    def invalidate_user(self, username):
+        username = username.lower()
+        self.entries.invalidate_values(lambda entry: entry[0] == username)
+
+    def clear(self):
+        self.entries.clear()
+
+
+def _invalidate(request, method, *args):
+    cache = getattr(request.registry, 'token_cache', None)
+    if cache is not None:
+        getattr(cache, method)(*args)
+        after_commit(getattr(cache, method), *args)
+
+
+def _revoke(request, kind, value):
+    revocations = getattr(request.registry, 'token_revocations', None)
+    if revocations is not None:
+        revocations.revoke(request.db_session, kind, value)
+
+
+def invalidate_token(request, digest, signed):
+    """Forget the cached checks of the token with ``digest``, and revoke
+    it if it is ``signed``.
+    """
+    _invalidate(request, 'invalidate_token', digest)
+    if signed:
+        _revoke(request, 'token', digest)
+
+
+def invalidate_user_tokens(request, username):
+    """Forget the cached checks of every token for ``username``, after
+    their account is disabled, locked or enabled again.
+
+    Signed tokens aren't revoked, as their checks look up whether the
+    account is usable.
+    """
+    _invalidate(request, 'invalidate_user', username)
+
+
+def invalidate_client_tokens(request, client_id):
+    """Forget every cached check, and revoke the signed tokens issued so
+    far to ``client_id``.
+    """
+    _invalidate(request, 'clear')
+    _revoke(request, 'client', client_id)
+
+
+def get_oauth_provider(request, tokens_expire=True):
+    """Return a provider for ``request``, using the registry's token
+    validation cache and signer when there are any.
+    """
+    registry = request.registry
+    return SFOauthProvider(
+        request.db_session,
+        tokens_expire=tokens_expire,
+        token_cache=getattr(registry, 'token_cache', None),
+        signer=getattr(registry, 'token_signer', None),
+        revocations=getattr(registry, 'token_revocations', None),
+        credentials=getattr(registry, 'client_credentials', None),
+        identities=getattr(registry, 'identity_cache', None),
+    )
 
 
 class SFOauthProvider(object):
@@ -16,9 +124,62 @@ class SFOauthProvider(object):
     token_expires_in = 10  # days
     auth_code_expires_in = 3  # minutes
 
-    def __init__(self, db_session=None, tokens_expire=True):
+    def __init__(self, db_session=None, tokens_expire=True, token_cache=None,
+                 signer=None, revocations=None, credentials=None,
+                 identities=None):
         self.db_session = db_session
         self.tokens_expire = tokens_expire
+        self.token_cache = token_cache
+        self.signer = signer
+        self.revocations = revocations
+        self.credentials = credentials
+        self.identities = identities
+
+    def forget_token(self, authz):
+        """Drop the cached checks of ``authz``'s token, which is being
+        replaced, and revoke it if it is signed.
+        """
+        digest = authz.access_token
+        if digest == UNDEFINED_SECRET:
+            return
+        if self.token_cache is not None:
+            self.token_cache.invalidate_token(digest)
+            after_commit(self.token_cache.invalidate_token, digest)
+        if self.revocations is not None and authz.token_signed:
+            self.revocations.revoke(self.db_session, 'token', digest)
+
+    def is_signed(self, token):
+        return self.signer is not None and self.signer.is_signed(token)
+
+    def signed_claims(self, token):
+        """Return the claims of a signed token, or None if it is invalid,
+        expired or revoked.
+
+        Signed tokens always expire, even when ``tokens_expire`` is off, as
+        there is no authorization row to withdraw.
+        """
+        claims = self.signer.verify(token)
+        if claims is None:
+            return None
+        if self.revocations is not None and self.revocations.is_revoked(
+                self.db_session, hash_string(token), claims):
+            return None
+        return claims
+
+    def user_is_usable(self, username):
+        """Whether ``username`` exists and is neither locked nor disabled,
+        from the identity cache when there is one.
+        """
+        if self.identities is not None:
+            values = self.identities.get(self.db_session, username)
+        else:
+            row = self.db_session.query(
+                UserProfile.locked,
+                UserProfile.admin_disabled,
+            ).filter(UserProfile.username == username).first()
+            values = row and row._asdict()
+        return bool(values and not values['locked'] and
+                    not values['admin_disabled'])
 
     @property
     def token_expiration(self):
@@ -42,8 +203,15 @@ class SFOauthProvider(object):
         """Generate a random authorization code."""
         return random_ascii_string(self.token_length)
 
-    def generate_access_token(self):
-        """Generate a random access token."""
+    def generate_access_token(self, username=None, client_id=None):
+        """Generate an access token.
+
+        Tokens are signed when there is a signer and the username and
+        client_id are given, and random otherwise.
+        """
+        if self.signer is not None and username and client_id:
+            return self.signer.sign(username, client_id,
+                                    self.token_expiration)
         return random_ascii_string(self.token_length)
 
     def validate_client_id(self, client_id):
@@ -58,34 +226,55 @@ class SFOauthProvider(object):
             domain.client_secret = hash_string(client_secret)
             return client_secret
 
-    def validate_client_secret(self, client_id, client_secret):
-        """Is the secret correct for this domain?"""
+    def client_secret_digest(self, client_id):
+        if self.credentials is not None:
+            return self.credentials.secret_digest(self.db_session, client_id)
         domain = self.db_session.query(
-            DomainProfile.name,
             DomainProfile.client_secret,
         ).filter(
             DomainProfile.name == client_id
         ).first()
-        hashed = hash_string(client_secret)
-        return (domain.client_secret == hashed)
+        return domain and domain.client_secret
+
+    def validate_client_secret(self, client_id, client_secret):
+        """Is the secret correct for this domain?
+
+        Unknown domains and domains without a secret are refused.
+        """
+        expected = self.client_secret_digest(client_id)
+        if not expected or not client_secret:
+            return False
+        hashed = hash_string(client_secret.encode('utf-8'))
+        if hmac.compare_digest(expected.encode('utf-8'), hashed):
+            return True
+        if self.credentials is None:
+            return False
+        # The secret may have been rotated by another process. Reloading
+        # at most every few seconds keeps wrong secrets cheap to refuse.
+        expected = self.credentials.recheck(self.db_session, client_id)
+        if not expected:
+            return False
+        return hmac.compare_digest(expected.encode('utf-8'), hashed)
 
     def validate_redirect_uri(self, request, redirect_uri):
         # redirect URL must be part of a registered domain
         # redirect domain must match referrer domain
         req_domain_name = get_domain(request)
         rdr_domain_name = get_domain(redirect_uri)
-        domain = DomainProfile.apply_wildcard(request.db_session,
-                                              req_domain_name)
+        domain = find_domain(request, req_domain_name)
         return (domain and req_domain_name == rdr_domain_name)
 
     def persist_authorization_code(self, client_id, username, code):
+        code = hash_string(code)
         authz = self.db_session.query(OAuthAuthorization).filter(
             OAuthAuthorization.client_id == client_id,
             OAuthAuthorization.username == username,
         ).first()
         if authz:
             # update the row
+            self.forget_token(authz)
             authz.access_token = UNDEFINED_SECRET
+            authz.token_signed = False
             authz.auth_code = code
             authz.valid_until = self.auth_code_expiration
         else:
@@ -99,15 +288,23 @@ class SFOauthProvider(object):
             )
             self.db_session.add(new_authz)
 
-    def persist_access_token(self, client_id, auth_code, token):
+    def persist_access_token(self, client_id, auth_code, token=None):
+        """Exchange ``auth_code`` for an access token, generating one when
+        ``token`` isn't given. Returns the token.
+        """
         # throw away auth code, store access token, extend expiration
         authz = self.db_session.query(OAuthAuthorization).filter(
             OAuthAuthorization.client_id == client_id,
-            OAuthAuthorization.auth_code == auth_code,
+            OAuthAuthorization.auth_code == hash_string(auth_code),
         ).first()
+        if token is None:
+            token = self.generate_access_token(authz.username, client_id)
+        self.forget_token(authz)
         authz.auth_code = UNDEFINED_SECRET
-        authz.access_token = token
+        authz.access_token = hash_string(token)
+        authz.token_signed = self.is_signed(token)
         authz.valid_until = self.token_expiration
+        return token
 
     def validate_auth_code(self, client_id, auth_code):
         """Look for an authorization based on auth code and domain"""
@@ -116,48 +313,239 @@ class SFOauthProvider(object):
         now = datetime.datetime.utcnow()
         authz = self.db_session.query(OAuthAuthorization).filter(
             OAuthAuthorization.client_id == client_id,
-            OAuthAuthorization.auth_code == auth_code,
+            OAuthAuthorization.auth_code == hash_string(auth_code),
             OAuthAuthorization.valid_until > now,
         ).first()
         return bool(authz)
 
-    def _authorization_for_access_token(self, client_id, token):
-        """Look for an authorization based on token and domain"""
-        if len(token) < self.token_length or token == UNDEFINED_SECRET:
-            return False
+    @property
+    def valid_after(self):
+        """The time authorizations must still be valid at."""
         if self.tokens_expire:
-            now = datetime.datetime.utcnow()
-        else:
-            now = datetime.datetime.utcfromtimestamp(0)
-        authz = self.db_session.query(OAuthAuthorization).filter(
-            OAuthAuthorization.client_id == client_id,
-            OAuthAuthorization.access_token == token,
-            OAuthAuthorization.valid_until > now,
-        ).first()
-        return authz
+            return datetime.datetime.utcnow()
+        return datetime.datetime.utcfromtimestamp(0)
 
     def user_for_access_token(self, client_id, token):
         """return the username associated with the authorization"""
-        authz = self._authorization_for_access_token(client_id, token)
-        if authz:
-            return authz.username
+        if self.is_signed(token):
+            claims = self.signed_claims(token)
+            if claims and claims['client_id'] == client_id:
+                return claims['username']
+            return None
+        if not self._usable_token(token):
+            return None
+        digest = hash_string(token)
+        principal = ('client', client_id)
+        if self.token_cache is not None:
+            username = self.token_cache.get(digest, principal, _missing)
+            if username is not _missing:
+                return username
+        row = self.db_session.query(
+            OAuthAuthorization.username,
+            OAuthAuthorization.valid_until,
+        ).filter(
+            OAuthAuthorization.client_id == client_id,
+            OAuthAuthorization.access_token == digest,
+            OAuthAuthorization.valid_until > self.valid_after,
+        ).first()
+        self._remember_user(digest, principal, row)
+        return row and row.username or None
+
+    def _remember_user(self, digest, principal, row):
+        if self.token_cache is None:
+            return
+        username = valid_until = None
+        if row:
+            username = row.username
+            if self.tokens_expire:
+                valid_until = row.valid_until
+        self.token_cache.set(digest, principal, username, username,
+                             valid_until)
+
+    def user_details_for_access_token(self, client_id, token):
+        """Return the UserDetails of the user ``token`` was issued to for
+        ``client_id``, or None if it isn't valid for that domain.
+
+        The outcome is kept in the token cache, so a hit needs no query;
+        otherwise a single query joins the authorization with the profile.
+        """
+        if self.is_signed(token):
+            claims = self.signed_claims(token)
+            if not claims or claims['client_id'] != client_id:
+                return None
+            valid_until = datetime.datetime.utcfromtimestamp(
+                claims['expires'])
+            return UserDetails(claims['username'],
+                               *self.profile_details(claims['username']),
+                               valid_until=valid_until)
+        if not self._usable_token(token):
+            return None
+        digest = hash_string(token)
+        principal = ('details', client_id)
+        if self.token_cache is not None:
+            details = self.token_cache.get(digest, principal, _missing)
+            if details is not _missing:
+                return details
+        row = self.db_session.query(
+            OAuthAuthorization.username,
+            OAuthAuthorization.valid_until,
+            UserProfile.email,
+            UserProfile.first_name,
+            UserProfile.last_name,
+        ).outerjoin(
+            UserProfile,
+            UserProfile.username == OAuthAuthorization.username,
+        ).filter(
+            OAuthAuthorization.client_id == client_id,
+            OAuthAuthorization.access_token == digest,
+            OAuthAuthorization.valid_until > self.valid_after,
+        ).first()
+        details = None
+        if row is not None:
+            details = UserDetails(
+                row.username, row.email, row.first_name, row.last_name,
+                row.valid_until if self.tokens_expire else None)
+        if self.token_cache is not None:
+            self.token_cache.set(digest, principal,
+                                 details and details.username, details,
+                                 details and details.valid_until)
+        return details
+
+    def profile_details(self, username):
+        """Return the email, first and last name of ``username``, from the
+        identity cache when there is one, or Nones if there is no such user.
+        """
+        if self.identities is not None:
+            values = self.identities.get(self.db_session, username)
+            if values is None:
+                return None, None, None
+            return values['email'], values['first_name'], values['last_name']
+        row = self.db_session.query(
+            UserProfile.email,
+            UserProfile.first_name,
+            UserProfile.last_name,
+        ).filter(UserProfile.username == username).first()
+        return tuple(row or (None,) * 3)
 
     def validate_user_with_access_token(self, username, token):
         """Look for an authorization based on token and username"""
-        if len(token) < self.token_length or token == UNDEFINED_SECRET:
-            return False
-        user = self.db_session.query(UserProfile).filter(
-            UserProfile.username == username
-        ).first()
-        if user.locked or user.admin_disabled:
-            return False
-        if self.tokens_expire:
-            now = datetime.datetime.utcnow()
-        else:
-            now = datetime.datetime.utcfromtimestamp(0)
-        authz = self.db_session.query(OAuthAuthorization).filter(
+        return self.check_user_access_token(username, token)[0]
+
+    def check_user_access_token(self, username, token):
+        """Return whether ``token`` is valid for ``username``, and the time
+        it expires, or None if it doesn't.
+        """
+        if not self._usable_token(token):
+            return False, None
+        if self.is_signed(token):
+            claims = self.signed_claims(token)
+            if not claims or claims['username'] != username:
+                return False, None
+            # Like _validate_user_with_access_token, refused while the
+            # account is locked or disabled
+            if not self.user_is_usable(username):
+                return False, None
+            return True, datetime.datetime.utcfromtimestamp(claims['expires'])
+        digest = hash_string(token)
+        principal = ('user', username.lower())
+        if self.token_cache is not None:
+            result = self.token_cache.get(digest, principal)
+            if result is not None:
+                return result
+        result = self._validate_user_with_access_token(username, digest)
+        if self.token_cache is not None:
+            self.token_cache.set(digest, principal, username, result,
+                                 result[1])
+        return result
+
+    def _validate_user_with_access_token(self, username, digest):
+        """Check the authorization and the user's status with a single
+        query, returning whether the token is valid and until when.
+        """
+        row = self.db_session.query(
+            OAuthAuthorization.valid_until,
+            UserProfile.locked,
+            UserProfile.admin_disabled,
+        ).join(
+            UserProfile,
+            UserProfile.username == OAuthAuthorization.username,
+        ).filter(
             OAuthAuthorization.username == username,
-            OAuthAuthorization.access_token == token,
-            OAuthAuthorization.valid_until > now,
+            OAuthAuthorization.access_token == digest,
+            OAuthAuthorization.valid_until > self.valid_after,
         ).first()
-        return bool(authz)
+        if row is None or row.locked or row.admin_disabled:
+            return False, None
+        if self.tokens_expire:
+            return True, row.valid_until
+        return True, None
+
+    def _usable_token(self, token):
+        return len(token) >= self.token_length and token != UNDEFINED_SECRET
+
+    def authorizations_for_access_tokens(self, tokens):
+        """Look up the authorizations for many access tokens with a single
+        query, joined with their user's profile.
+
+        Returns the rows found, keyed by token digest.
+        """
+        digests = set(hash_string(token) for token in tokens
+                      if self._usable_token(token))
+        if not digests:
+            return {}
+        rows = self.db_session.query(
+            OAuthAuthorization.access_token,
+            OAuthAuthorization.client_id,
+            OAuthAuthorization.username,
+            OAuthAuthorization.valid_until,
+            UserProfile.email,
+            UserProfile.first_name,
+            UserProfile.last_name,
+            UserProfile.locked,
+            UserProfile.admin_disabled,
+        ).outerjoin(
+            UserProfile,
+            UserProfile.username == OAuthAuthorization.username,
+        ).filter(
+            OAuthAuthorization.access_token.in_(digests),
+            OAuthAuthorization.valid_until > self.valid_after,
+        ).all()
+        return dict((row.access_token, row) for row in rows)
+
+    def validate_users_with_access_tokens(self, pairs):
+        """Batch version of validate_user_with_access_token, taking a list
+        of (username, token) pairs and returning a list of booleans.
+        """
+        results = [None] * len(pairs)
+        misses = []
+        for index, (username, token) in enumerate(pairs):
+            if not self._usable_token(token):
+                results[index] = False
+            elif self.is_signed(token):
+                results[index] = self.validate_user_with_access_token(
+                    username, token)
+            elif self.token_cache is not None:
+                cached = self.token_cache.get(hash_string(token),
+                                              ('user', username.lower()))
+                if cached is not None:
+                    results[index] = cached[0]
+            if results[index] is None:
+                misses.append(index)
+        rows = self.authorizations_for_access_tokens(
+            [pairs[index][1] for index in misses])
+        for index in misses:
+            username, token = pairs[index]
+            digest = hash_string(token)
+            row = rows.get(digest)
+            valid = bool(row and row.username == username and
+                         row.email is not None and
+                         not row.locked and not row.admin_disabled)
+            results[index] = valid
+            if self.token_cache is not None:
+                valid_until = None
+                if valid and self.tokens_expire:
+                    valid_until = row.valid_until
+                self.token_cache.set(digest, ('user', username.lower()),
+                                     username, (valid, valid_until),
+                                     valid_until)
+        return results
@@ -0,0 +1,50 @@
+import logging
+import os
+import sys
+
+import transaction
+
+from pyramid.config import Configurator
+from pyramid.paster import get_appsettings, setup_logging
+
+from sixfeetup.bowab.db import init_sa
+
+from zope.sqlalchemy import mark_changed
+
+from speak_friend.models.reports import DOMAIN_LOGIN_BACKFILL
+from speak_friend.models.reports import LATEST_ACTIVITY_BACKFILL
+
+
+def usage(argv):
+    cmd = os.path.basename(argv[0])
+    print('usage %s <config_uri>\n'
+          '(example: "%s development.ini")' % (cmd, cmd))
+    sys.exit(1)
+
+
+def main(argv=sys.argv):
+    """Populate reports.latest_user_activity and reports.domain_logins
+    from the activity history.
+
+    Safe to run repeatedly: rows already newer than the history are kept.
+    """
+    if len(argv) != 2:
+        usage(argv)
+    config_uri = argv[1]
+    setup_logging(config_uri)
+    settings = get_appsettings(config_uri)
+    config = Configurator(settings=settings)
+    db_session = init_sa(config)
+    logger = logging.getLogger('speak_friend.backfillactivity')
+
+    logger.info("Backfilling latest user activity...")
+    with transaction.manager:
+        result = db_session.execute(LATEST_ACTIVITY_BACKFILL)
+        mark_changed(db_session())
+    logger.info("Recorded %d latest activities.", result.rowcount)
+
+    logger.info("Backfilling domain logins...")
+    with transaction.manager:
+        result = db_session.execute(DOMAIN_LOGIN_BACKFILL)
+        mark_changed(db_session())
+    logger.info("Recorded %d domain logins.", result.rowcount)
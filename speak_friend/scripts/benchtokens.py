@@ -0,0 +1,135 @@
+import os
+import sys
+import time
+
+import transaction
+
+from pyramid.paster import bootstrap, setup_logging
+
+from sqlalchemy import event
+
+from speak_friend.models.authorizations import OAuthAuthorization
+from speak_friend.models.profiles import UserProfile
+from speak_friend.oauth_provider import SFOauthProvider
+from speak_friend.utils import hash_string
+
+
+BENCHMARK_CLIENT = u'benchmark.invalid'
+DEFAULT_ITERATIONS = 1000
+
+
+def usage(argv):
+    cmd = os.path.basename(argv[0])
+    print('usage %s <config_uri> [iterations]\n'
+          '(example: "%s development.ini 1000")' % (cmd, cmd))
+    sys.exit(1)
+
+
+class StatementCounter(object):
+    """Count the SQL statements run on ``engine`` while active."""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+
+    def before_cursor_execute(self, *args):
+        self.count += 1
+
+    def __enter__(self):
+        self.count = 0
+        event.listen(self.engine, 'before_cursor_execute',
+                     self.before_cursor_execute)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(self.engine, 'before_cursor_execute',
+                     self.before_cursor_execute)
+
+
+def validate_two_queries(db_session, username, token):
+    """validate_user_with_access_token as it was: load the profile, then
+    the authorization.
+    """
+    user = db_session.query(UserProfile).filter(
+        UserProfile.username == username
+    ).first()
+    if user.locked or user.admin_disabled:
+        return False
+    authz = db_session.query(OAuthAuthorization).filter(
+        OAuthAuthorization.username == username,
+        OAuthAuthorization.access_token == hash_string(token),
+    ).first()
+    return bool(authz)
+
+
+def details_two_queries(db_session, client_id, token):
+    """get_user_details as it was: find the authorization's user, then
+    load their profile.
+    """
+    authz = db_session.query(OAuthAuthorization).filter(
+        OAuthAuthorization.client_id == client_id,
+        OAuthAuthorization.access_token == hash_string(token),
+    ).first()
+    return db_session.query(UserProfile).get(authz.username)
+
+
+def run(db_session, name, func, iterations):
+    engine = db_session.get_bind()
+    with StatementCounter(engine) as counter:
+        start = time.time()
+        for i in xrange(iterations):
+            # Each request starts with an empty identity map
+            db_session.expunge_all()
+            func()
+        elapsed = time.time() - start
+    print('%-40s %5.2f queries/call %8.3f ms/call' % (
+        name, float(counter.count) / iterations,
+        elapsed * 1000 / iterations))
+
+
+def main(argv=sys.argv):
+    """Compare the queries made to validate an access token, the old way and
+    with the provider's single joined query.
+
+    A token is issued to the first user for a made up domain, and removed
+    again as the transaction is rolled back.
+    """
+    if len(argv) not in (2, 3):
+        usage(argv)
+    config_uri = argv[1]
+    iterations = DEFAULT_ITERATIONS
+    if len(argv) == 3:
+        iterations = int(argv[2])
+    setup_logging(config_uri)
+    env = bootstrap(config_uri)
+    db_session = env['request'].db_session
+    transaction.begin()
+    try:
+        user = db_session.query(UserProfile.username).first()
+        if user is None:
+            print('No users to issue a token to')
+            sys.exit(1)
+        username = user.username
+        provider = SFOauthProvider(db_session)
+        code = provider.generate_authorization_code()
+        provider.persist_authorization_code(BENCHMARK_CLIENT, username, code)
+        token = provider.persist_access_token(BENCHMARK_CLIENT, code)
+        db_session.flush()
+        benchmarks = [
+            ('validate_user_token (before)',
+             lambda: validate_two_queries(db_session, username, token)),
+            ('validate_user_token',
+             lambda: provider.validate_user_with_access_token(username,
+                                                              token)),
+            ('get_user_details (before)',
+             lambda: details_two_queries(db_session, BENCHMARK_CLIENT,
+                                         token)),
+            ('get_user_details',
+             lambda: provider.user_details_for_access_token(
+                 BENCHMARK_CLIENT, token)),
+        ]
+        for name, func in benchmarks:
+            run(db_session, name, func, iterations)
+    finally:
+        transaction.abort()
+        env['closer']()
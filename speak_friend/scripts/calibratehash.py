@@ -0,0 +1,205 @@
+from ConfigParser import SafeConfigParser
+import multiprocessing
+import optparse
+import os
+import sys
+import time
+
+from passlib.context import CryptContext
+from passlib.registry import get_crypt_handler
+
+from pyramid.config import Configurator
+from pyramid.paster import get_appsettings
+
+from speak_friend.configuration import set_password_context
+from speak_friend.hashing import PasswordHashingService
+from speak_friend.utils import percentile
+
+
+DEFAULT_TARGET_MS = 250
+DEFAULT_CAPACITY = 4  # logins per second per core
+DEFAULT_SAMPLES = 10
+# Multiples of the default rounds tried for linear cost schemes, and steps
+# around the default for log2 cost schemes
+LINEAR_GRID = (0.25, 0.5, 1, 2, 4, 8)
+LOG2_GRID = (-2, -1, 0, 1, 2, 3)
+BENCHMARK_PASSWORD = 'correct horse battery staple'
+
+
+def usage(argv):
+    cmd = os.path.basename(argv[0])
+    print('usage %s [options] <config_uri or passlib ini> ...\n'
+          '(example: "%s -t 250 -c 4 production.ini")' % (cmd, cmd))
+    sys.exit(1)
+
+
+def load_context(path):
+    """Load a CryptContext from a file with a [passlib] section, or the one
+    an application's config file sets up.
+    """
+    parser = SafeConfigParser()
+    parser.read(path)
+    if parser.has_section('passlib'):
+        return CryptContext.from_path(path)
+    settings = get_appsettings(path)
+    config = Configurator(settings=settings)
+    config.add_directive('set_password_context', set_password_context)
+    if 'speak_friend.password_hasher' in settings:
+        config.include(settings['speak_friend.password_hasher'])
+    else:
+        from passlib.apps import ldap_context
+        config.set_password_context(context=ldap_context)
+    config.commit()
+    context = config.registry.password_context
+    if isinstance(context, PasswordHashingService):
+        context = context.context
+    return context
+
+
+def rounds_grid(handler):
+    """Return the rounds to try for ``handler``, around its default."""
+    default = handler.default_rounds
+    if handler.rounds_cost == 'log2':
+        grid = [default + step for step in LOG2_GRID]
+    else:
+        grid = [int(default * factor) for factor in LINEAR_GRID]
+    return sorted(set(max(handler.min_rounds, min(rounds, handler.max_rounds))
+                      for rounds in grid))
+
+
+def time_hashes(args):
+    """Hash and verify ``samples`` times, returning the seconds each took.
+    Run in a worker process.
+    """
+    scheme, rounds, samples = args
+    handler = get_crypt_handler(scheme).using(rounds=rounds)
+    encrypts = []
+    verifies = []
+    for i in xrange(samples):
+        start = time.time()
+        pw_hash = handler.hash(BENCHMARK_PASSWORD)
+        encrypts.append(time.time() - start)
+        start = time.time()
+        handler.verify(BENCHMARK_PASSWORD, pw_hash)
+        verifies.append(time.time() - start)
+    return encrypts, verifies
+
+
+def benchmark(pool, processes, scheme, rounds, samples):
+    """Time ``scheme`` at ``rounds`` on every core at once, as a busy
+    server would, returning the sorted encrypt and verify times.
+    """
+    encrypts = []
+    verifies = []
+    jobs = [(scheme, rounds, samples)] * processes
+    for job_encrypts, job_verifies in pool.map(time_hashes, jobs):
+        encrypts.extend(job_encrypts)
+        verifies.extend(job_verifies)
+    return sorted(encrypts), sorted(verifies)
+
+
+def fits(verifies, target, capacity):
+    """Whether a login's verify meets the p95 ``target`` (in seconds), and
+    one core can verify ``capacity`` logins per second.
+    """
+    mean = sum(verifies) / len(verifies)
+    return percentile(verifies, 95) <= target and mean * capacity <= 1
+
+
+def recommended_context(context, scheme, rounds):
+    """Return ``context`` with ``scheme`` as its default at ``rounds``.
+    Hashes using any other scheme are then deprecated, so they are upgraded
+    as users log in.
+    """
+    schemes = list(context.schemes())
+    if scheme in schemes:
+        schemes.remove(scheme)
+    kwargs = {
+        'schemes': [scheme] + schemes,
+        'default': scheme,
+        '%s__default_rounds' % scheme: rounds,
+    }
+    if schemes:
+        kwargs['deprecated'] = ['auto']
+    return context.copy(**kwargs)
+
+
+def calibrate(context, scheme, options, pool):
+    if scheme is None:
+        handler = context.handler()
+    else:
+        handler = get_crypt_handler(scheme)
+    if 'rounds' not in handler.setting_kwds:
+        print('%s has no rounds to tune, pick a scheme with --scheme '
+              '(for example bcrypt or pbkdf2_sha256)' % handler.name)
+        return None
+    if options.rounds:
+        grid = sorted(int(rounds) for rounds in options.rounds.split(','))
+    else:
+        grid = rounds_grid(handler)
+    target = options.target / 1000.0
+    print('%-12s %12s %12s %12s %12s' % (
+        'rounds', 'encrypt p95', 'verify p50', 'verify p95', 'per core/s'))
+    best = None
+    for rounds in grid:
+        encrypts, verifies = benchmark(pool, options.processes, handler.name,
+                                       rounds, options.samples)
+        mean = sum(verifies) / len(verifies)
+        ok = fits(verifies, target, options.capacity)
+        print('%-12d %10.1fms %10.1fms %10.1fms %12.1f%s' % (
+            rounds, percentile(encrypts, 95) * 1000,
+            percentile(verifies, 50) * 1000,
+            percentile(verifies, 95) * 1000,
+            1 / mean, '' if ok else '  too slow'))
+        if ok:
+            best = rounds
+    if best is None:
+        best = grid[0]
+        print('No rounds meet the target, even %d is too slow' % best)
+    return recommended_context(context, handler.name, best)
+
+
+def main(argv=sys.argv):
+    """Benchmark the password context's default scheme (or --scheme) across
+    a grid of rounds on every core, and print a [passlib] section using the
+    most rounds whose verify still meets the p95 latency target and the
+    logins per second per core capacity.
+
+    Each argument is either an application config file, whose password
+    context is loaded as the application would, or a candidate file with a
+    [passlib] section.
+    """
+    parser = optparse.OptionParser(
+        usage='%prog [options] <config_uri or passlib ini> ...')
+    parser.add_option('-t', '--target', type='float',
+                      default=DEFAULT_TARGET_MS,
+                      help='p95 verify latency target, in milliseconds')
+    parser.add_option('-c', '--capacity', type='float',
+                      default=DEFAULT_CAPACITY,
+                      help='logins per second each core must sustain')
+    parser.add_option('-s', '--scheme',
+                      help='scheme to tune, instead of the default one')
+    parser.add_option('-r', '--rounds',
+                      help='comma separated rounds to try')
+    parser.add_option('-n', '--samples', type='int', default=DEFAULT_SAMPLES,
+                      help='hashes timed per core for each rounds value')
+    parser.add_option('-p', '--processes', type='int',
+                      default=multiprocessing.cpu_count(),
+                      help='number of cores to benchmark on')
+    options, args = parser.parse_args(argv[1:])
+    if not args:
+        usage(argv)
+    pool = multiprocessing.Pool(options.processes)
+    try:
+        for path in args:
+            print('# %s' % path)
+            try:
+                context = load_context(path)
+            except (KeyError, ValueError), e:
+                print('Unable to load a password context: %s' % e)
+                continue
+            context = calibrate(context, options.scheme, options, pool)
+            if context is not None:
+                print('\n%s' % context.to_string())
+    finally:
+        pool.terminate()
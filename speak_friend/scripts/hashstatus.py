@@ -0,0 +1,35 @@
+import os
+import sys
+
+from pyramid.paster import bootstrap, setup_logging
+
+from speak_friend.hashing import hash_status
+
+
+def usage(argv):
+    cmd = os.path.basename(argv[0])
+    print('usage %s <config_uri>\n'
+          '(example: "%s development.ini")' % (cmd, cmd))
+    sys.exit(1)
+
+
+def main(argv=sys.argv):
+    """Report how many stored password hashes use each scheme, and what
+    fraction already match the password context's current policy.
+    """
+    if len(argv) != 2:
+        usage(argv)
+    config_uri = argv[1]
+    setup_logging(config_uri)
+    env = bootstrap(config_uri)
+    try:
+        status = hash_status(env['request'].db_session,
+                             env['registry'].password_context)
+    finally:
+        env['closer']()
+    for scheme, count in sorted(status['schemes'].items()):
+        print('%s: %d' % (scheme, count))
+    total = status['total']
+    print('%d of %d hashes (%.1f%%) use the current policy' % (
+        status['current'], total,
+        total and 100.0 * status['current'] / total or 100.0))
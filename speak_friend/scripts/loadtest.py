@@ -0,0 +1,294 @@
+from Cookie import SimpleCookie
+from datetime import datetime
+from urllib import urlencode
+from urlparse import parse_qs
+from urlparse import urlsplit
+import logging
+import optparse
+import os
+import Queue
+import sys
+import threading
+import time
+
+from psycopg2.tz import FixedOffsetTimezone
+
+from pyramid.paster import bootstrap, setup_logging
+from pyramid.request import Request
+from pyramid.security import remember
+
+from sqlalchemy import event
+
+import transaction
+
+from zope.sqlalchemy import mark_changed
+
+from speak_friend.models.authorizations import OAuthAuthorization
+from speak_friend.models.profiles import DomainProfile
+from speak_friend.models.profiles import UserProfile
+from speak_friend.models.reports import DomainLogin
+from speak_friend.models.reports import LatestUserActivity
+from speak_friend.models.reports import UserActivity
+from speak_friend.oauth_provider import SFOauthProvider
+from speak_friend.utils import percentile
+
+
+DOMAIN_SUFFIX = u'.loadtest.invalid'
+USER_PREFIX = u'loadtest_'
+ENDPOINTS = (
+    'authorize_client',
+    'process_authorization',
+    'request_token',
+    'get_user_details',
+    'validate_user_token',
+)
+
+
+def usage(argv):
+    cmd = os.path.basename(argv[0])
+    print('usage %s [options] <config_uri>\n'
+          '(example: "%s -d 10 -u 100 -c 8 -f 1000 development.ini")'
+          % (cmd, cmd))
+    sys.exit(1)
+
+
+class QueryCounter(object):
+    """Count SQL statements per endpoint, for whichever endpoint the
+    executing thread is currently calling.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.current = threading.local()
+        self.counts = dict((name, 0) for name in ENDPOINTS)
+        self._lock = threading.Lock()
+
+    def before_cursor_execute(self, *args):
+        name = getattr(self.current, 'endpoint', None)
+        if name is not None:
+            with self._lock:
+                self.counts[name] += 1
+
+    def start(self):
+        event.listen(self.engine, 'before_cursor_execute',
+                     self.before_cursor_execute)
+
+    def stop(self):
+        event.remove(self.engine, 'before_cursor_execute',
+                     self.before_cursor_execute)
+
+
+class RelyingParty(object):
+    """Stands in for a client application and its user's browser, walking
+    one user through the OAuth2 flow against the WSGI app in-process.
+    """
+
+    def __init__(self, app, registry, counter, timings):
+        self.app = app
+        self.registry = registry
+        self.counter = counter
+        self.timings = timings
+
+    def call(self, endpoint, request, cookies):
+        if cookies:
+            request.headers['Cookie'] = '; '.join(
+                '%s=%s' % (name, morsel.value)
+                for name, morsel in cookies.items())
+        self.counter.current.endpoint = endpoint
+        start = time.time()
+        try:
+            response = request.get_response(self.app)
+        finally:
+            elapsed = time.time() - start
+            self.counter.current.endpoint = None
+        self.timings[endpoint].append(elapsed)
+        for header in response.headers.getall('Set-Cookie'):
+            cookies.load(header)
+        return response
+
+    def login_cookies(self, username):
+        request = Request.blank('/')
+        request.registry = self.registry
+        cookies = SimpleCookie()
+        for name, value in remember(request, username):
+            if name == 'Set-Cookie':
+                cookies.load(value)
+        return cookies
+
+    def flow(self, username, domain, secret):
+        """Run the whole flow, returning an error message or None."""
+        cookies = self.login_cookies(username)
+        site = 'http://%s' % domain
+        request = Request.blank(
+            '/oauth2/authorize_client?' + urlencode({
+                'domain': domain,
+                'redirect_uri': site + '/callback',
+                'response_type': 'code',
+            }),
+            referrer=site + '/')
+        response = self.call('authorize_client', request, cookies)
+        if response.status_int != 200:
+            return 'authorize_client: %s' % response.status
+        request = Request.blank('/oauth2/process_authorization',
+                                POST={'submit': 'submit'},
+                                referrer=site + '/')
+        response = self.call('process_authorization', request, cookies)
+        query = parse_qs(urlsplit(response.location or '').query)
+        code = query.get('code', ['none'])[0]
+        if code == 'none':
+            return 'process_authorization: %s' % response.status
+        request = Request.blank('/oauth2/request_token/%s' % code,
+                                POST={'domain': domain, 'secret': secret})
+        response = self.call('request_token', request, SimpleCookie())
+        token = response.status_int == 200 and \
+            response.json_body.get('access_token')
+        if not token:
+            return 'request_token: %s' % response.status
+        request = Request.blank('/oauth2/get_user_details',
+                                POST={'domain': domain, 'token': token})
+        response = self.call('get_user_details', request, SimpleCookie())
+        if response.status_int != 200:
+            return 'get_user_details: %s' % response.status
+        request = Request.blank('/validate_user_token',
+                                POST={'user': username, 'token': token})
+        response = self.call('validate_user_token', request, SimpleCookie())
+        if not response.json_body.get('valid'):
+            return 'validate_user_token: not valid'
+
+
+def provision(db_session, num_domains, num_users):
+    """Create the load test's domains and users, returning the domain
+    names with their plain client secrets and the usernames.
+    """
+    provider = SFOauthProvider(db_session)
+    now = datetime.utcnow().replace(tzinfo=FixedOffsetTimezone(offset=0))
+    domains = []
+    usernames = []
+    with transaction.manager:
+        for i in xrange(num_domains):
+            domain = DomainProfile(u'lt%d%s' % (i, DOMAIN_SUFFIX))
+            db_session.add(domain)
+            domains.append((domain.name,
+                            provider.create_client_secret(domain)))
+        for i in xrange(num_users):
+            username = u'%s%d' % (USER_PREFIX, i)
+            db_session.add(UserProfile(
+                username, u'Load', u'Test %d' % i,
+                u'%s@loadtest.invalid' % username, u'!', None, 0, False))
+            usernames.append(username)
+        db_session.flush()
+        # Satisfy password_timeout_tween and initial_login_tween
+        db_session.execute(UserActivity.__table__.insert().values([
+            {'username': name, 'activity': u'login', 'activity_ts': now}
+            for name in usernames]))
+        for username in usernames:
+            for name, secret in domains:
+                DomainLogin.record(db_session, username, name)
+        mark_changed(db_session())
+    return domains, usernames
+
+
+def clean_up(db_session):
+    """Remove everything the load test created."""
+    with transaction.manager:
+        for model in (OAuthAuthorization, DomainLogin, LatestUserActivity,
+                      UserActivity, UserProfile):
+            db_session.query(model).filter(
+                model.username.startswith(USER_PREFIX, autoescape=True)
+            ).delete(synchronize_session=False)
+        db_session.query(DomainProfile).filter(
+            DomainProfile.name.endswith(DOMAIN_SUFFIX, autoescape=True)
+        ).delete(synchronize_session=False)
+        mark_changed(db_session())
+
+
+def report(timings, counter, elapsed):
+    print('%-22s %7s %9s %9s %9s %9s %9s' % (
+        'endpoint', 'calls', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms',
+        'queries'))
+    for name in ENDPOINTS:
+        ordered = sorted(timings[name])
+        calls = len(ordered)
+        print('%-22s %7d %9.1f %9.2f %9.2f %9.2f %9.2f' % (
+            name, calls, calls / elapsed,
+            percentile(ordered, 50) * 1000,
+            percentile(ordered, 95) * 1000,
+            percentile(ordered, 99) * 1000,
+            calls and float(counter.counts[name]) / calls or 0))
+
+
+def main(argv=sys.argv):
+    """Drive the OAuth2 flow, from authorize_client to validate_user_token,
+    through the WSGI app from concurrent simulated clients, then report the
+    latency percentiles, throughput and queries per call of each endpoint.
+
+    Test domains and users are created first, and removed at the end unless
+    --keep is given. Meant for a local database, never production.
+    """
+    parser = optparse.OptionParser(usage='%prog [options] <config_uri>')
+    parser.add_option('-d', '--domains', type='int', default=10,
+                      help='number of client domains to create')
+    parser.add_option('-u', '--users', type='int', default=100,
+                      help='number of users to create')
+    parser.add_option('-c', '--concurrency', type='int', default=8,
+                      help='number of simulated clients running at once')
+    parser.add_option('-f', '--flows', type='int', default=1000,
+                      help='number of complete OAuth2 flows to run')
+    parser.add_option('--keep', action='store_true', default=False,
+                      help="don't remove the test domains and users")
+    options, args = parser.parse_args(argv[1:])
+    if len(args) != 1:
+        usage(argv)
+    config_uri = args[0]
+    setup_logging(config_uri)
+    logger = logging.getLogger('speak_friend.loadtest')
+    env = bootstrap(config_uri)
+    db_session = env['request'].db_session
+    clean_up(db_session)
+    domains, usernames = provision(db_session, options.domains,
+                                   options.users)
+    logger.info('Provisioned %d domains and %d users', len(domains),
+                len(usernames))
+
+    timings = dict((name, []) for name in ENDPOINTS)
+    counter = QueryCounter(db_session.get_bind())
+    party = RelyingParty(env['app'], env['registry'], counter, timings)
+    jobs = Queue.Queue()
+    for i in xrange(options.flows):
+        name, secret = domains[i % len(domains)]
+        jobs.put((usernames[i % len(usernames)], name, secret))
+    errors = []
+
+    def worker():
+        while True:
+            try:
+                username, name, secret = jobs.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                error = party.flow(username, name, secret)
+            except Exception, e:
+                error = repr(e)
+            if error:
+                errors.append(error)
+
+    threads = [threading.Thread(target=worker)
+               for i in xrange(options.concurrency)]
+    counter.start()
+    start = time.time()
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        elapsed = time.time() - start
+        counter.stop()
+        report(timings, counter, elapsed)
+        print('%d flows in %.1fs, %d failed' % (options.flows, elapsed,
+                                                len(errors)))
+        for error in sorted(set(errors)):
+            print('  %s' % error)
+        if not options.keep:
+            clean_up(db_session)
+        env['closer']()
@@ -0,0 +1,117 @@
+from datetime import datetime
+import logging
+import os
+import sys
+
+import transaction
+
+from pyramid.paster import bootstrap, setup_logging
+
+from pyramid_controlpanel.views import ControlPanel
+
+from zope.sqlalchemy import mark_changed
+
+from speak_friend.forms.controlpanel import ACTIVITY_RETENTION
+from speak_friend.forms.controlpanel import reports_schema
+from speak_friend.models.reports import PARTITION_MONTHS_AHEAD
+from speak_friend.models.reports import activity_partitions
+from speak_friend.models.reports import add_months
+from speak_friend.models.reports import create_activity_partitions
+from speak_friend.models.reports import month_start
+
+
+ARCHIVE_SCHEMA = 'reports_archive'
+
+
+def usage(argv):
+    cmd = os.path.basename(argv[0])
+    print('usage %s <config_uri>\n'
+          '(example: "%s development.ini")' % (cmd, cmd))
+    sys.exit(1)
+
+
+def expired_partitions(partitions, this_month, retention):
+    """Return the partitions entirely older than ``retention`` months."""
+    if not retention:
+        return []
+    cutoff = add_months(this_month, -retention)
+    return [name for month, name in partitions if month < cutoff]
+
+
+def prune_partition(connection, name, archive=False):
+    connection.execute('ALTER TABLE reports.user_activity '
+                       'DETACH PARTITION reports.%s' % name)
+    if archive:
+        connection.execute('CREATE SCHEMA IF NOT EXISTS %s' % ARCHIVE_SCHEMA)
+        connection.execute('ALTER TABLE reports.%s SET SCHEMA %s' %
+                           (name, ARCHIVE_SCHEMA))
+    else:
+        connection.execute('DROP TABLE reports.%s' % name)
+
+
+def prune_default_partition(connection, cutoff, archive=False):
+    """Remove the rows of the default partition older than ``cutoff``,
+    moving them to the archive schema if ``archive``. Returns how many.
+    """
+    condition = ("FROM reports.user_activity_default "
+                 "WHERE activity_ts < '%s+00'" % cutoff.isoformat())
+    if archive:
+        connection.execute('CREATE SCHEMA IF NOT EXISTS %s' % ARCHIVE_SCHEMA)
+        connection.execute('CREATE TABLE IF NOT EXISTS '
+                           '%s.user_activity_default '
+                           '(LIKE reports.user_activity)' % ARCHIVE_SCHEMA)
+        return connection.execute(
+            'WITH moved AS (DELETE %s RETURNING *) '
+            'INSERT INTO %s.user_activity_default SELECT * FROM moved'
+            % (condition, ARCHIVE_SCHEMA)).rowcount
+    return connection.execute('DELETE %s' % condition).rowcount
+
+
+def main(argv=sys.argv):
+    """Create upcoming reports.user_activity partitions and remove those
+    older than the retention period set in the control panel.
+
+    Meant to be run regularly, at least monthly, from cron.
+    """
+    if len(argv) != 2:
+        usage(argv)
+    config_uri = argv[1]
+    setup_logging(config_uri)
+    env = bootstrap(config_uri)
+    request = env['request']
+    db_session = request.db_session
+    logger = logging.getLogger('speak_friend.pruneactivity')
+
+    cp = ControlPanel(request)
+    retention = cp.get_value(reports_schema.name, 'activity_retention',
+                             ACTIVITY_RETENTION)
+    archive = cp.get_value(reports_schema.name, 'archive_activity', False)
+    this_month = month_start(datetime.utcnow())
+
+    # Separately, so a failure here doesn't hold back pruning
+    with transaction.manager:
+        connection = db_session.connection()
+        create_activity_partitions(
+            connection, this_month,
+            add_months(this_month, PARTITION_MONTHS_AHEAD))
+        mark_changed(db_session())
+
+    with transaction.manager:
+        connection = db_session.connection()
+        partitions = activity_partitions(connection)
+        for name in expired_partitions(partitions, this_month, retention):
+            logger.info("%s partition %s",
+                        archive and "Archiving" or "Dropping", name)
+            prune_partition(connection, name, archive)
+        if retention:
+            count = prune_default_partition(
+                connection, add_months(this_month, -retention), archive)
+            logger.info("%s %d rows from the default partition",
+                        archive and "Archived" or "Dropped", count)
+        remaining = connection.execute(
+            'SELECT count(*) FROM reports.user_activity_default').scalar()
+        if remaining:
+            logger.warning("%d rows are in reports.user_activity_default, "
+                           "outside every monthly partition", remaining)
+        mark_changed(db_session())
+    env['closer']()
@@ -0,0 +1,32 @@
+import os
+import sys
+
+from pyramid.paster import bootstrap, setup_logging
+
+from speak_friend.maintenance import reap_expired
+
+
+def usage(argv):
+    cmd = os.path.basename(argv[0])
+    print('usage %s <config_uri>\n'
+          '(example: "%s development.ini")' % (cmd, cmd))
+    sys.exit(1)
+
+
+def main(argv=sys.argv):
+    """Delete expired OpenID associations and nonces, password reset
+    tokens older than the token duration set in the control panel, signed
+    token revocations that no longer apply and unused OAuth authorization
+    codes (and expired access tokens, if enabled).
+    """
+    if len(argv) != 2:
+        usage(argv)
+    config_uri = argv[1]
+    setup_logging(config_uri)
+    env = bootstrap(config_uri)
+    try:
+        counts = reap_expired(env['registry'])
+    finally:
+        env['closer']()
+    for name in sorted(counts):
+        print('%s: %d removed' % (name, counts[name]))
@@ -4,21 +4,20 @@ from pyramid.security import Authenticated
 from pyramid.security import Everyone
 from pyramid.security import authenticated_userid
 
-from speak_friend.models.profiles import UserProfile
+from speak_friend.identity import lookup_identity
 
 
 Viewers = 'speak_friend.viewers'
 Admins = 'speak_friend.admins'
 
 def groupfinder(userid, request):
-    query = request.db_session.query(UserProfile)
-    user = query.get(userid)
+    identity = lookup_identity(request, userid)
     groups = []
-    if user:
+    if identity:
         groups.append(Viewers)
     else:
         return None
-    if user.is_superuser:
+    if identity['is_superuser']:
         groups.append(Admins)
     return groups
 
@@ -9,9 +9,25 @@ from pyramid_controlpanel.views import ControlPanel
 from pyramid_mailer import get_mailer
 from pyramid_mailer.message import Message
 
+from sixfeetup.bowab.db import get_db_session
+
+from zope.sqlalchemy import mark_changed
+
 from speak_friend.forms.controlpanel import email_notification_schema
+from speak_friend.hashing import DEFAULT_PASSWORD_STATS_INTERVAL
+from speak_friend.hashing import PasswordHashingService
+from speak_friend.identity import invalidate_identity
+from speak_friend.oauth_provider import invalidate_user_tokens
+from speak_friend.maintenance import DEFAULT_NONCE_CLEANUP_INTERVAL
+from speak_friend.maintenance import DEFAULT_REAP_INTERVAL
+from speak_friend.maintenance import PeriodicTask
+from speak_friend.maintenance import cleanup_nonces
+from speak_friend.maintenance import reap_expired
+from speak_friend.models.open_id import sql_store_factory
+from speak_friend.models.reports import DomainLogin
 from speak_friend.models.reports import UserActivity
 from speak_friend.models.profiles import ResetToken
+from speak_friend.utils import after_commit
 from speak_friend.utils import get_xrds_url
 
 
@@ -39,7 +55,41 @@ def log_user_activity(event):
     if 'activity' not in kwargs:
         kwargs['activity'] = event.activity
     activity = UserActivity(**kwargs)
-    event.request.db_session.add(activity)
+    writer = getattr(event.request.registry, 'activity_writer', None)
+    if writer is not None:
+        writer.record(event.request, activity)
+    else:
+        event.request.db_session.add(activity)
+
+
+def record_domain_login(event):
+    """Remember every domain a user has logged in from, for the benefit
+    of initial_login_tween.
+    """
+    if not event.came_from_fqdn:
+        return
+    db_session = event.request.db_session
+    # The account may have been created in this same request
+    db_session.flush()
+    DomainLogin.record(db_session, event.user.username, event.came_from_fqdn)
+    mark_changed(db_session())
+    cache = getattr(event.request.registry, 'login_cache', None)
+    if cache is not None:
+        key = DomainLogin.cache_key(event.user.username, event.came_from_fqdn)
+        after_commit(cache.set, key, True)
+
+
+def invalidate_user_identity(event):
+    """Drop the user's cached identity once their account changes."""
+    invalidate_identity(event.request, event.user.username)
+
+
+def invalidate_user_tokens_cache(event):
+    """Drop the cached checks of a user's tokens, and the profile details
+    cached with them, once their profile changes or their account is
+    disabled, locked, or unlocked by a password reset.
+    """
+    invalidate_user_tokens(event.request, event.user.username)
 
 
 def notify_account_created(event):
@@ -220,3 +270,35 @@ def add_yadis_header(event):
     if request is not None:
         xrds_url = get_xrds_url(request)
         request.response.headers[YADIS_HEADER_NAME] = xrds_url
+
+
+def start_maintenance(event):
+    """Start the background housekeeping tasks once the application is
+    created.
+    """
+    registry = event.app.registry
+    settings = registry.settings
+    tasks = []
+    interval = int(settings.get('speak_friend.nonce_cleanup_interval',
+                                DEFAULT_NONCE_CLEANUP_INTERVAL))
+    store_factory = getattr(registry, 'openid_store_factory', None)
+    if interval > 0 and store_factory is sql_store_factory:
+        tasks.append(PeriodicTask('speak_friend.cleanup_nonces', interval,
+                                  cleanup_nonces,
+                                  get_db_session(None, settings)))
+    interval = int(settings.get('speak_friend.reap_interval',
+                                DEFAULT_REAP_INTERVAL))
+    if interval > 0:
+        tasks.append(PeriodicTask('speak_friend.reap_expired', interval,
+                                  reap_expired, registry))
+    password_context = getattr(registry, 'password_context', None)
+    if isinstance(password_context, PasswordHashingService):
+        password_context.start()
+        interval = int(settings.get('speak_friend.password_stats_interval',
+                                    DEFAULT_PASSWORD_STATS_INTERVAL))
+        if interval > 0:
+            tasks.append(PeriodicTask('speak_friend.password_stats',
+                                      interval, password_context.log_stats))
+    for task in tasks:
+        task.start()
+    registry.maintenance_tasks = tasks
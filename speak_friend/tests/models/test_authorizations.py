@@ -0,0 +1,46 @@
+from unittest import TestCase
+
+from mock import Mock
+from mock import patch
+
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import Query
+from sqlalchemy.orm import Session
+
+from speak_friend.models.authorizations import OAuthAuthorization
+
+
+class IssuedToTests(TestCase):
+    @patch.object(Query, 'all', autospec=True)
+    def test_single_joined_query(self, all_):
+        all_.return_value = [Mock(total=120), Mock(total=120)]
+        rows, total = OAuthAuthorization.issued_to(Session(), u'dave', 50, 50)
+        self.assertEqual(total, 120)
+        self.assertEqual(all_.call_count, 1)
+        query = all_.call_args[0][0]
+        sql = str(query.statement.compile(dialect=postgresql.dialect()))
+        self.assertIn('LEFT OUTER JOIN profiles.domain_profiles', sql)
+        self.assertIn('oauth_authorizations.access_token !=', sql)
+        self.assertIn('count(*) OVER ()', sql)
+        self.assertIn('LIMIT', sql)
+
+    @patch.object(Query, 'all', autospec=True)
+    def test_no_rows(self, all_):
+        all_.return_value = []
+        # Only counted again past the first page
+        self.assertEqual(OAuthAuthorization.issued_to(Session(), u'dave'),
+                         ([], 0))
+
+    @patch.object(Query, 'scalar', autospec=True)
+    @patch.object(Query, 'all', autospec=True)
+    def test_past_last_page(self, all_, scalar):
+        all_.return_value = []
+        scalar.return_value = 120
+        rows, total = OAuthAuthorization.issued_to(Session(), u'dave',
+                                                   500, 50)
+        self.assertEqual((rows, total), ([], 120))
+        query = scalar.call_args[0][0]
+        sql = str(query.statement.compile(dialect=postgresql.dialect()))
+        self.assertIn('count(*)', sql)
+        self.assertIn('FROM oauth_authorizations', sql)
+        self.assertNotIn('OVER', sql)
@@ -2,14 +2,27 @@ import datetime
 import time
 
 from unittest import TestCase
-from mock import Mock, call
+from mock import Mock, call, patch
+
+from openid.association import Association as OpenIDAssociation
+import transaction
 
 from sixfeetup.bowab.tests.mocks import MockQuery
 
+from speak_friend.models.open_id import AssociationCache
+from speak_friend.models.open_id import MemoryOpenIDStore
 from speak_friend.models.open_id import SFOpenIDStore, Association, Nonce
 
 
-__all__ = ['OpenIDStoreTest', 'AssociationTests']
+__all__ = ['OpenIDStoreTest', 'AssociationTests', 'AssociationCacheTests',
+           'MemoryOpenIDStoreTests']
+
+
+def make_openid_association(handle='asdf', lifetime=600, issued=None):
+    if issued is None:
+        issued = int(time.time())
+    return OpenIDAssociation(handle, 'aflasdkf', issued, lifetime,
+                             'HMAC-SHA1')
 
 
 class OpenIDStoreTest(TestCase):
@@ -179,51 +192,55 @@ class OpenIDStoreTest(TestCase):
         returned = store.removeAssociation(server_url, handle='asdf')
         self.assertEqual(returned, False)
 
-    def test_use_nonce_success(self):
+    @patch('speak_friend.models.open_id.mark_changed')
+    def test_use_nonce_success(self, mark_changed):
         server_url = "http://test.net"
         timestamp = int(time.time())
         salt = "asdfgadfgj"
 
         session = Mock()
-        session.query = MockQuery()
+        session.execute.return_value.rowcount = 1
 
         store = SFOpenIDStore(session)
         use_nonce = store.useNonce(server_url, timestamp, salt)
         self.assertEqual(use_nonce, True)
+        stmt = session.execute.call_args[0][0]
+        self.assertEqual(stmt.table, Nonce.__table__)
 
-    def test_use_nonce_fail(self):
+    @patch('speak_friend.models.open_id.mark_changed')
+    def test_use_nonce_fail(self, mark_changed):
         server_url = "http://test.net"
         timestamp = int(time.time())
         salt = "asdfgadfgj"
 
-        nonce = Nonce(server_url, timestamp, salt)
-
+        # The insert conflicted with an existing nonce
         session = Mock()
-        session.query = MockQuery(store=[nonce])
+        session.execute.return_value.rowcount = 0
 
         store = SFOpenIDStore(session)
         use_nonce = store.useNonce(server_url, timestamp, salt)
         self.assertEqual(use_nonce, False)
 
-    def test_use_nonce_out_of_skew_pass(self):
+    def test_use_nonce_out_of_skew_fail(self):
         from openid.store.nonce import SKEW
         server_url = "http://test.net"
-        timestamp = int(time.time())
+        timestamp = int(time.time()) - SKEW - 5
         salt = "asdfgadfgj"
 
-        nonce = Nonce(server_url, timestamp + SKEW + 5, salt)
-
         session = Mock()
-        session.query = MockQuery(store=[nonce])
 
-        def fake_filter(*args):
-            return MockQuery(store=[])
+        store = SFOpenIDStore(session)
+        use_nonce = store.useNonce(server_url, timestamp, salt)
+        self.assertEqual(use_nonce, False)
+        self.assertFalse(session.execute.called)
 
-        session.query.filter = fake_filter
+    def test_cleanup(self):
+        session = Mock()
+        query = session.query.return_value.filter.return_value
+        query.delete.return_value = 3
 
         store = SFOpenIDStore(session)
-        use_nonce = store.useNonce(server_url, timestamp, salt)
-        self.assertEqual(use_nonce, True)
+        self.assertEqual(store.cleanup(), (3, 3))
 
 
 class AssociationTests(TestCase):
@@ -248,3 +265,84 @@ class AssociationTests(TestCase):
                                 issued, lifetime, 'HMAC-SHA1')
             expired = assoc.is_expired()
             self.assertFalse(expired)
+
+
+class AssociationCacheTests(TestCase):
+    server_url = "http://test.net"
+
+    def test_written_through_on_commit(self):
+        cache = AssociationCache(10)
+        store = SFOpenIDStore(Mock(), cache=cache)
+        txn = transaction.begin()
+        store.storeAssociation(self.server_url, make_openid_association())
+        self.assertIsNone(cache.get(self.server_url, 'asdf'))
+        txn.commit()
+        self.assertEqual(cache.get(self.server_url, 'asdf').handle, 'asdf')
+
+    def test_lookup_by_handle_skips_query(self):
+        cache = AssociationCache(10)
+        cache.add(self.server_url, make_openid_association())
+        session = Mock()
+        store = SFOpenIDStore(session, cache=cache)
+        returned = store.getAssociation(self.server_url, 'asdf')
+        self.assertEqual(returned.handle, 'asdf')
+        self.assertFalse(session.query.called)
+
+    def test_caches_database_lookups(self):
+        cache = AssociationCache(10)
+        assoc = Association(self.server_url, 'asdf', 'aflasdkf',
+                            int(time.time()), 600, 'HMAC-SHA1')
+        session = Mock()
+        session.query = MockQuery(store=[assoc])
+        store = SFOpenIDStore(session, cache=cache)
+        store.getAssociation(self.server_url, 'asdf')
+        self.assertEqual(cache.get(self.server_url, 'asdf').handle, 'asdf')
+
+    def test_expired_not_cached(self):
+        cache = AssociationCache(10)
+        cache.add(self.server_url,
+                  make_openid_association(issued=int(time.time()) - 700))
+        self.assertIsNone(cache.get(self.server_url, 'asdf'))
+
+    def test_remove(self):
+        cache = AssociationCache(10)
+        cache.add(self.server_url, make_openid_association())
+        session = Mock()
+        session.query = MockQuery()
+        store = SFOpenIDStore(session, cache=cache)
+        store.removeAssociation(self.server_url, 'asdf')
+        self.assertIsNone(cache.get(self.server_url, 'asdf'))
+
+
+class MemoryOpenIDStoreTests(TestCase):
+    server_url = "http://test.net"
+
+    def test_associations(self):
+        store = MemoryOpenIDStore()
+        store.storeAssociation(self.server_url,
+                               make_openid_association('old', issued=100))
+        store.storeAssociation(self.server_url, make_openid_association())
+        self.assertEqual(store.getAssociation(self.server_url).handle, 'asdf')
+        self.assertIsNone(store.getAssociation(self.server_url, 'old'))
+        self.assertEqual(store.cleanupAssociations(), 1)
+        self.assertTrue(store.removeAssociation(self.server_url, 'asdf'))
+        self.assertFalse(store.removeAssociation(self.server_url, 'asdf'))
+
+    def test_nonces(self):
+        store = MemoryOpenIDStore()
+        timestamp = int(time.time())
+        self.assertTrue(store.useNonce(self.server_url, timestamp, 'salt'))
+        self.assertFalse(store.useNonce(self.server_url, timestamp, 'salt'))
+        self.assertFalse(store.useNonce(self.server_url, 100, 'salt'))
+
+    def test_nonce_ring_buffer(self):
+        store = MemoryOpenIDStore(nonce_capacity=2)
+        timestamp = int(time.time())
+        for salt in ('a', 'b', 'c'):
+            store.useNonce(self.server_url, timestamp + ord(salt), salt)
+        self.assertEqual(len(store.nonces), 2)
+        # Pushed out, so it can't be checked and is refused
+        self.assertFalse(store.useNonce(self.server_url,
+                                        timestamp + ord('a'), 'd'))
+        self.assertTrue(store.useNonce(self.server_url,
+                                       timestamp + ord('c'), 'd'))
@@ -0,0 +1,49 @@
+from unittest import TestCase
+
+from mock import Mock
+from mock import patch
+
+from sqlalchemy.dialects import postgresql
+
+from speak_friend.models.profiles import LoginAttempts
+from speak_friend.tests.mocks import create_user
+
+
+@patch('speak_friend.models.profiles.mark_changed')
+class LoginAttemptsTests(TestCase):
+    def setUp(self):
+        self.session = Mock()
+        self.user = create_user(u'dave')
+        self.user.locked = False
+
+    def statements(self):
+        return [str(call[0][0].compile(dialect=postgresql.dialect()))
+                for call in self.session.execute.call_args_list]
+
+    def test_failed_is_one_statement(self, mark_changed):
+        self.session.execute.return_value.first.return_value = Mock(
+            login_attempts=1, locked=False)
+        self.assertFalse(LoginAttempts.failed(self.session, self.user, 3))
+        sql, = self.statements()
+        self.assertIn('SET login_attempts=(coalesce(', sql)
+        self.assertIn('RETURNING profiles.user_profiles.login_attempts, '
+                      'profiles.user_profiles.locked', sql)
+        self.assertEqual(self.user.login_attempts, 1)
+        self.assertTrue(mark_changed.called)
+
+    def test_failed_locks(self, mark_changed):
+        self.session.execute.return_value.first.return_value = Mock(
+            login_attempts=3, locked=True)
+        self.assertTrue(LoginAttempts.failed(self.session, self.user, 3))
+        self.assertTrue(self.user.locked)
+        # Already locked by a concurrent failure
+        self.assertFalse(LoginAttempts.failed(self.session, self.user, 3))
+
+    def test_reset(self, mark_changed):
+        self.assertFalse(LoginAttempts.reset(self.session, self.user))
+        self.assertFalse(self.session.execute.called)
+        self.user.login_attempts = 2
+        self.assertTrue(LoginAttempts.reset(self.session, self.user))
+        self.assertEqual(len(self.statements()), 1)
+        self.assertEqual(self.user.login_attempts, 0)
+        self.assertFalse(self.user.locked)
@@ -0,0 +1,121 @@
+from datetime import date
+from datetime import datetime
+from unittest import TestCase
+
+from mock import Mock
+
+from speak_friend.models.reports import DomainLogin
+from speak_friend.models.reports import LatestUserActivity
+from speak_friend.models.reports import activity_partitions
+from speak_friend.models.reports import add_months
+from speak_friend.models.reports import create_activity_partitions
+from speak_friend.tests.mocks import create_user
+
+
+class LatestUserActivityTests(TestCase):
+    def test_single_activity_is_key_lookup(self):
+        session = Mock()
+        LatestUserActivity.latest(session, u'dave', u'login')
+        session.query.assert_called_once_with(LatestUserActivity)
+        query = session.query.return_value
+        query.get.assert_called_once_with((u'dave', u'login'))
+        self.assertFalse(query.order_by.called)
+
+    def test_several_activities_pick_newest(self):
+        session = Mock()
+        LatestUserActivity.latest(session, u'dave',
+                                  u'authorize_checkid', u'login')
+        query = session.query.return_value
+        self.assertFalse(query.get.called)
+        self.assertTrue(query.filter.return_value.filter.called)
+
+    def test_last_login(self):
+        session = Mock()
+        user = create_user(u'dave')
+        user.last_login(session)
+        query = session.query.return_value
+        query.get.assert_called_once_with((u'dave', u'login'))
+
+
+class DomainLoginTests(TestCase):
+    def test_exists(self):
+        session = Mock()
+        query = session.query.return_value.filter.return_value
+        query.first.return_value = None
+        self.assertFalse(DomainLogin.exists(session, u'dave', u'foo.com'))
+        query.first.return_value = (u'dave',)
+        self.assertTrue(DomainLogin.exists(session, u'dave', u'foo.com'))
+
+    def test_record_ignores_duplicates(self):
+        session = Mock()
+        DomainLogin.record(session, u'dave', u'foo.com')
+        stmt = session.execute.call_args[0][0]
+        self.assertEqual(stmt.table, DomainLogin.__table__)
+        self.assertIsNotNone(stmt._post_values_clause)
+
+    def test_cache_key(self):
+        self.assertEqual(DomainLogin.cache_key(u'Dave', u'foo.com'),
+                         (u'dave', u'foo.com'))
+
+
+class ActivityPartitionTests(TestCase):
+    def test_add_months(self):
+        self.assertEqual(add_months(date(2026, 11, 1), 3), date(2027, 2, 1))
+        self.assertEqual(add_months(date(2026, 1, 1), -1), date(2025, 12, 1))
+
+    def partition_connection(self, existing=(), stranded=False):
+        """A connection whose catalog lists ``existing`` partitions, and
+        whose default partition holds rows for new months if ``stranded``.
+        """
+        connection = Mock()
+
+        def execute(sql, **kw):
+            result = Mock()
+            if 'pg_inherits' in sql:
+                return [(name,) for name in existing]
+            # The default partition exists
+            result.scalar.return_value = 'SELECT EXISTS' not in sql or stranded
+            return result
+        connection.execute.side_effect = execute
+        return connection
+
+    def executed(self, connection):
+        """The statements run, less the lookups."""
+        lookups = ('pg_inherits', 'to_regclass', 'SELECT EXISTS')
+        return [call[0][0] for call in connection.execute.call_args_list
+                if not any(word in call[0][0] for word in lookups)]
+
+    def test_create_partitions(self):
+        connection = self.partition_connection(['user_activity_2026_11'])
+        names = create_activity_partitions(connection,
+                                           datetime(2026, 11, 14),
+                                           date(2027, 1, 1))
+        self.assertEqual(names, ['user_activity_2026_11',
+                                 'user_activity_2026_12',
+                                 'user_activity_2027_01'])
+        created = self.executed(connection)
+        self.assertEqual(len(created), 2)
+        self.assertIn("FROM ('2026-12-01+00') TO ('2027-01-01+00')",
+                      created[0])
+
+    def test_create_partitions_moves_default_rows(self):
+        connection = self.partition_connection(stranded=True)
+        create_activity_partitions(connection, date(2026, 12, 1),
+                                   date(2026, 12, 1))
+        detach, create, insert, delete, attach = self.executed(connection)
+        self.assertIn('DETACH PARTITION reports.user_activity_default',
+                      detach)
+        self.assertIn('PARTITION OF reports.user_activity', create)
+        self.assertIn('INSERT INTO reports.user_activity_2026_12', insert)
+        self.assertIn("activity_ts < '2027-01-01+00'", delete)
+        self.assertIn('ATTACH PARTITION reports.user_activity_default '
+                      'DEFAULT', attach)
+
+    def test_list_partitions(self):
+        connection = Mock()
+        connection.execute.return_value = [('user_activity_2026_11',),
+                                           ('user_activity_default',),
+                                           ('user_activity_2026_09',)]
+        self.assertEqual(activity_partitions(connection),
+                         [(date(2026, 9, 1), 'user_activity_2026_09'),
+                          (date(2026, 11, 1), 'user_activity_2026_11')])
@@ -0,0 +1,124 @@
+from unittest import TestCase
+import threading
+
+from mock import MagicMock
+import transaction
+
+from sqlalchemy.dialects import postgresql
+
+from speak_friend.activity import ActivityWriter
+from speak_friend.activity import activity_values
+from speak_friend.models.reports import UserActivity
+from speak_friend.tests.common import SFBaseCase
+from speak_friend.tests.mocks import create_user
+
+
+def make_activity(activity=u'authorize_checkid'):
+    return UserActivity(user=create_user(u'dave'), activity=activity,
+                        came_from_fqdn=u'foo.com')
+
+
+class ActivityValuesTests(TestCase):
+    def test_stamps_time(self):
+        values = activity_values(make_activity())
+        self.assertIsNotNone(values['activity_ts'])
+        self.assertEqual(values['username'], u'dave')
+        self.assertEqual(values['actor_username'], None)
+        self.assertNotIn('user_activity_id', values)
+
+
+class ActivityWriterTests(SFBaseCase):
+    def setUp(self):
+        super(ActivityWriterTests, self).setUp()
+        self.writer = ActivityWriter(batch_size=2, queue_size=2,
+                                     flush_interval=0.01)
+        self.writer.engine = MagicMock()
+        self.writer.start = lambda: None
+
+    def executed(self):
+        connection = self.writer.engine.begin.return_value.__enter__()
+        return connection.execute.call_args_list
+
+    def test_sync_activities_join_the_request(self):
+        self.request.db_session = MagicMock()
+        activity = make_activity(u'login')
+        self.writer.record(self.request, activity)
+        self.request.db_session.add.assert_called_once_with(activity)
+        self.assertTrue(self.writer.queue.empty())
+
+    def test_queued_after_commit(self):
+        self.request.db_session = MagicMock()
+        txn = transaction.begin()
+        self.writer.record(self.request, make_activity())
+        self.assertTrue(self.writer.queue.empty())
+        txn.commit()
+        self.assertEqual(self.writer.queue.qsize(), 1)
+
+    def test_not_queued_after_abort(self):
+        self.request.db_session = MagicMock()
+        txn = transaction.begin()
+        self.writer.record(self.request, make_activity())
+        txn.abort()
+        self.assertTrue(self.writer.queue.empty())
+
+    def test_batches(self):
+        for i in range(3):
+            self.writer.enqueue(activity_values(make_activity()))
+            if i == 1:
+                batch, stopping = self.writer.next_batch()
+                self.assertEqual(len(batch), 2)
+        batch, stopping = self.writer.next_batch()
+        self.assertEqual(len(batch), 1)
+        self.assertFalse(stopping)
+
+    def test_drop_when_full(self):
+        self.writer.backpressure = 'drop'
+        for i in range(3):
+            self.writer.enqueue(activity_values(make_activity()))
+        self.assertEqual(self.writer.dropped, 1)
+        self.assertEqual(self.writer.queue.qsize(), 2)
+
+    def test_sync_when_full(self):
+        self.writer.backpressure = 'sync'
+        for i in range(3):
+            self.writer.enqueue(activity_values(make_activity()))
+        self.assertEqual(len(self.executed()), 1)
+        self.assertEqual(self.writer.written, 1)
+
+    def test_write_serializes_detail_off_the_request_thread(self):
+        self.writer.registry = self.config.registry
+        dialect = postgresql.dialect()
+        bound = []
+
+        def execute(stmt):
+            compiled = stmt.compile(dialect=dialect)
+            processors = compiled._bind_processors
+            bound.extend(processors[key](value) for key, value
+                         in compiled.construct_params().items()
+                         if key.startswith('activity_detail'))
+
+        connection = self.writer.engine.begin.return_value.__enter__()
+        connection.execute.side_effect = execute
+        activity = make_activity()
+        activity.activity_detail = {u'ip_address': u'127.0.0.1'}
+        thread = threading.Thread(target=self.writer.write,
+                                  args=([activity_values(activity)],))
+        thread.start()
+        thread.join()
+        self.assertEqual(self.writer.failed, 0)
+        self.assertEqual(bound, [u'{"ip_address": "127.0.0.1"}'])
+
+    def test_write_failure_is_counted(self):
+        self.writer.engine.begin.side_effect = ValueError
+        self.writer.write([activity_values(make_activity())])
+        self.assertEqual(self.writer.failed, 1)
+
+    def test_stop_flushes(self):
+        del self.writer.start
+        self.writer.enqueue(activity_values(make_activity()))
+        self.writer.stop()
+        self.assertEqual(self.writer.written, 1)
+        self.assertFalse(self.writer._thread.is_alive())
+
+    def test_unknown_policy(self):
+        self.assertRaises(ValueError, ActivityWriter, backpressure='wait')
@@ -0,0 +1,60 @@
+from unittest import TestCase
+
+from mock import patch
+
+from speak_friend.cache import LRUCache
+from speak_friend.cache import cache_size
+
+
+class LRUCacheTests(TestCase):
+    def test_get_set(self):
+        cache = LRUCache()
+        self.assertIsNone(cache.get('a'))
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIn('a', cache)
+        self.assertEqual(cache.hits, 2)
+        self.assertEqual(cache.misses, 1)
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(len(cache), 2)
+        self.assertNotIn('b', cache)
+        self.assertIn('a', cache)
+
+    @patch('speak_friend.cache.time.time')
+    def test_ttl(self, time):
+        time.return_value = 100
+        cache = LRUCache(ttl=10)
+        cache.set('a', 1)
+        cache.set('b', 2, ttl=30)
+        time.return_value = 120
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('b'), 2)
+
+    def test_invalidate(self):
+        cache = LRUCache()
+        cache.set(('dave', 'a'), 1)
+        cache.set(('dave', 'b'), 2)
+        cache.set(('sue', 'a'), 3)
+        cache.invalidate(('sue', 'a'))
+        self.assertNotIn(('sue', 'a'), cache)
+        cache.invalidate_where(lambda key: key[0] == 'dave')
+        self.assertEqual(len(cache), 0)
+
+    def test_invalidate_values(self):
+        cache = LRUCache()
+        cache.set('a', ('dave', 1))
+        cache.set('b', ('sue', 2))
+        cache.invalidate_values(lambda value: value[0] == 'dave')
+        self.assertNotIn('a', cache)
+        self.assertIn('b', cache)
+
+    def test_cache_size(self):
+        self.assertEqual(cache_size({}, 'login', 5), 5)
+        settings = {'speak_friend.login_cache_size': '20'}
+        self.assertEqual(cache_size(settings, 'login'), 20)
@@ -0,0 +1,148 @@
+from mock import Mock
+
+from sixfeetup.bowab.tests.mocks import MockSession
+
+from speak_friend.domains import ClientCredentials
+from speak_friend.domains import CompiledDomains
+from speak_friend.domains import DomainMatcher
+from speak_friend.domains import RequestDomains
+from speak_friend.domains import find_domain
+from speak_friend.models.profiles import DomainProfile
+from speak_friend.tests.common import SFBaseCase
+
+
+def make_domains(*names):
+    return [DomainProfile(name=name, password_valid=-1) for name in names]
+
+
+class CompiledDomainsTests(SFBaseCase):
+    def test_exact_match(self):
+        compiled = CompiledDomains(make_domains(u'foo.com', u'bar.com'))
+        self.assertEqual(compiled.match(u'foo.com').name, u'foo.com')
+
+    def test_case_insensitive(self):
+        compiled = CompiledDomains(make_domains(u'Foo.com'))
+        self.assertEqual(compiled.match(u'FOO.COM').name, u'Foo.com')
+
+    def test_no_match(self):
+        compiled = CompiledDomains(make_domains(u'foo.com', u'*.bar.com'))
+        self.assertIsNone(compiled.match(u'baz.com'))
+
+    def test_wildcard_needs_a_label(self):
+        compiled = CompiledDomains(make_domains(u'*.foo.com'))
+        self.assertIsNone(compiled.match(u'foo.com'))
+        self.assertEqual(compiled.match(u'www.foo.com').name, u'*.foo.com')
+        self.assertEqual(compiled.match(u'a.b.foo.com').name, u'*.foo.com')
+
+    def test_most_specific_wildcard(self):
+        compiled = CompiledDomains(make_domains(u'*.foo.com', u'*.b.foo.com'))
+        self.assertEqual(compiled.match(u'a.b.foo.com').name, u'*.b.foo.com')
+        self.assertEqual(compiled.match(u'a.c.foo.com').name, u'*.foo.com')
+
+    def test_exact_beats_wildcard(self):
+        compiled = CompiledDomains(make_domains(u'*.foo.com', u'www.foo.com'))
+        self.assertEqual(compiled.match(u'www.foo.com').name, u'www.foo.com')
+
+    def test_bare_suffix_wildcard(self):
+        compiled = CompiledDomains(make_domains(u'*foo.com'))
+        self.assertEqual(compiled.match(u'foo.com').name, u'*foo.com')
+        self.assertEqual(compiled.match(u'barfoo.com').name, u'*foo.com')
+
+
+class DomainMatcherTests(SFBaseCase):
+    def test_loads_once(self):
+        session = MockSession(make_domains(u'foo.com'))
+        matcher = DomainMatcher()
+        self.assertEqual(matcher.match(session, u'foo.com').name, u'foo.com')
+        session._store.append(make_domains(u'bar.com')[0])
+        self.assertIsNone(matcher.match(session, u'bar.com'))
+
+    def test_invalidate(self):
+        session = MockSession(make_domains(u'foo.com'))
+        matcher = DomainMatcher()
+        matcher.match(session, u'foo.com')
+        session.query = MockSession(make_domains(u'bar.com')).query
+        matcher.invalidate()
+        self.assertEqual(matcher.match(session, u'bar.com').name, u'bar.com')
+
+    def test_returns_copies(self):
+        domain = make_domains(u'foo.com')[0]
+        matcher = DomainMatcher()
+        found = matcher.match(MockSession([domain]), u'foo.com')
+        self.assertIsNot(found, domain)
+
+    def test_find_domain_uses_registry(self):
+        self.request.registry.domain_matcher = DomainMatcher()
+        self.request.db_session = MockSession(make_domains(u'*.foo.com'))
+        self.assertEqual(find_domain(self.request, u'www.foo.com').name,
+                         u'*.foo.com')
+        self.assertIsNone(find_domain(self.request, u''))
+
+
+class ClientCredentialsTests(SFBaseCase):
+    def setUp(self):
+        super(ClientCredentialsTests, self).setUp()
+        self.session = Mock()
+        self.session.query.return_value.all.return_value = [
+            (u'foo.com', u'digest'),
+            (u'bar.com', None),
+        ]
+
+    def test_loads_once(self):
+        credentials = ClientCredentials()
+        self.assertEqual(credentials.secret_digest(self.session, u'foo.com'),
+                         u'digest')
+        self.assertIsNone(credentials.secret_digest(self.session, u'bar.com'))
+        self.assertIsNone(credentials.secret_digest(self.session, u'baz.com'))
+        self.assertEqual(self.session.query.call_count, 1)
+
+    def test_invalidate(self):
+        credentials = ClientCredentials()
+        credentials.secret_digest(self.session, u'foo.com')
+        credentials.invalidate()
+        credentials.secret_digest(self.session, u'foo.com')
+        self.assertEqual(self.session.query.call_count, 2)
+
+    def test_recheck_throttled(self):
+        credentials = ClientCredentials()
+        credentials.secret_digest(self.session, u'foo.com')
+        self.assertIsNone(credentials.recheck(self.session, u'foo.com'))
+        self.assertEqual(self.session.query.call_count, 1)
+        credentials._loaded_at -= 6
+        self.assertEqual(credentials.recheck(self.session, u'foo.com'),
+                         u'digest')
+        self.assertIsNone(credentials.recheck(self.session, u'foo.com'))
+        self.assertEqual(self.session.query.call_count, 2)
+
+    def test_reloaded_after_ttl(self):
+        credentials = ClientCredentials(ttl=30)
+        credentials.secret_digest(self.session, u'foo.com')
+        credentials._loaded_at -= 31
+        credentials.secret_digest(self.session, u'foo.com')
+        self.assertEqual(self.session.query.call_count, 2)
+
+
+class RequestDomainsTests(SFBaseCase):
+    def setUp(self):
+        super(RequestDomainsTests, self).setUp()
+        self.request.db_session = MockSession(make_domains(u'foo.com'))
+        self.matcher = DomainMatcher()
+        self.request.registry.domain_matcher = self.matcher
+
+    def test_memoizes_per_name(self):
+        domains = RequestDomains(self.request)
+        self.request.domains = domains
+        first = find_domain(self.request, u'foo.com')
+        self.assertIs(find_domain(self.request, u'FOO.com'), first)
+        self.assertIsNone(find_domain(self.request, u'bar.com'))
+        self.assertIsNone(find_domain(self.request, u'bar.com'))
+        self.assertEqual(domains.hits, 2)
+        self.assertEqual(domains.misses, 2)
+
+    def test_records_counters(self):
+        domains = RequestDomains(self.request)
+        domains.find(u'foo.com')
+        domains.find(u'foo.com')
+        domains.finished(self.request)
+        self.assertEqual(self.matcher.request_hits, 1)
+        self.assertEqual(self.matcher.request_misses, 1)
@@ -0,0 +1,123 @@
+from unittest import TestCase
+import time
+
+from mock import MagicMock
+from passlib.context import CryptContext
+
+from sqlalchemy.dialects import postgresql
+
+from speak_friend.hashing import PasswordHashingService
+from speak_friend.hashing import PasswordServiceBusy
+from speak_friend.hashing import RehashQueue
+from speak_friend.hashing import hash_status
+
+
+class PasswordHashingServiceTests(TestCase):
+    def setUp(self):
+        self.context = CryptContext(schemes=['ldap_salted_sha1'])
+        self.service = PasswordHashingService(self.context, 1, queue_size=1,
+                                              timeout=5)
+
+    def tearDown(self):
+        self.service.stop()
+
+    def test_hashes_in_pool(self):
+        pw_hash = self.service.encrypt('secret')
+        self.assertTrue(self.context.verify('secret', pw_hash))
+        self.assertTrue(self.service.verify('secret', pw_hash))
+        self.assertFalse(self.service.verify('wrong', pw_hash))
+        self.assertEqual(self.service.pending, 0)
+        self.assertEqual(self.service.hash_time.count, 3)
+        self.assertEqual(self.service.queue_wait.count, 3)
+
+    def test_started_before_calls(self):
+        self.service.start()
+        pool = self.service._pool
+        self.assertTrue(pool is not None)
+        self.service.start()
+        self.service.encrypt('secret')
+        self.assertTrue(self.service._pool is pool)
+
+    def test_stats(self):
+        self.service.verify('secret', self.context.encrypt('secret'))
+        stats = self.service.stats()
+        self.assertEqual(stats['calls'], 1)
+        self.assertEqual(stats['pending'], 0)
+        self.assertEqual(stats['busy'], 0)
+        self.assertTrue(stats['hash_time_max'] >= stats['hash_time_mean'])
+        self.service.log_stats()
+
+    def test_local_methods(self):
+        pw_hash = self.context.encrypt('secret')
+        self.assertFalse(self.service.needs_update(pw_hash))
+        self.assertEqual(self.service.identify(pw_hash), 'ldap_salted_sha1')
+
+    def test_worker_errors_raised(self):
+        self.assertRaises(ValueError, self.service.verify, 'secret', 'junk')
+        self.assertEqual(self.service.pending, 0)
+
+    def test_busy(self):
+        self.service.pool()
+        self.service.pending = self.service.max_pending
+        self.assertRaises(PasswordServiceBusy, self.service.verify,
+                          'secret', '{SSHA}junk')
+        self.assertEqual(self.service.busy, 1)
+        self.assertEqual(self.service.pending, self.service.max_pending)
+
+
+class RehashQueueTests(TestCase):
+    def setUp(self):
+        self.rehash_queue = RehashQueue(rate=100, queue_size=2, max_age=60)
+        self.rehash_queue.start = lambda: None
+        self.rehash_queue.context = CryptContext(schemes=['ldap_salted_sha1'])
+        self.rehash_queue.engine = MagicMock()
+        engine = self.rehash_queue.engine
+        self.connection = engine.begin.return_value.__enter__()
+
+    def test_enqueue_once_per_user(self):
+        self.rehash_queue.enqueue(u'dave', u'{SHA}old', 'secret')
+        self.rehash_queue.enqueue(u'dave', u'{SHA}old', 'secret')
+        self.rehash_queue.enqueue(u'bob', u'{SHA}old', 'secret')
+        self.rehash_queue.enqueue(u'eve', u'{SHA}old', 'secret')
+        self.assertEqual(self.rehash_queue.queue.qsize(), 2)
+        self.assertEqual(self.rehash_queue.dropped, 1)
+
+    def test_compare_and_swap(self):
+        self.connection.execute.return_value.rowcount = 1
+        self.rehash_queue.rehash(time.time(), u'dave', u'{SHA}old', 'secret')
+        stmt = self.connection.execute.call_args[0][0]
+        compiled = stmt.compile(dialect=postgresql.dialect())
+        self.assertIn('user_profiles.password_hash = %(password_hash_1)s',
+                      str(compiled))
+        self.assertEqual(compiled.params['password_hash_1'], u'{SHA}old')
+        self.assertTrue(self.rehash_queue.context.verify(
+            'secret', compiled.params['password_hash']))
+        self.assertEqual(self.rehash_queue.rehashed, 1)
+
+    def test_conflict(self):
+        self.connection.execute.return_value.rowcount = 0
+        self.rehash_queue.rehash(time.time(), u'dave', u'{SHA}old', 'secret')
+        self.assertEqual(self.rehash_queue.conflicts, 1)
+
+    def test_expired(self):
+        self.rehash_queue.rehash(time.time() - 61, u'dave', u'{SHA}old',
+                                 'secret')
+        self.assertFalse(self.connection.execute.called)
+        self.assertEqual(self.rehash_queue.expired, 1)
+
+
+class HashStatusTests(TestCase):
+    def test_counts(self):
+        context = CryptContext(schemes=['ldap_salted_sha1', 'ldap_sha1'],
+                               deprecated=['ldap_sha1'])
+        session = MagicMock()
+        session.query.return_value.yield_per.return_value = [
+            (context.hash('secret'),),
+            (context.handler('ldap_sha1').hash('secret'),),
+            (u'!',),
+        ]
+        status = hash_status(session, context)
+        self.assertEqual(status['total'], 3)
+        self.assertEqual(status['current'], 1)
+        self.assertEqual(status['schemes'], {'ldap_salted_sha1': 1,
+                                             'ldap_sha1': 1, 'unknown': 1})
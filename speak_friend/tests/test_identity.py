@@ -0,0 +1,64 @@
+from sqlalchemy.orm import Session
+
+from sixfeetup.bowab.tests.mocks import MockSession
+
+from speak_friend.identity import IdentityCache
+from speak_friend.identity import invalidate_identity
+from speak_friend.identity import load_user
+from speak_friend.security import Admins
+from speak_friend.security import Viewers
+from speak_friend.security import groupfinder
+from speak_friend.tests.common import SFBaseCase
+from speak_friend.tests.mocks import create_user
+
+
+class IdentityCacheTests(SFBaseCase):
+    def setUp(self):
+        super(IdentityCacheTests, self).setUp()
+        self.user = create_user(u'dave')
+        self.cache = IdentityCache(10)
+        self.request.registry.identity_cache = self.cache
+        self.request.db_session = MockSession([self.user])
+
+    def test_loads_once(self):
+        values = self.cache.get(self.request.db_session, u'dave')
+        self.assertEqual(values['email'], u'test@test.com')
+        self.assertNotIn('password_hash', values)
+        self.request.db_session._store.remove(self.user)
+        self.assertIs(self.cache.get(self.request.db_session, u'Dave'),
+                      values)
+
+    def test_missing_user(self):
+        self.request.db_session = MockSession()
+        self.assertIsNone(self.cache.get(self.request.db_session, u'dave'))
+        self.assertEqual(len(self.cache.entries), 0)
+
+    def test_groupfinder(self):
+        self.assertEqual(groupfinder(u'dave', self.request), [Viewers])
+        self.cache.invalidate(u'dave')
+        self.user.is_superuser = True
+        self.assertEqual(groupfinder(u'dave', self.request),
+                         [Viewers, Admins])
+
+    def test_groupfinder_without_cache(self):
+        self.request.registry.identity_cache = None
+        self.assertEqual(groupfinder(u'dave', self.request), [Viewers])
+        self.request.db_session = MockSession()
+        self.assertIsNone(groupfinder(u'dave', self.request))
+
+    def test_invalidate_identity(self):
+        self.cache.remember(self.user)
+        invalidate_identity(self.request, u'DAVE')
+        self.assertEqual(len(self.cache.entries), 0)
+
+    def test_load_user_attaches_to_session(self):
+        self.cache.remember(self.user)
+        session = Session()
+        self.request.db_session = session
+        user = load_user(self.request, u'dave')
+        self.assertIsNot(user, self.user)
+        self.assertIn(user, session)
+        self.assertEqual(user.first_name, u'Fname')
+        self.assertFalse(session.dirty)
+        # Sensitive columns are left to be loaded from the database
+        self.assertNotIn('password_hash', user.__dict__)
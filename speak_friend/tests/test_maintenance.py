@@ -0,0 +1,76 @@
+from unittest import TestCase
+
+from mock import Mock
+from mock import patch
+
+from speak_friend.maintenance import PeriodicTask
+from speak_friend.maintenance import cleanup_nonces
+from speak_friend.maintenance import delete_in_batches
+from speak_friend.maintenance import reap
+from speak_friend.models.open_id import Nonce
+
+
+class PeriodicTaskTests(TestCase):
+    def test_runs_until_stopped(self):
+        calls = []
+        task = PeriodicTask('test', 0.001, calls.append, 'run')
+        task.start()
+        while not calls:
+            pass
+        task.stop(1)
+        self.assertFalse(task._thread.is_alive())
+        self.assertEqual(set(calls), set(['run']))
+
+    def test_survives_errors(self):
+        func = Mock(side_effect=[ValueError, None])
+        task = PeriodicTask('test', 0.001, func)
+        task.start()
+        while func.call_count < 2:
+            pass
+        task.stop(1)
+        self.assertTrue(task.runs >= 2)
+
+
+class CleanupNoncesTests(TestCase):
+    @patch('speak_friend.maintenance.mark_changed')
+    def test_cleanup(self, mark_changed):
+        db_session = Mock()
+        query = db_session.query.return_value.filter.return_value
+        query.delete.return_value = 4
+        self.assertEqual(cleanup_nonces(db_session), 4)
+        self.assertTrue(db_session.remove.called)
+
+
+class ReapTests(TestCase):
+    @patch('speak_friend.maintenance.mark_changed')
+    def test_batches_until_done(self, mark_changed):
+        db_session = Mock()
+        results = [Mock(rowcount=n) for n in (2, 2, 1, 0, 2, 0, 1, 0)]
+        db_session.execute.side_effect = results
+        counts = reap(db_session, batch_size=2)
+        self.assertEqual(counts, {'associations': 5, 'nonces': 0,
+                                  'reset_tokens': 2, 'revocations': 1,
+                                  'auth_codes': 0})
+        self.assertEqual(db_session.execute.call_count, 8)
+
+    @patch('speak_friend.maintenance.mark_changed')
+    def test_access_tokens_opt_in(self, mark_changed):
+        db_session = Mock()
+        db_session.execute.return_value.rowcount = 0
+        counts = reap(db_session, batch_size=2)
+        self.assertNotIn('access_tokens', counts)
+        counts = reap(db_session, batch_size=2, access_tokens=True)
+        self.assertEqual(counts['access_tokens'], 0)
+        sql = str(db_session.execute.call_args[0][0])
+        self.assertIn('DELETE FROM oauth_authorizations', sql)
+        self.assertTrue(db_session.remove.called)
+
+    def test_batch_statement(self):
+        db_session = Mock()
+        db_session.execute.return_value.rowcount = 0
+        with patch('speak_friend.maintenance.mark_changed'):
+            delete_in_batches(db_session, Nonce.__table__,
+                              Nonce.timestamp < 10, 50)
+        sql = str(db_session.execute.call_args[0][0])
+        self.assertIn('DELETE FROM openid.nonces', sql)
+        self.assertIn('LIMIT', sql)
@@ -0,0 +1,259 @@
+import datetime
+from unittest import TestCase
+
+from mock import Mock
+
+from speak_friend.models.authorizations import OAuthAuthorization
+from speak_friend.oauth_provider import SFOauthProvider
+from speak_friend.oauth_provider import TokenValidationCache
+from speak_friend.oauth_provider import UNDEFINED_SECRET
+from speak_friend.utils import hash_string
+
+
+class TokenDigestTests(TestCase):
+    def setUp(self):
+        self.session = Mock()
+        self.provider = SFOauthProvider(self.session)
+        self.code = self.provider.generate_authorization_code()
+        self.token = self.provider.generate_access_token()
+
+    def filter_values(self):
+        query = self.session.query.return_value
+        criteria = query.filter.call_args[0]
+        return [c.right.value for c in criteria
+                if hasattr(c.right, 'value')]
+
+    def test_new_code_stored_as_digest(self):
+        self.session.query.return_value.filter.return_value.first.\
+            return_value = None
+        self.provider.persist_authorization_code(u'foo.com', u'dave',
+                                                 self.code)
+        authz = self.session.add.call_args[0][0]
+        self.assertEqual(authz.auth_code, hash_string(self.code))
+        self.assertEqual(authz.access_token, UNDEFINED_SECRET)
+
+    def test_token_stored_as_digest(self):
+        authz = OAuthAuthorization(u'dave', u'foo.com', UNDEFINED_SECRET,
+                                   hash_string(self.code), None)
+        self.session.query.return_value.filter.return_value.first.\
+            return_value = authz
+        self.provider.persist_access_token(u'foo.com', self.code, self.token)
+        self.assertIn(hash_string(self.code), self.filter_values())
+        self.assertEqual(authz.access_token, hash_string(self.token))
+        self.assertEqual(authz.auth_code, UNDEFINED_SECRET)
+
+    def test_lookup_by_digest(self):
+        self.provider.user_for_access_token(u'foo.com', self.token)
+        values = self.filter_values()
+        self.assertIn(hash_string(self.token), values)
+        self.assertNotIn(self.token, values)
+
+    def test_placeholder_never_matches(self):
+        self.assertFalse(self.provider.validate_auth_code(u'foo.com',
+                                                          UNDEFINED_SECRET))
+        self.assertFalse(self.session.query.called)
+
+
+class TokenValidationCacheTests(TestCase):
+    def setUp(self):
+        self.session = Mock()
+        self.cache = TokenValidationCache(10)
+        self.provider = SFOauthProvider(self.session, token_cache=self.cache)
+        self.token = self.provider.generate_access_token()
+        self.digest = hash_string(self.token)
+        self.first = self.session.query.return_value.filter.return_value.first
+
+    def test_user_for_access_token_cached(self):
+        self.first.return_value = OAuthAuthorization(
+            u'dave', u'foo.com', self.digest, UNDEFINED_SECRET,
+            datetime.datetime.utcnow() + datetime.timedelta(days=1))
+        self.assertEqual(
+            self.provider.user_for_access_token(u'foo.com', self.token),
+            u'dave')
+        self.assertEqual(
+            self.provider.user_for_access_token(u'foo.com', self.token),
+            u'dave')
+        self.assertEqual(self.first.call_count, 1)
+
+    def test_negative_result_cached(self):
+        self.first.return_value = None
+        self.assertIsNone(
+            self.provider.user_for_access_token(u'foo.com', self.token))
+        self.assertIsNone(
+            self.provider.user_for_access_token(u'foo.com', self.token))
+        self.assertEqual(self.first.call_count, 1)
+
+    def test_user_details_cached(self):
+        first = self.session.query.return_value.outerjoin.return_value.\
+            filter.return_value.first
+        first.return_value = Mock(
+            username=u'dave', email=u'd@example.com', first_name=u'Dave',
+            last_name=u'Smith',
+            valid_until=datetime.datetime.utcnow() + datetime.timedelta(1))
+        details = self.provider.user_details_for_access_token(u'foo.com',
+                                                              self.token)
+        self.assertEqual(
+            self.provider.user_details_for_access_token(u'foo.com',
+                                                        self.token),
+            details)
+        self.assertEqual(self.session.query.call_count, 1)
+        # Dropped when the profile changes
+        self.cache.invalidate_user(u'dave')
+        self.provider.user_details_for_access_token(u'foo.com', self.token)
+        self.assertEqual(self.session.query.call_count, 2)
+
+    def test_bad_token_details_cached(self):
+        first = self.session.query.return_value.outerjoin.return_value.\
+            filter.return_value.first
+        first.return_value = None
+        for i in range(2):
+            self.assertIsNone(self.provider.user_details_for_access_token(
+                u'foo.com', self.token))
+        self.assertEqual(self.session.query.call_count, 1)
+
+    def test_cached_per_client(self):
+        self.first.return_value = None
+        self.provider.user_for_access_token(u'foo.com', self.token)
+        self.provider.user_for_access_token(u'bar.com', self.token)
+        self.assertEqual(self.first.call_count, 2)
+
+    def test_expired_authorization_not_cached(self):
+        self.cache.set(self.digest, ('client', u'foo.com'), u'dave', u'dave',
+                       datetime.datetime.utcnow() - datetime.timedelta(1))
+        self.assertIsNone(self.cache.get(self.digest, ('client', u'foo.com')))
+
+    def test_invalidate_token(self):
+        self.cache.set(self.digest, ('client', u'foo.com'), u'dave', u'dave')
+        self.cache.set(self.digest, ('user', u'dave'), u'dave', True)
+        self.cache.set(u'other', ('user', u'dave'), u'dave', True)
+        self.cache.invalidate_token(self.digest)
+        self.assertIsNone(self.cache.get(self.digest, ('client', u'foo.com')))
+        self.assertIsNone(self.cache.get(self.digest, ('user', u'dave')))
+        self.assertTrue(self.cache.get(u'other', ('user', u'dave')))
+
+    def test_invalidate_user(self):
+        self.cache.set(self.digest, ('user', u'dave'), u'Dave', True)
+        self.cache.set(u'other', ('user', u'sue'), u'sue', True)
+        self.cache.invalidate_user(u'dave')
+        self.assertIsNone(self.cache.get(self.digest, ('user', u'dave')))
+        self.assertTrue(self.cache.get(u'other', ('user', u'sue')))
+
+
+class BatchValidationTests(TestCase):
+    def setUp(self):
+        self.session = Mock()
+        self.provider = SFOauthProvider(self.session)
+        self.tokens = [self.provider.generate_access_token() for i in range(3)]
+        self.all = self.session.query.return_value.outerjoin.return_value.\
+            filter.return_value.all
+
+    def row(self, token, username, **kw):
+        values = dict(access_token=hash_string(token), client_id=u'foo.com',
+                      username=username, valid_until=None, email=u'a@b.com',
+                      first_name=u'A', last_name=u'B', locked=False,
+                      admin_disabled=False)
+        values.update(kw)
+        return Mock(**values)
+
+    def test_single_query(self):
+        self.all.return_value = [
+            self.row(self.tokens[0], u'dave'),
+            self.row(self.tokens[1], u'sue', locked=True),
+        ]
+        pairs = [
+            (u'dave', self.tokens[0]),
+            (u'sue', self.tokens[1]),
+            (u'bob', self.tokens[2]),
+            (u'dave', self.tokens[1]),
+            (u'dave', u'short'),
+        ]
+        results = self.provider.validate_users_with_access_tokens(pairs)
+        self.assertEqual(results, [True, False, False, False, False])
+        self.assertEqual(self.session.query.call_count, 1)
+
+    def test_cached_results_not_queried(self):
+        cache = TokenValidationCache(10)
+        self.provider.token_cache = cache
+        cache.set(hash_string(self.tokens[0]), ('user', u'dave'), u'dave',
+                  (True, None))
+        results = self.provider.validate_users_with_access_tokens(
+            [(u'dave', self.tokens[0])])
+        self.assertEqual(results, [True])
+        self.assertFalse(self.session.query.called)
+
+
+class SingleQueryTests(TestCase):
+    def setUp(self):
+        self.session = Mock()
+        self.provider = SFOauthProvider(self.session)
+        self.token = self.provider.generate_access_token()
+        self.first = self.session.query.return_value.join.return_value.\
+            filter.return_value.first
+
+    def test_validate_user_one_query(self):
+        self.first.return_value = Mock(locked=False, admin_disabled=False)
+        self.assertTrue(
+            self.provider.validate_user_with_access_token(u'dave', self.token))
+        self.assertEqual(self.session.query.call_count, 1)
+        columns = [c.key for c in self.session.query.call_args[0]]
+        self.assertEqual(columns, ['valid_until', 'locked', 'admin_disabled'])
+
+    def test_validate_locked_user(self):
+        self.first.return_value = Mock(locked=True, admin_disabled=False)
+        self.assertFalse(
+            self.provider.validate_user_with_access_token(u'dave', self.token))
+
+    def test_user_details_one_query(self):
+        first = self.session.query.return_value.outerjoin.return_value.\
+            filter.return_value.first
+        first.return_value = Mock(username=u'dave', email=u'd@example.com',
+                                  first_name=u'Dave', last_name=u'Smith')
+        details = self.provider.user_details_for_access_token(u'foo.com',
+                                                              self.token)
+        self.assertEqual(details[:4], (u'dave', u'd@example.com', u'Dave',
+                                       u'Smith'))
+        self.assertEqual(details.email, u'd@example.com')
+        self.assertEqual(self.session.query.call_count, 1)
+
+
+class ClientSecretTests(TestCase):
+    def setUp(self):
+        self.session = Mock()
+        self.credentials = Mock()
+        self.provider = SFOauthProvider(self.session,
+                                        credentials=self.credentials)
+
+    def test_correct_secret(self):
+        self.credentials.secret_digest.return_value = hash_string('s3cret')
+        self.credentials.recheck.return_value = hash_string('s3cret')
+        self.assertTrue(self.provider.validate_client_secret(u'foo.com',
+                                                             u's3cret'))
+        self.assertFalse(self.provider.validate_client_secret(u'foo.com',
+                                                              u'wrong'))
+        self.assertFalse(self.provider.validate_client_secret(u'foo.com',
+                                                              u''))
+
+    def test_rotated_elsewhere(self):
+        self.credentials.secret_digest.return_value = hash_string('old')
+        self.credentials.recheck.return_value = hash_string('new')
+        self.assertTrue(self.provider.validate_client_secret(u'foo.com',
+                                                             u'new'))
+        self.assertEqual(self.credentials.recheck.call_count, 1)
+        self.assertTrue(self.provider.validate_client_secret(u'foo.com',
+                                                             u'old'))
+        self.assertEqual(self.credentials.recheck.call_count, 1)
+        self.credentials.recheck.return_value = None
+        self.assertFalse(self.provider.validate_client_secret(u'foo.com',
+                                                              u'wrong'))
+
+    def test_unknown_client(self):
+        self.credentials.secret_digest.return_value = None
+        self.assertFalse(self.provider.validate_client_secret(u'nope.com',
+                                                              u's3cret'))
+
+    def test_without_credentials_cache(self):
+        provider = SFOauthProvider(self.session)
+        self.session.query.return_value.filter.return_value.first.\
+            return_value = None
+        self.assertFalse(provider.validate_client_secret(u'nope.com',
+                                                         u's3cret'))
@@ -22,7 +22,7 @@ class MockQuery(mocks.MockQuery):
         """
         Differentiate between DomainProfiles and UserActivities.
         """
-        if model.__name__ == 'UserActivity':
+        if model.__name__ in ('UserActivity', 'LatestUserActivity'):
             return mocks.MockQuery(self._store[:1])(model)
         return mocks.MockQuery(self._store[1:])
 
@@ -0,0 +1,37 @@
+from unittest import TestCase
+
+from speak_friend.cache import LRUCache
+from speak_friend.throttle import LoginThrottle
+
+
+class LoginThrottleTests(TestCase):
+    def setUp(self):
+        self.throttle = LoginThrottle(LRUCache(10))
+
+    def test_bucket_empties_and_refills(self):
+        for i in range(3):
+            self.assertEqual(self.throttle.take('k', 3, now=100), 0)
+        self.assertAlmostEqual(self.throttle.take('k', 3, now=100), 20)
+        # One attempt back every 20 seconds
+        self.assertAlmostEqual(self.throttle.take('k', 3, now=110), 10)
+        self.assertEqual(self.throttle.take('k', 3, now=121), 0)
+        self.assertTrue(self.throttle.take('k', 3, now=121))
+
+    def test_no_limit(self):
+        for i in range(100):
+            self.assertEqual(self.throttle.take('k', 0), 0)
+        self.assertEqual(len(self.throttle.store), 0)
+
+    def test_check_address(self):
+        self.assertEqual(self.throttle.check_address('10.0.0.1', 1), 0)
+        self.assertTrue(self.throttle.check_address('10.0.0.1', 1))
+        self.assertEqual(self.throttle.check_address('10.0.0.2', 1), 0)
+        self.assertEqual(self.throttle.throttled, 1)
+
+    def test_check_account(self):
+        self.assertEqual(self.throttle.check_account(u'dave', 1), 0)
+        self.assertTrue(self.throttle.check_account(u'dave', 1))
+        self.assertEqual(self.throttle.check_account(u'bob', 1), 0)
+        self.assertEqual(self.throttle.throttled, 1)
+        # Addresses and accounts have separate buckets
+        self.assertEqual(self.throttle.check_address(u'dave', 1), 0)
@@ -0,0 +1,172 @@
+from datetime import datetime
+from datetime import timedelta
+import time
+from unittest import TestCase
+
+from mock import Mock
+from mock import patch
+
+from speak_friend.oauth_provider import SFOauthProvider
+from speak_friend.tokens import RevocationList
+from speak_friend.tokens import TokenSigner
+from speak_friend.tokens import parse_signing_keys
+from speak_friend.utils import hash_string
+
+
+def expires(**kw):
+    return datetime.utcnow() + timedelta(**kw)
+
+
+class SigningKeysTests(TestCase):
+    def test_parse(self):
+        self.assertEqual(parse_signing_keys(['b:two', 'a:o:ne']),
+                         [('b', 'two'), ('a', 'o:ne')])
+
+    def test_malformed(self):
+        self.assertRaises(ValueError, parse_signing_keys, ['nosecret'])
+        self.assertRaises(ValueError, parse_signing_keys, ['a.b:secret'])
+        self.assertRaises(ValueError, parse_signing_keys, ['a:x', 'a:y'])
+
+
+class TokenSignerTests(TestCase):
+    def setUp(self):
+        self.signer = TokenSigner([('k2', 'new secret'), ('k1', 'old secret')])
+
+    def test_round_trip(self):
+        token = self.signer.sign(u'dave', u'foo.com', expires(days=1))
+        self.assertTrue(self.signer.is_signed(token))
+        claims = self.signer.verify(token)
+        self.assertEqual(claims['username'], u'dave')
+        self.assertEqual(claims['client_id'], u'foo.com')
+
+    def test_tampered(self):
+        token = self.signer.sign(u'dave', u'foo.com', expires(days=1))
+        prefix, key_id, payload, signature = token.split('.')
+        other = self.signer.sign(u'sue', u'foo.com', expires(days=1))
+        forged = '.'.join([prefix, key_id, other.split('.')[2], signature])
+        self.assertIsNone(self.signer.verify(forged))
+        self.assertIsNone(self.signer.verify(token[:-2]))
+        self.assertIsNone(self.signer.verify(u'not a token'))
+
+    def test_expired(self):
+        token = self.signer.sign(u'dave', u'foo.com', expires(seconds=-1))
+        self.assertIsNone(self.signer.verify(token))
+
+    def test_rotation(self):
+        old = TokenSigner([('k1', 'old secret')])
+        token = old.sign(u'dave', u'foo.com', expires(days=1))
+        self.assertIsNotNone(self.signer.verify(token))
+        retired = TokenSigner([('k2', 'new secret')])
+        self.assertIsNone(retired.verify(token))
+
+
+class RevocationListTests(TestCase):
+    def setUp(self):
+        self.session = Mock()
+        self.revocations = RevocationList()
+        self.claims = {'username': u'Dave', 'client_id': u'foo.com',
+                       'issued': int(time.time()) - 60}
+
+    def load(self, *rows):
+        self.session.query.return_value.all.return_value = list(rows)
+
+    def test_token_revoked(self):
+        self.load((u'token', u'abc', datetime.utcnow()))
+        self.assertTrue(self.revocations.is_revoked(self.session, u'abc',
+                                                    self.claims))
+        self.assertFalse(self.revocations.is_revoked(self.session, u'def',
+                                                     self.claims))
+
+    def test_only_earlier_tokens_revoked(self):
+        self.load((u'user', u'dave', datetime.utcnow() - timedelta(hours=1)),
+                  (u'client', u'bar.com', datetime.utcnow()))
+        self.assertFalse(self.revocations.is_revoked(self.session, u'abc',
+                                                     self.claims))
+        self.claims['issued'] -= 7200
+        self.assertTrue(self.revocations.is_revoked(self.session, u'abc',
+                                                    self.claims))
+
+    def test_loaded_once(self):
+        self.load()
+        for i in range(3):
+            self.revocations.is_revoked(self.session, u'abc', self.claims)
+        self.assertEqual(self.session.query.call_count, 1)
+
+    @patch('speak_friend.tokens.after_commit')
+    def test_revoke(self, after_commit):
+        self.load()
+        self.revocations.is_revoked(self.session, u'abc', self.claims)
+        self.revocations.revoke(self.session, 'client', u'foo.com')
+        revocation = self.session.add.call_args[0][0]
+        self.assertEqual(revocation.value, u'foo.com')
+        callback, args = after_commit.call_args[0][0], \
+            after_commit.call_args[0][1:]
+        callback(*args)
+        self.assertTrue(self.revocations.is_revoked(self.session, u'abc',
+                                                    self.claims))
+
+
+class SignedProviderTests(TestCase):
+    def setUp(self):
+        self.session = Mock()
+        self.revocations = Mock()
+        self.revocations.is_revoked.return_value = False
+        self.identities = Mock()
+        self.identities.get.return_value = {'locked': False,
+                                            'admin_disabled': False}
+        self.provider = SFOauthProvider(
+            self.session, signer=TokenSigner([('k1', 'secret')]),
+            revocations=self.revocations, identities=self.identities)
+        self.token = self.provider.generate_access_token(u'dave', u'foo.com')
+
+    def test_checked_without_query(self):
+        self.assertEqual(
+            self.provider.user_for_access_token(u'foo.com', self.token),
+            u'dave')
+        self.assertIsNone(
+            self.provider.user_for_access_token(u'bar.com', self.token))
+        self.assertTrue(
+            self.provider.validate_user_with_access_token(u'dave', self.token))
+        self.assertFalse(
+            self.provider.validate_user_with_access_token(u'sue', self.token))
+        self.assertFalse(self.session.query.called)
+
+    def test_refused_while_locked(self):
+        self.identities.get.return_value = {'locked': True,
+                                            'admin_disabled': False}
+        self.assertFalse(
+            self.provider.validate_user_with_access_token(u'dave', self.token))
+        self.identities.get.return_value = {'locked': False,
+                                            'admin_disabled': False}
+        self.assertTrue(
+            self.provider.validate_user_with_access_token(u'dave', self.token))
+        self.assertFalse(self.revocations.revoke.called)
+
+    def test_revoked(self):
+        self.revocations.is_revoked.return_value = True
+        self.assertFalse(
+            self.provider.validate_user_with_access_token(u'dave', self.token))
+        digest = self.revocations.is_revoked.call_args[0][1]
+        self.assertEqual(digest, hash_string(self.token))
+
+    def test_replaced_token_revoked(self):
+        authz = Mock(access_token=u'olddigest', username=u'dave',
+                     token_signed=True)
+        self.session.query.return_value.filter.return_value.first.\
+            return_value = authz
+        token = self.provider.persist_access_token(u'foo.com', u'x' * 64)
+        self.assertEqual(self.provider.signer.verify(token)['username'],
+                         u'dave')
+        self.assertTrue(authz.token_signed)
+        self.revocations.revoke.assert_called_with(self.session, 'token',
+                                                   u'olddigest')
+
+    def test_replaced_random_token_not_revoked(self):
+        authz = Mock(access_token=u'olddigest', username=u'dave',
+                     token_signed=False)
+        self.session.query.return_value.filter.return_value.first.\
+            return_value = authz
+        self.provider.persist_authorization_code(u'foo.com', u'dave',
+                                                 u'x' * 64)
+        self.assertFalse(self.revocations.revoke.called)
+        self.assertFalse(authz.token_signed)
@@ -0,0 +1,43 @@
+from mock import MagicMock
+from mock import patch
+
+from webob.multidict import MultiDict
+
+from speak_friend.tests.common import SFBaseCase
+from speak_friend.tests.mocks import create_user
+from speak_friend.views.admin import DisableUser
+
+
+class DisableUserTests(SFBaseCase):
+    def setUp(self):
+        super(DisableUserTests, self).setUp()
+        self.config.add_route('disable_user', '/disable_user/{username}/')
+        self.user = create_user(u'dave')
+        self.request.matchdict['username'] = u'dave'
+        self.request.POST = MultiDict({'submit': ''})
+        self.request.db_session = MagicMock()
+        self.request.db_session.query.return_value.filter.return_value.\
+            first.return_value = self.user
+
+    def post(self):
+        view = DisableUser(self.request)
+        view.form = MagicMock()
+        return view.post()
+
+    @patch('speak_friend.views.admin.invalidate_identity')
+    @patch('speak_friend.views.admin.invalidate_user_tokens')
+    def test_disable_forgets_tokens(self, invalidate_tokens, invalidate_id):
+        self.user.admin_disabled = False
+        self.post()
+        self.assertTrue(self.user.admin_disabled)
+        invalidate_tokens.assert_called_once_with(self.request, u'dave')
+        invalidate_id.assert_called_once_with(self.request, u'dave')
+
+    @patch('speak_friend.views.admin.invalidate_identity')
+    @patch('speak_friend.views.admin.invalidate_user_tokens')
+    def test_enable_forgets_refusals(self, invalidate_tokens, invalidate_id):
+        self.user.admin_disabled = True
+        self.post()
+        self.assertFalse(self.user.admin_disabled)
+        invalidate_tokens.assert_called_once_with(self.request, u'dave')
+        invalidate_id.assert_called_once_with(self.request, u'dave')
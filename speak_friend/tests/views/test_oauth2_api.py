@@ -0,0 +1,130 @@
+import datetime
+
+from mock import patch
+from pyramid.httpexceptions import HTTPBadRequest
+from pyramid.request import Request
+
+from speak_friend.tests.common import SFBaseCase
+from speak_friend.views.oauth2_api import bearer_token
+from speak_friend.views.oauth2_api import introspection_response
+from speak_friend.views.oauth2_api import token_batch
+from speak_friend.views.oauth2_api import validate_user_token
+from speak_friend.views.oauth2_api import validate_user_tokens
+
+
+class TokenBatchTests(SFBaseCase):
+    def test_pairs(self):
+        self.request.json_body = [
+            {'user': 'dave', 'token': 'abc'},
+            {'user': 'sue', 'token': 'def'},
+        ]
+        self.assertEqual(token_batch(self.request, 'user'),
+                         [(u'dave', u'abc'), (u'sue', u'def')])
+
+    def test_malformed(self):
+        self.request.json_body = [{'domain': 'foo.com', 'token': 'abc'}]
+        self.assertRaises(HTTPBadRequest, token_batch, self.request, 'user')
+        self.request.json_body = {'user': 'dave', 'token': 'abc'}
+        self.assertRaises(HTTPBadRequest, token_batch, self.request, 'user')
+
+    def test_too_many(self):
+        self.request.registry.settings['speak_friend.token_batch_size'] = '1'
+        self.request.json_body = [
+            {'user': 'dave', 'token': 'abc'},
+            {'user': 'sue', 'token': 'def'},
+        ]
+        self.assertRaises(HTTPBadRequest, token_batch, self.request, 'user')
+
+    def test_short_tokens_are_invalid(self):
+        self.request.json_body = [{'user': 'dave', 'token': 'abc'}]
+        result = validate_user_tokens(None, self.request)
+        self.assertEqual(result, {'results': [{'valid': False}]})
+
+
+class IntrospectionResponseTests(SFBaseCase):
+    def setUp(self):
+        super(IntrospectionResponseTests, self).setUp()
+        self.request = self.make_request()
+
+    def make_request(self, method='POST', **headers):
+        request = Request.blank('/', method=method, headers=headers)
+        request.registry = self.config.registry
+        return request
+
+    def test_headers(self):
+        payload = {'valid': True}
+        result = introspection_response(self.request, payload)
+        self.assertEqual(result, payload)
+        response = self.request.response
+        self.assertTrue(response.cache_control.private)
+        self.assertFalse(response.cache_control.public)
+        self.assertEqual(response.cache_control.max_age, 60)
+        self.assertTrue(response.etag)
+
+    def test_get_headers(self):
+        request = self.make_request('GET')
+        introspection_response(request, {'valid': True})
+        response = request.response
+        self.assertTrue(response.cache_control.public)
+        self.assertFalse(response.cache_control.private)
+        self.assertEqual(response.vary, ('Authorization',))
+        self.assertEqual(response.cache_control.max_age, 60)
+
+    def test_max_age_bounded_by_expiry(self):
+        valid_until = datetime.datetime.utcnow() + \
+            datetime.timedelta(seconds=30)
+        introspection_response(self.request, {'valid': True}, valid_until)
+        self.assertTrue(self.request.response.cache_control.max_age <= 30)
+        self.request.response.cache_control.max_age = None
+        introspection_response(self.request, {'valid': True},
+                               datetime.datetime.utcnow() -
+                               datetime.timedelta(seconds=5))
+        self.assertEqual(self.request.response.cache_control.max_age, 0)
+
+    def test_ceiling_from_settings(self):
+        settings = self.request.registry.settings
+        settings['speak_friend.introspection_max_age'] = '10'
+        valid_until = datetime.datetime.utcnow() + datetime.timedelta(days=1)
+        introspection_response(self.request, {'valid': True}, valid_until)
+        self.assertEqual(self.request.response.cache_control.max_age, 10)
+
+    def test_get_not_modified(self):
+        request = self.make_request('GET')
+        introspection_response(request, {'valid': True})
+        etag = request.response.etag
+        request = self.make_request('GET', **{'If-None-Match': '"%s"' % etag})
+        result = introspection_response(request, {'valid': True})
+        self.assertEqual(result.status_int, 304)
+        other = introspection_response(self.make_request(
+            'GET', **{'If-None-Match': '"%s"' % etag}), {'valid': False})
+        self.assertEqual(other, {'valid': False})
+
+    def test_bearer_token(self):
+        request = self.make_request('GET', Authorization='Bearer abc ')
+        self.assertEqual(bearer_token(request), 'abc')
+        request = self.make_request('GET', Authorization='Basic abc')
+        self.assertEqual(bearer_token(request), '')
+        self.assertEqual(bearer_token(self.make_request('GET')), '')
+
+    def test_post_ignores_if_none_match(self):
+        introspection_response(self.request, {'valid': True})
+        etag = self.request.response.etag
+        request = self.make_request(**{'If-None-Match': '"%s"' % etag})
+        result = introspection_response(request, {'valid': True})
+        self.assertEqual(result, {'valid': True})
+        self.assertEqual(request.response.status_int, 200)
+        self.assertEqual(request.response.etag, etag)
+        introspection_response(request, {'valid': False})
+        self.assertNotEqual(request.response.etag, etag)
+
+    @patch('speak_friend.views.oauth2_api.get_oauth_provider')
+    def test_validate_by_get(self, get_provider):
+        provider = get_provider.return_value
+        provider.check_user_access_token.return_value = (True, None)
+        request = self.make_request('GET', Authorization='Bearer abc')
+        request.GET['user'] = u'dave'
+        result = validate_user_token(None, request)
+        self.assertEqual(result, {'valid': True})
+        provider.check_user_access_token.assert_called_once_with(u'dave',
+                                                                 'abc')
+        self.assertTrue(request.response.cache_control.public)
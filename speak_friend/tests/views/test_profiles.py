@@ -1,3 +1,4 @@
+from mock import MagicMock
 from passlib.apps import ldap_context
 
 from pyramid import testing
@@ -6,9 +7,11 @@ from speak_friend.views.accounts import CreateProfile, EditProfile, LoginView
 
 from sixfeetup.bowab.tests.mocks import MockSession
 
+from speak_friend.cache import LRUCache
 from speak_friend.forms.controlpanel import MAX_DOMAIN_ATTEMPTS
 from speak_friend.tests.common import SFBaseCase
 from speak_friend.tests.mocks import create_user
+from speak_friend.throttle import LoginThrottle
 
 
 class DummyPasswordContext(object):
@@ -141,3 +144,57 @@ class ViewTests(SFBaseCase):
             'Location', post.headers, 'Missing redirect location')
         self.assertEqual(
             post.headers['Location'], '/', 'Wrong redirect location')
+
+    def test_login_view_throttled(self):
+        request = self.request
+        request.referrer = '/'
+        request.matched_route = self.config.get_routes_mapper(
+            ).get_route('login')
+        throttle = LoginThrottle(LRUCache(10))
+        self.config.registry.login_throttle = throttle
+        request.environ['REMOTE_ADDR'] = '127.0.0.2'
+        request.db_session = MagicMock()
+        request.POST.update(
+            submit='1',
+            came_from=request.referrer,
+            csrf_token=request.session.get_csrf_token(),
+            login=u'testuser', password=u'guess')
+        # Use up the address's attempts
+        for i in range(30):
+            throttle.check_address('127.0.0.2', 30)
+
+        view = LoginView(request, MAX_DOMAIN_ATTEMPTS)
+        info = view.post()
+        self.assertTrue('rendered_form' in info)
+        self.assertEqual(request.response.status_int, 429)
+        self.assertTrue(request.response.retry_after)
+        self.assertFalse(request.db_session.query.called)
+
+    def test_login_view_throttled_by_account(self):
+        request = self.request
+        request.referrer = '/'
+        request.matched_route = self.config.get_routes_mapper(
+            ).get_route('login')
+        throttle = LoginThrottle(LRUCache(10))
+        self.config.registry.login_throttle = throttle
+        request.environ['REMOTE_ADDR'] = '127.0.0.2'
+        user = create_user(u'testuser')
+        request.db_session = MagicMock()
+        request.db_session.query.return_value.filter.return_value.first.\
+            return_value = user
+        self.config.registry.password_context = MagicMock()
+        # Logging in by email draws on the username's bucket
+        request.POST.update(
+            submit='1',
+            came_from=request.referrer,
+            csrf_token=request.session.get_csrf_token(),
+            login=user.email, password=u'guess')
+        for i in range(5):
+            throttle.check_account(u'testuser', 5)
+
+        view = LoginView(request, MAX_DOMAIN_ATTEMPTS)
+        info = view.post()
+        self.assertTrue('rendered_form' in info)
+        self.assertEqual(request.response.status_int, 429)
+        password_context = self.config.registry.password_context
+        self.assertFalse(password_context.verify.called)
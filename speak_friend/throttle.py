@@ -0,0 +1,70 @@
+"""Token bucket throttling of login attempts.
+"""
+import logging
+import threading
+import time
+
+
+BUCKET_REFILL_PERIOD = 60  # seconds to refill an empty bucket
+
+
+class LoginThrottle(object):
+    """Token buckets, one per client address and one per account, checked
+    before a login's password is verified.
+
+    A bucket holds up to ``rate`` attempts and refills at ``rate`` attempts
+    per minute; an attempt finding its bucket empty is refused. Buckets are
+    kept in ``store``, anything with the ``get`` and ``set(key, value,
+    ttl)`` methods of :class:`speak_friend.cache.LRUCache`. A bucket is
+    full again by the time its entry expires, so evicting it is harmless.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.throttled = 0
+        self.logger = logging.getLogger('speak_friend.throttle')
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, now=None):
+        """Take an attempt from ``key``'s bucket. Returns 0 if one was
+        left, otherwise the seconds until there will be.
+        """
+        if not rate:
+            return 0
+        if now is None:
+            now = time.time()
+        per_second = float(rate) / BUCKET_REFILL_PERIOD
+        with self._lock:
+            tokens, updated = self.store.get(key) or (rate, now)
+            tokens = min(rate, tokens + (now - updated) * per_second)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self.store.set(key, (tokens, now), ttl=BUCKET_REFILL_PERIOD)
+        if allowed:
+            return 0
+        return (1 - tokens) / per_second
+
+    def check_address(self, address, rate):
+        """Take an attempt for ``address``, before the login is looked up.
+        Returns 0 if the login may go ahead, otherwise the seconds to wait.
+        """
+        wait = self.take(('address', address), rate)
+        if wait:
+            self.refused('from %s', address)
+        return wait
+
+    def check_account(self, username, rate):
+        """Take an attempt for the account ``username``, which the login
+        was resolved to, so logging in by username or by email draws on the
+        same bucket. Returns 0 or the seconds to wait, as above.
+        """
+        wait = self.take(('account', username), rate)
+        if wait:
+            self.refused('for %r', username)
+        return wait
+
+    def refused(self, message, *args):
+        with self._lock:
+            self.throttled += 1
+        self.logger.warning('Throttled login attempt ' + message, *args)
@@ -0,0 +1,195 @@
+"""Self-describing access tokens, signed with a shared secret.
+
+A signed token carries the username, client_id and expiry it was issued
+for, so it can be checked without a database round trip. Revoking one is
+recorded as an OAuthRevocation row, which every process keeps in memory.
+"""
+from calendar import timegm
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import threading
+import time
+
+from speak_friend.models.authorizations import OAuthRevocation
+from speak_friend.utils import after_commit
+from speak_friend.utils import random_ascii_string
+
+
+TOKEN_PREFIX = 'sf1'
+DEFAULT_REVOCATION_TTL = 30  # seconds
+REVOCATION_KINDS = ('token', 'client', 'user')
+
+
+def b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip('=')
+
+
+def b64decode(data):
+    data = str(data)
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+
+def timestamp(dt):
+    """Seconds since the epoch for a naive UTC datetime."""
+    return timegm(dt.utctimetuple()) + dt.microsecond / 1e6
+
+
+def parse_signing_keys(pairs):
+    """Parse ``key_id:secret`` strings into a list of (key_id, secret).
+
+    Raises ValueError for a malformed or repeated key id.
+    """
+    keys = []
+    for pair in pairs:
+        key_id, sep, secret = pair.partition(':')
+        if not (key_id and sep and secret) or '.' in key_id:
+            raise ValueError(u'Expected key_id:secret, got %r' % pair)
+        if key_id in dict(keys):
+            raise ValueError(u'Signing key %r is repeated' % key_id)
+        keys.append((key_id, secret))
+    return keys
+
+
+class TokenSigner(object):
+    """Issue and verify HMAC-SHA256 signed access tokens.
+
+    ``keys`` is a list of (key_id, secret): new tokens are signed with the
+    first, and tokens signed with any of them are accepted. Rotate keys by
+    adding a new one at the front, and removing the old one once the
+    tokens it signed have expired.
+    """
+
+    def __init__(self, keys):
+        if not keys:
+            raise ValueError(u'At least one signing key is needed')
+        self.current = keys[0][0]
+        self.keys = dict(keys)
+
+    def is_signed(self, token):
+        return token.startswith(TOKEN_PREFIX + '.')
+
+    def signature(self, key_id, signed):
+        digest = hmac.new(self.keys[key_id], signed, hashlib.sha256).digest()
+        return b64encode(digest)
+
+    def sign(self, username, client_id, expires):
+        claims = {
+            'u': username,
+            'c': client_id,
+            'i': int(time.time()),
+            'e': int(timestamp(expires)),
+            # Keeps tokens issued in the same second distinct
+            'n': random_ascii_string(8),
+        }
+        payload = b64encode(json.dumps(claims, separators=(',', ':')))
+        signed = '.'.join([TOKEN_PREFIX, self.current, payload])
+        return '.'.join([signed, self.signature(self.current, signed)])
+
+    def verify(self, token, now=None):
+        """Return the claims of ``token`` as a dictionary with username,
+        client_id, issued and expires keys.
+
+        Returns None if the token is malformed, signed with an unknown key,
+        tampered with or expired.
+        """
+        try:
+            prefix, key_id, payload, signature = str(token).split('.')
+        except (ValueError, UnicodeError):
+            return None
+        if prefix != TOKEN_PREFIX or key_id not in self.keys:
+            return None
+        signed = '.'.join([prefix, key_id, payload])
+        if not hmac.compare_digest(self.signature(key_id, signed),
+                                   signature):
+            return None
+        try:
+            claims = json.loads(b64decode(payload))
+            claims = {
+                'username': claims['u'],
+                'client_id': claims['c'],
+                'issued': claims['i'],
+                'expires': claims['e'],
+            }
+        except (ValueError, TypeError, KeyError):
+            return None
+        if now is None:
+            now = time.time()
+        if claims['expires'] <= now:
+            return None
+        return claims
+
+
+class RevocationList(object):
+    """The revoked signed tokens, kept in memory.
+
+    A ``token`` revocation names a token digest; ``client`` and ``user``
+    revocations reject every token issued to that client or user up to the
+    time of revocation. The rows are reloaded at most every ``ttl`` seconds,
+    which bounds how long other processes accept a revoked token;
+    revocations made by this process apply as soon as they commit.
+    """
+
+    def __init__(self, ttl=DEFAULT_REVOCATION_TTL):
+        self.ttl = ttl
+        self.logger = logging.getLogger('speak_friend.tokens')
+        self._lock = threading.Lock()
+        self._entries = None
+        self._loaded_at = 0
+
+    def is_stale(self):
+        if self._entries is None:
+            return True
+        return time.time() - self._loaded_at > self.ttl
+
+    def load(self, session):
+        entries = dict((kind, {}) for kind in REVOCATION_KINDS)
+        rows = session.query(OAuthRevocation.kind,
+                             OAuthRevocation.value,
+                             OAuthRevocation.revoked_at).all()
+        for kind, value, revoked_at in rows:
+            revoked = entries.setdefault(kind, {})
+            revoked[value] = max(revoked.get(value, 0), timestamp(revoked_at))
+        with self._lock:
+            self._entries = entries
+            self._loaded_at = time.time()
+        self.logger.debug('Loaded %d token revocations', len(rows))
+        return entries
+
+    def entries(self, session):
+        entries = self._entries
+        if entries is None or self.is_stale():
+            entries = self.load(session)
+        return entries
+
+    def add(self, kind, value, revoked_at):
+        with self._lock:
+            if self._entries is None:
+                return
+            revoked = self._entries[kind]
+            revoked[value] = max(revoked.get(value, 0), revoked_at)
+
+    def revoke(self, session, kind, value):
+        """Record a revocation, applying it here once the transaction
+        commits.
+        """
+        if kind not in REVOCATION_KINDS:
+            raise ValueError(u'Unknown revocation kind: %s' % kind)
+        if kind == 'user':
+            value = value.lower()
+        revocation = OAuthRevocation(kind, value)
+        session.add(revocation)
+        after_commit(self.add, kind, value, timestamp(revocation.revoked_at))
+
+    def is_revoked(self, session, digest, claims):
+        entries = self.entries(session)
+        if digest in entries['token']:
+            return True
+        for kind, value in (('client', claims['client_id']),
+                            ('user', claims['username'].lower())):
+            revoked_at = entries[kind].get(value)
+            if revoked_at is not None and claims['issued'] <= revoked_at:
+                return True
+        return False
@@ -11,8 +11,8 @@ from sqlalchemy.orm.exc import DetachedInstanceError
 
 from speak_friend.forms.controlpanel import MAX_DOMAIN_ATTEMPTS
 from speak_friend.forms.controlpanel import MAX_PASSWORD_VALID
-from speak_friend.models.profiles import DomainProfile
-from speak_friend.models.reports import UserActivity
+from speak_friend.domains import find_domain
+from speak_friend.models.reports import DomainLogin
 from speak_friend.utils import get_domain
 from speak_friend.views.accounts import logout
 from speak_friend.views.accounts import LoginView
@@ -32,8 +32,7 @@ def password_timeout_factory(handler, registry):
 
         cp = ControlPanel(request)
         domain_name = get_domain(request)
-        domain = DomainProfile.apply_wildcard(request.db_session,
-                                              domain_name)
+        domain = find_domain(request, domain_name)
         if domain:
             pw_valid = timedelta(minutes=domain.get_password_valid(cp))
         else:
@@ -73,17 +72,23 @@ def initial_login_factory(handler, registry):
         domain_name = get_domain(request)
         if not domain_name:
             return response
+        local_request = request.host == domain_name
+        if local_request:
+            return response
         try:
-            query = request.user.activity_query(request.db_session,
-                                                u'login')
+            username = request.user.username
         except DetachedInstanceError:
             request.db_session.add(request.user)
-            query = request.user.activity_query(request.db_session,
-                                                u'login')
-        query = query.filter(UserActivity.came_from_fqdn == domain_name)
-        domain_logins = query.count()
-        local_request = request.host == domain_name
-        if domain_logins == 0 and not local_request:
+            username = request.user.username
+        cache = getattr(registry, 'login_cache', None)
+        key = DomainLogin.cache_key(username, domain_name)
+        if cache is not None and cache.get(key):
+            return response
+        logged_in = DomainLogin.exists(request.db_session, username,
+                                       domain_name)
+        if logged_in and cache is not None:
+            cache.set(key, True)
+        if not logged_in:
             logger.info('User has not logged in from here yet: %r, %s',
                         request.user, domain_name)
             response = logout(request, request.route_url('home'))
@@ -158,8 +163,7 @@ def valid_referrer_factory(handler, registry):
 
         if 'location' in response.headers:
             domain_name = get_domain(response.headers['location'])
-            domain = DomainProfile.apply_wildcard(request.db_session,
-                                                  domain_name)
+            domain = find_domain(request, domain_name)
             local_request = request.host == domain_name
             if not local_request and domain is None and domain_name:
                 msg = 'Invalid requesting domain, not redirecting: %s'
@@ -7,6 +7,8 @@ from urlparse import parse_qsl, urlsplit, urlunsplit
 
 from pyramid.interfaces import IRequest
 
+import transaction
+
 
 UNICODE_ASCII_CHARACTERS = (string.ascii_letters.decode('ascii') +
     string.digits.decode('ascii'))
@@ -61,6 +63,15 @@ def hash_string(original_str):
     return sha256(original_str).hexdigest()
 
 
+def after_commit(callback, *args, **kwargs):
+    """Call ``callback`` once the current transaction commits successfully.
+    """
+    def hook(succeeded, *args, **kwargs):
+        if succeeded:
+            callback(*args, **kwargs)
+    transaction.get().addAfterCommitHook(hook, args=args, kws=kwargs)
+
+
 def random_ascii_string(length):
     random = SystemRandom()
     return ''.join([random.choice(UNICODE_ASCII_CHARACTERS) for x in xrange(length)])
@@ -77,3 +88,11 @@ def url_is_valid(url_str):
         r'(?:/?|[/?]\S+)$', re.IGNORECASE
     )
     return bool(url_pat.match(url_str))
+
+
+def percentile(ordered, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not ordered:
+        return 0.0
+    rank = int(round(pct / 100.0 * len(ordered) + 0.5)) - 1
+    return ordered[max(0, min(rank, len(ordered) - 1))]
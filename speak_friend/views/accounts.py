@@ -1,6 +1,7 @@
 # Views related to account management (creating, editing, deactivating)
 from datetime import timedelta
 from uuid import UUID
+import math
 
 import colander
 from deform import ValidationFailure
@@ -15,6 +16,8 @@ from pyramid.view import view_defaults
 
 from pyramid_controlpanel.views import ControlPanel
 
+from webhelpers import paginate
+
 from sqlalchemy import func
 
 
@@ -29,6 +32,8 @@ from speak_friend.events import LoginFailed
 from speak_friend.events import PasswordRequested
 from speak_friend.events import ProfileChanged
 from speak_friend.events import get_pwreset_class
+from speak_friend.forms.controlpanel import ADDRESS_ATTEMPTS_PER_MINUTE
+from speak_friend.forms.controlpanel import LOGIN_ATTEMPTS_PER_MINUTE
 from speak_friend.forms.controlpanel import MAX_DOMAIN_ATTEMPTS
 from speak_friend.forms.controlpanel import authentication_schema
 from speak_friend.forms.profiles import make_new_authorization_form
@@ -37,11 +42,11 @@ from speak_friend.forms.profiles import make_password_reset_request_form
 from speak_friend.forms.profiles import make_password_change_form
 from speak_friend.forms.profiles import make_profile_form, make_login_form
 from speak_friend.models.authorizations import OAuthAuthorization
-from speak_friend.models.profiles import DomainProfile
+from speak_friend.models.profiles import LoginAttempts
 from speak_friend.models.profiles import ResetToken
 from speak_friend.models.profiles import UserProfile
-from speak_friend.oauth_provider import SFOauthProvider
-from speak_friend.oauth_provider import UNDEFINED_SECRET
+from speak_friend.oauth_provider import get_oauth_provider
+from speak_friend.oauth_provider import invalidate_token
 from speak_friend.utils import get_domain
 from speak_friend.utils import get_referrer
 from speak_friend.utils import replace_url_csrf
@@ -334,9 +339,9 @@ class ChangePassword(object):
                 self.target_user,
             )
 
-        new_hash = self.login_view.pass_ctx.encrypt(appstruct['new_password'])
-
         if valid_pass:
+            new_hash = self.login_view.pass_ctx.encrypt(
+                appstruct['new_password'])
             self.target_user.password_hash = new_hash
             self.target_user.password_salt = None
             self.request.db_session.add(self.target_user)
@@ -362,6 +367,8 @@ class ChangePassword(object):
 
 @view_defaults(route_name='authorizations')
 class ManageAuthorizations(object):
+    page_size = 50
+
     def __init__(self, request):
         self.request = request
         self.target_username = request.matchdict['username']
@@ -376,41 +383,63 @@ class ManageAuthorizations(object):
         self.frm = make_new_authorization_form(request)
 
     def _get_authorizations(self):
-        authzn_query = self.request.db_session.query(OAuthAuthorization)
-        authzns = authzn_query.filter(
-            OAuthAuthorization.username == self.target_username,
-        ).all()
+        """Return the requested page of the user's authorizations."""
+        try:
+            current_page = max(1, int(self.request.params.get('page', 1)))
+        except ValueError:
+            current_page = 1
+        offset = (current_page - 1) * self.page_size
+        rows, total = OAuthAuthorization.issued_to(
+            self.request.db_session, self.target_username,
+            offset, self.page_size)
         authorizations = []
-        for authzn in authzns:
-            entry = {
-                'name': authzn.client_id,
-                'token': authzn.access_token,
-            }
-            if entry['token'] == UNDEFINED_SECRET:
-                continue
-            dom_query = self.request.db_session.query(DomainProfile)
-            dom = dom_query.filter(
-                DomainProfile.name == authzn.client_id
-            ).first()
-            if dom:
-                entry['name'] = dom.display_name
-            authorizations.append(entry)
-        return authorizations
+        for row in rows:
+            # Only the token's digest is stored
+            authorizations.append({
+                'name': row.name,
+                'client_id': row.client_id,
+                'token': row.access_token,
+                'fingerprint': row.access_token[:12],
+                'valid_until': row.valid_until,
+            })
+        page_url = paginate.PageURL_WebOb(self.request)
+        return paginate.Page(authorizations, current_page,
+                             items_per_page=self.page_size,
+                             item_count=total, presliced_list=True,
+                             url=page_url)
 
     def get(self):
+        authzns = self._get_authorizations()
         return {
             'forms': [self.frm],
-            'authzns': self._get_authorizations(),
+            'authzns': authzns,
+            'pager': authzns.pager(),
             'rendered_form': self.frm.render(),
             'target_username': self.target_username,
         }
 
+    def listing(self):
+        """The page of authorizations as JSON."""
+        authzns = self._get_authorizations()
+        authorizations = []
+        for entry in authzns:
+            entry = dict(entry)
+            entry['valid_until'] = entry['valid_until'].isoformat()
+            authorizations.append(entry)
+        return {
+            'authorizations': authorizations,
+            'page': authzns.page,
+            'page_count': authzns.page_count,
+            'total': authzns.item_count,
+        }
+
     def post(self):
         if self.request.method != "POST":
             return HTTPMethodNotAllowed()
         if 'submit' not in self.request.POST:
             return self.get()
-        provider = SFOauthProvider(self.request.db_session)
+        provider = get_oauth_provider(self.request)
+        token = None
         try:
             description = self.request.POST.get('description', None)
             code = provider.generate_authorization_code()
@@ -419,21 +448,26 @@ class ManageAuthorizations(object):
                 self.target_username,
                 code,
             )
-            token = provider.generate_access_token()
-            provider.persist_access_token(description, code, token)
+            token = provider.persist_access_token(description, code)
         except:
             request.reponse.status = 500
-        return self.get()
+        data = self.get()
+        # The plain token can't be shown again later
+        data['new_token'] = token
+        return data
 
 
 def remove_authzn(request):
     username = request.matchdict['username']
     token = request.matchdict['access_token']
     query = request.db_session.query(OAuthAuthorization)
-    query.filter(
+    query = query.filter(
         OAuthAuthorization.username == username,
         OAuthAuthorization.access_token == token,
-    ).delete()
+    )
+    signed = query.with_entities(OAuthAuthorization.token_signed).scalar()
+    query.delete()
+    invalidate_token(request, token, signed)
     url = request.route_url('authorizations', username=username)
     return HTTPFound(location=url)
 
@@ -621,14 +655,17 @@ class LoginView(object):
         self.invalid_error = 'Username or password is invalid.'
         self.locked_error = 'Your account has been disabled. ' \
                             'Check your email for instructions to reset your password.'
+        self.throttled_error = 'Too many login attempts. ' \
+                               'Please wait a minute before trying again.'
         query = self.request.GET.items()
         action = request.route_url('login', _query=query)
         self.frm = make_login_form(request, action)
         if max_attempts is None:
             cp = ControlPanel(request)
-            self.max_attempts = cp.get_value(authentication_schema.name,
-                                             'max_attempts',
-                                             MAX_DOMAIN_ATTEMPTS)
+            max_attempts = cp.get_value(authentication_schema.name,
+                                        'max_attempts',
+                                        MAX_DOMAIN_ATTEMPTS)
+        self.max_attempts = max_attempts
 
     def verify_password(self, password, saved_hash, user):
         if not user:
@@ -642,18 +679,51 @@ class LoginView(object):
 
         if self.pass_ctx.verify(password, saved_hash, **kwargs):
             if self.pass_ctx.needs_update(saved_hash):
-                new_hash = self.pass_ctx.encrypt(password)
-                user.password_hash = new_hash
-                # if the user had a password_salt stored, we want to wipe it
-                # out so that the salt auto-generated by passlib will
-                # take over
-                user.password_salt = None
-                self.request.db_session.add(user)
+                self.update_hash(password, user)
             passes = True
         else:
             passes = False
         return passes
 
+    def throttle(self, username=None):
+        """Return how many seconds to wait before trying to log in again
+        from this address, or as ``username`` once the login is resolved,
+        or 0 to go ahead.
+        """
+        throttle = getattr(self.request.registry, 'login_throttle', None)
+        if throttle is None:
+            return 0
+        cp = ControlPanel(self.request)
+        if username is not None:
+            rate = cp.get_value(authentication_schema.name,
+                                'login_attempts_per_minute',
+                                LOGIN_ATTEMPTS_PER_MINUTE)
+            return throttle.check_account(username, rate)
+        rate = cp.get_value(authentication_schema.name,
+                            'address_attempts_per_minute',
+                            ADDRESS_ATTEMPTS_PER_MINUTE)
+        return throttle.check_address(self.request.environ.get('REMOTE_ADDR'),
+                                      rate)
+
+    def throttled(self, wait):
+        self.request.response.status = '429 Too Many Requests'
+        self.request.response.retry_after = int(math.ceil(wait))
+        return self.login_error(self.throttled_error)
+
+    def update_hash(self, password, user):
+        rehash_queue = getattr(self.request.registry, 'rehash_queue', None)
+        if rehash_queue is not None:
+            # Upgraded in the background once the request commits
+            rehash_queue.submit(self.request, user, password)
+            return
+        new_hash = self.pass_ctx.encrypt(password)
+        user.password_hash = new_hash
+        # if the user had a password_salt stored, we want to wipe it
+        # out so that the salt auto-generated by passlib will
+        # take over
+        user.password_salt = None
+        self.request.db_session.add(user)
+
     def get(self):
         appstruct = {'came_from': get_referrer(self.request)}
         domain_name = get_domain(self.request)
@@ -697,6 +767,11 @@ class LoginView(object):
         login = appstruct['login']
         password = appstruct['password']
 
+        # Refuse guesses beyond the limits before any hashing or writes
+        wait = self.throttle()
+        if wait:
+            return self.throttled(wait)
+
         query = self.request.db_session.query(UserProfile)
         query = query.filter((UserProfile.username==login) | \
                              (UserProfile.email==login))
@@ -707,26 +782,27 @@ class LoginView(object):
         else:
             return self.login_error(self.invalid_error)
 
+        wait = self.throttle(user.username)
+        if wait:
+            return self.throttled(wait)
+
         if user.admin_disabled:
             return self.login_error(self.disabled_error)
         elif user.locked:
             return self.login_error(self.locked_error)
         elif not self.verify_password(password, saved_hash, user):
             self.request.registry.notify(LoginFailed(self.request, user))
-            # Don't just use += 1, as that is subject to race conditions
-            # with concurrent updates
-            user.login_attempts = UserProfile.login_attempts + 1
-            self.request.db_session.flush()
-            if user.login_attempts >= self.max_attempts:
-                user.locked = True
+            # Counted and compared in the database, as concurrent failures
+            # may be racing this one
+            if LoginAttempts.failed(self.request.db_session, user,
+                                    self.max_attempts):
                 self.request.registry.notify(AccountLocked(self.request, user))
+            if user.locked:
                 return self.login_error(self.locked_error)
             else:
                 return self.login_error(self.invalid_error)
 
-        if user.login_attempts > 0:
-            user.login_attempts = 0
-            user.locked = False
+        if LoginAttempts.reset(self.request.db_session, user):
             self.request.registry.notify(AccountUnlocked(self.request, user))
 
         auth_kw = {}
@@ -19,10 +19,14 @@ from webhelpers import paginate
 
 from pyramid_controlpanel.views import ControlPanel
 
+from speak_friend.domains import invalidate_domains
 from speak_friend.forms.oauth2_api import make_client_secret_form
 from speak_friend.forms.profiles import make_domain_form
 from speak_friend.forms.profiles import make_user_search_form
 from speak_friend.forms.profiles import make_disable_user_form
+from speak_friend.identity import invalidate_identity
+from speak_friend.oauth_provider import invalidate_client_tokens
+from speak_friend.oauth_provider import invalidate_user_tokens
 from speak_friend.models.authorizations import OAuthAuthorization
 from speak_friend.models.profiles import DomainProfile
 from speak_friend.models.profiles import ResetToken
@@ -87,6 +91,7 @@ class CreateDomain(object):
 
         new_domain = DomainProfile(**appstruct)
         self.request.db_session.merge(new_domain)
+        invalidate_domains(self.request)
 
         self.request.session.flash('Domain successfully created!',
                                    queue='success')
@@ -161,6 +166,7 @@ class EditDomain(object):
         if self.target_domain.password_valid != appstruct['password_valid']:
             self.target_domain.password_valid = appstruct['password_valid']
         self.request.db_session.add(self.target_domain)
+        invalidate_domains(self.request)
 
         self.request.session.flash('Domain successfully modified!',
                                    queue='success')
@@ -201,6 +207,8 @@ class DeleteDomain(object):
             authzn_query.filter(
                 OAuthAuthorization.client_id == target_domainname,
             ).delete()
+            invalidate_domains(self.request)
+            invalidate_client_tokens(self.request, target_domainname)
             msg = 'The domain %s was successfully deleted'
             msg_queue = 'success'
 
@@ -401,6 +409,9 @@ class DisableUser(object):
         user = self.get_target_user(self.target_username)
 
         user.admin_disabled = not user.admin_disabled
+        invalidate_identity(self.request, user.username)
+        # Also drops the refusals cached while the account was disabled
+        invalidate_user_tokens(self.request, user.username)
 
         action = {True: 'disabled', False: 'enabled'}[user.admin_disabled]
 
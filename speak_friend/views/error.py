@@ -39,6 +39,15 @@ def notallowed(request):
                                   request=request)
 
 
+def password_service_busy(request):
+    response = render_to_response("speak_friend:templates/400_template.pt",
+                                  {},
+                                  request=request)
+    response.status = request.exception.status
+    response.retry_after = 5
+    return response
+
+
 def badrequest(request):
     return render_to_response("speak_friend:templates/400_template.pt",
                               {},
@@ -1,11 +1,71 @@
+import datetime
+import hashlib
+import json
+
+from pyramid.httpexceptions import HTTPBadRequest
 from pyramid.httpexceptions import HTTPForbidden
 from pyramid.httpexceptions import HTTPFound
 from pyramid.httpexceptions import HTTPInternalServerError
 from pyramid.httpexceptions import HTTPMethodNotAllowed
 from pyramid.security import authenticated_userid
-from speak_friend.models.profiles import UserProfile
+from speak_friend.domains import invalidate_domains
 from speak_friend.oauth_provider import SFOauthProvider
+from speak_friend.oauth_provider import get_oauth_provider
 from speak_friend.forms.oauth2_api import make_client_authorization_form
+from speak_friend.utils import hash_string
+
+
+DEFAULT_TOKEN_BATCH_SIZE = 100
+DEFAULT_INTROSPECTION_MAX_AGE = 60  # seconds
+
+
+def bearer_token(request):
+    """Return the token of an ``Authorization: Bearer`` header, or ''."""
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    if scheme.lower() != 'bearer':
+        return ''
+    return token.strip()
+
+
+def introspection_response(request, payload, valid_until=None):
+    """Let the caller, and shared caches for a GET, cache a successful
+    token check.
+
+    Sets ``Cache-Control: max-age`` to the token's remaining lifetime, at
+    most ``speak_friend.introspection_max_age`` seconds, and an ETag over
+    ``payload``. A GET carries the token in its Authorization header, so
+    the response is public and varies on that header, and a matching
+    If-None-Match gets a 304 response. A POST carries the token in its
+    body, so the response is private and never a 304, as RFC 7232 asks
+    for a 412 for methods other than GET and HEAD. Returns ``payload``
+    otherwise.
+    """
+    settings = request.registry.settings
+    max_age = int(settings.get('speak_friend.introspection_max_age',
+                               DEFAULT_INTROSPECTION_MAX_AGE))
+    if valid_until is not None:
+        remaining = valid_until - datetime.datetime.utcnow()
+        max_age = max(0, min(max_age, int(remaining.total_seconds())))
+    body = json.dumps(payload, sort_keys=True, separators=(',', ':'))
+    response = request.response
+    response.etag = hashlib.sha1(body).hexdigest()
+    response.cache_control.max_age = max_age
+    if request.method not in ('GET', 'HEAD'):
+        # Shared caches can't tell POSTed tokens apart
+        response.cache_control.private = True
+        return payload
+    response.cache_control.public = True
+    response.vary = ('Authorization',)
+    if response.etag in request.if_none_match:
+        response.status = 304
+        return response
+    return payload
+
+
+def uncacheable(request, payload):
+    """Keep callers from caching a failed token check."""
+    request.response.cache_control.no_store = True
+    return payload
 
 
 # add secret to domain profile
@@ -17,6 +77,7 @@ def create_secret(context, request):
     client_id = request.POST.get('domain', '')
     domain = provider.domain_with_id(client_id)
     secret = provider.create_client_secret(domain)
+    invalidate_domains(request)
     return {
         'domain': domain.name,
         'display_name': domain.display_name,
@@ -62,19 +123,18 @@ def process_authorization(context, request):
     allowed = 'submit' in request.POST
     if allowed:
         # user allowed access
-        provider = SFOauthProvider(request.db_session)
+        provider = get_oauth_provider(request)
         username = authenticated_userid(request)
         client_id = request.session.get('oauth2_client_id', '')
         try:
             if response_type == 'token':
                 # place-holder auth code for direct token requests
                 transient_code = provider.generate_authorization_code()
-                response_code = provider.generate_access_token()
                 provider.persist_authorization_code(
                     client_id, username, transient_code
                 )
-                provider.persist_access_token(
-                    client_id, transient_code, response_code
+                response_code = provider.persist_access_token(
+                    client_id, transient_code
                 )
             else:
                 response_code = provider.generate_authorization_code()
@@ -97,16 +157,17 @@ def request_access_token(context, request):
     '''authenticate client app and provide a token'''
     if request.method != 'POST':
         return HTTPMethodNotAllowed()
-    provider = SFOauthProvider(request.db_session)
+    provider = get_oauth_provider(request)
     client_id = request.POST.get('domain', '')
     client_secret = request.POST.get('secret', '')
     request_auth_code = request.matchdict['code']
-    client_valid = provider.validate_client_secret(client_id, client_secret)
-    code_valid = provider.validate_auth_code(client_id, request_auth_code)
-    if client_valid and code_valid:
-        token = provider.generate_access_token()
+    # Don't look up codes for unknown clients
+    valid = (provider.validate_client_secret(client_id, client_secret) and
+             provider.validate_auth_code(client_id, request_auth_code))
+    if valid:
         try:
-            provider.persist_access_token(client_id, request_auth_code, token)
+            token = provider.persist_access_token(client_id,
+                                                  request_auth_code)
         except:
             request.reponse.status = 500
             return {'error': 'database error'}
@@ -119,38 +180,103 @@ def request_access_token(context, request):
 # resource views
 def get_user_details(context, request):
     '''validate the application and return user details'''
-    if request.method != 'POST':
+    if request.method in ('GET', 'HEAD'):
+        client_id = request.GET.get('domain', '')
+        token = bearer_token(request)
+    elif request.method == 'POST':
+        client_id = request.POST.get('domain', '')
+        token = request.POST.get('token', '')
+    else:
         return HTTPMethodNotAllowed()
-    provider = SFOauthProvider(request.db_session)
-    client_id = request.POST.get('domain', '')
-    token = request.POST.get('token', '')
-    username = provider.user_for_access_token(client_id, token)
-    if not username:
+    provider = get_oauth_provider(request)
+    user = provider.user_details_for_access_token(client_id, token)
+    if not user:
         request.response.status = 403
-        return {'error': 'access token not valid for domain'}
-    user = request.db_session.query(UserProfile).get(username)
-    if user:
-        request.response.headers['Access-Control-Allow-Method'] = 'POST'
+        return uncacheable(request,
+                           {'error': 'access token not valid for domain'})
+    if user.email is not None:
+        request.response.headers['Access-Control-Allow-Method'] = 'GET, POST'
         request.response.headers['Access-Control-Allow-Origin'] = '*'
-        return {
-            'username': username,
+        return introspection_response(request, {
+            'username': user.username,
             'email': user.email,
             'given_name': user.first_name,
             'surname': user.last_name,
-        }
+        }, user.valid_until)
     request.response.status = 404
-    return {'error': 'user not found'}
+    return uncacheable(request, {'error': 'user not found'})
 
 
 def validate_user_token(context, request):
     '''validate a user using an access token'''
-    if request.method != 'POST':
+    if request.method in ('GET', 'HEAD'):
+        username = request.GET.get('user', '')
+        token = bearer_token(request)
+    elif request.method == 'POST':
+        username = request.POST.get('user', '')
+        token = request.POST.get('token', '')
+    else:
         return HTTPMethodNotAllowed()
-    provider = SFOauthProvider(request.db_session, tokens_expire=False)
-    username = request.POST.get('user', '')
-    token = request.POST.get('token', '')
+    provider = get_oauth_provider(request, tokens_expire=False)
     try:
-        valid = provider.validate_user_with_access_token(username, token)
+        valid, valid_until = provider.check_user_access_token(username, token)
     except:
         valid = False
-    return {'valid': valid}
+    if not valid:
+        return uncacheable(request, {'valid': False})
+    return introspection_response(request, {'valid': True}, valid_until)
+
+
+def token_batch(request, key):
+    """Return the (key, token) pairs posted as a JSON array of objects.
+
+    Raises HTTPBadRequest if the body isn't such an array, or holds more
+    than ``speak_friend.token_batch_size`` items.
+    """
+    settings = request.registry.settings
+    limit = int(settings.get('speak_friend.token_batch_size',
+                             DEFAULT_TOKEN_BATCH_SIZE))
+    try:
+        items = request.json_body
+        pairs = [(unicode(item[key]), unicode(item['token']))
+                 for item in items]
+    except (ValueError, TypeError, KeyError):
+        raise HTTPBadRequest('Expected a JSON array of {"%s": ..., '
+                             '"token": ...} objects' % key)
+    if len(pairs) > limit:
+        raise HTTPBadRequest('At most %d tokens may be checked at once'
+                             % limit)
+    return pairs
+
+
+def get_users_details(context, request):
+    '''get_user_details for a JSON array of {"domain", "token"} objects'''
+    pairs = token_batch(request, 'domain')
+    provider = get_oauth_provider(request)
+    rows = provider.authorizations_for_access_tokens(
+        [token for client_id, token in pairs])
+    results = []
+    for client_id, token in pairs:
+        row = rows.get(hash_string(token))
+        if not row or row.client_id != client_id:
+            results.append({'error': 'access token not valid for domain'})
+        elif row.email is None:
+            results.append({'error': 'user not found'})
+        else:
+            results.append({
+                'username': row.username,
+                'email': row.email,
+                'given_name': row.first_name,
+                'surname': row.last_name,
+            })
+    request.response.headers['Access-Control-Allow-Method'] = 'POST'
+    request.response.headers['Access-Control-Allow-Origin'] = '*'
+    return {'results': results}
+
+
+def validate_user_tokens(context, request):
+    '''validate_user_token for a JSON array of {"user", "token"} objects'''
+    pairs = token_batch(request, 'user')
+    provider = get_oauth_provider(request, tokens_expire=False)
+    valid = provider.validate_users_with_access_tokens(pairs)
+    return {'results': [{'valid': v} for v in valid]}
@@ -14,7 +14,7 @@ from pyramid.security import authenticated_userid
 from pyramid.view import view_defaults
 
 from speak_friend.events import CheckIDAuthorized
-from speak_friend.models.open_id import SFOpenIDStore
+from speak_friend.models.open_id import get_openid_store
 from speak_friend.models.profiles import UserProfile
 
 
@@ -35,7 +35,7 @@ class OpenIDProvider(object):
 
     def __init__(self, request):
         self.request = request
-        self.openid_server = Server(SFOpenIDStore(self.request.db_session),
+        self.openid_server = Server(get_openid_store(request),
                                     request.route_url('openid_provider'))
         userid = authenticated_userid(request)
         self.auth_userid = userid or request.session.get('auth_userid')